@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark compare_screenshots on a synthetic corpus of screenshot directories.
+
+The corpus has a before and after directory, each with a job directory per
+platform like fetch_screenshots creates, containing identical (hard-linked
+and copied), slightly different, very different and missing images. One
+platform uses Windows maximized names so that system UI is cropped and one
+uses HiDPI dimensions.
+
+Timings of each stage and the throughput are output as JSON, e.g.:
+
+    python benchmarks/compare_benchmark.py --pairs 10 --jobs 4 --output bench.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mozscreenshots"))
+
+import numpy
+from PIL import Image
+
+import compare_screenshots
+
+# (platform, filename infix, scale)
+PLATFORMS = [
+    ("linux64", "", 1),
+    ("windows7-32", "maximized_", 1),
+    ("osx-10-10", "", 2),
+]
+KINDS = ["identical", "copy", "few", "large", "missing_before", "missing_after"]
+
+
+def synthetic_screenshot(random, width, height):
+    """Return RGB pixels resembling UI: a light background with flat coloured boxes."""
+    pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    pixels[:] = (240, 240, 240)
+    for _ in range(40):
+        x, y = random.randint(0, width - 1), random.randint(0, height - 1)
+        w, h = random.randint(8, max(9, width // 4)), random.randint(8, max(9, height // 8))
+        pixels[y:y + h, x:x + w] = random.randint(0, 256, 3)
+    return pixels
+
+
+def save(pixels, path):
+    Image.fromarray(pixels).save(path, "PNG")
+
+
+def build_corpus(root, pairs, width, height, seed=0):
+    """Create <root>/before and <root>/after and return the number of pairs of each kind."""
+    random = numpy.random.RandomState(seed)
+    counts = dict((kind, 0) for kind in KINDS)
+    for platform_index, (platform, infix, scale) in enumerate(PLATFORMS):
+        before_dir = os.path.join(root, "before", "%s-%d" % (platform, 1000 + platform_index))
+        after_dir = os.path.join(root, "after", "%s-%d" % (platform, 2000 + platform_index))
+        os.makedirs(before_dir)
+        os.makedirs(after_dir)
+        for kind in KINDS:
+            for i in range(pairs):
+                name = "bench_%02d_%s%s.png" % (i, infix, kind)
+                before_path = os.path.join(before_dir, "1_" + name)
+                after_path = os.path.join(after_dir, "2_" + name)
+                pixels = synthetic_screenshot(random, width * scale, height * scale)
+                if kind != "missing_before":
+                    save(pixels, before_path)
+                if kind == "identical":
+                    # Like the hard links into the sha512/ store made by fetch_screenshots.
+                    os.link(before_path, after_path)
+                elif kind == "copy":
+                    shutil.copyfile(before_path, after_path)
+                elif kind in ("few", "large"):
+                    changed = pixels.copy()
+                    if kind == "few":
+                        for _ in range(3):
+                            changed[random.randint(0, changed.shape[0]), random.randint(0, changed.shape[1])] ^= 0xff
+                    else:
+                        changed[changed.shape[0] // 4:changed.shape[0] // 2, :] ^= 0x80
+                    save(changed, after_path)
+                elif kind == "missing_before":
+                    save(pixels, after_path)
+                counts[kind] += 1
+    return counts
+
+
+def quietly(function, *args, **kwargs):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timings_since(start):
+    return dict((stage, round(seconds, 4)) for stage, seconds in compare_screenshots.stage_timings.items()), \
+        round(time.time() - start, 4)
+
+
+def benchmark_compare_images(root, options):
+    """Time compare_images alone for every pair which exists on both sides."""
+    outdir = os.path.join(root, "compare_images")
+    os.makedirs(outdir)
+    pairs = []
+    for before_platform in sorted(os.listdir(os.path.join(root, "before"))):
+        platform = before_platform.rsplit("-", 1)[0]
+        after_platform = [d for d in os.listdir(os.path.join(root, "after")) if d.startswith(platform)][0]
+        for name in sorted(os.listdir(os.path.join(root, "before", before_platform))):
+            after_path = os.path.join(root, "after", after_platform, "2_" + name[2:])
+            if os.path.isfile(after_path):
+                pairs.append((os.path.join(root, "before", before_platform, name), after_path))
+
+    compare_screenshots.stage_timings.clear()
+    start = time.time()
+    for before, after in pairs:
+        quietly(compare_screenshots.compare_images, before, after, outdir, outdir, options)
+    stages, seconds = timings_since(start)
+    return {
+        "pairs": len(pairs),
+        "seconds": seconds,
+        "pairs_per_second": round(len(pairs) / seconds, 2) if seconds else None,
+        "stages": stages,
+    }
+
+
+def benchmark_compare_dirs(root, options, pair_count):
+    outdir = os.path.join(root, "compare_dirs-%d" % options.jobs)
+    compare_screenshots.stage_timings.clear()
+    start = time.time()
+    quietly(compare_screenshots.compare_dirs, os.path.join(root, "before"), os.path.join(root, "after"),
+            outdir, options)
+    stages, seconds = timings_since(start)
+    return {
+        "jobs": options.jobs,
+        "pairs": pair_count,
+        "seconds": seconds,
+        "pairs_per_second": round(pair_count / seconds, 2) if seconds else None,
+        # Stages run in --jobs workers aren't included.
+        "stages": stages,
+    }
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark compare_screenshots on a synthetic corpus')
+    parser.add_argument("--pairs", type=int, default=5, help="Images of each kind per platform [Default=%(default)s]")
+    parser.add_argument("--width", type=int, default=1280, help="Width of non-HiDPI images [Default=%(default)s]")
+    parser.add_argument("--height", type=int, default=800, help="Height of non-HiDPI images [Default=%(default)s]")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1], help="--jobs values to benchmark compare_dirs with")
+    parser.add_argument("--tile-size", type=int, default=0, help="--tile-size to compare with")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="Keep the corpus and output directory")
+    parser.add_argument("-o", "--output", default=None, help="File to write the JSON report to instead of stdout")
+    args = parser.parse_args(args)
+
+    root = tempfile.mkdtemp(prefix="compare_benchmark-")
+    try:
+        start = time.time()
+        counts = build_corpus(root, args.pairs, args.width, args.height, args.seed)
+        report = {
+            "corpus": {
+                "kinds": counts,
+                "platforms": [platform for platform, infix, scale in PLATFORMS],
+                "width": args.width,
+                "height": args.height,
+                "seconds": round(time.time() - start, 4),
+            },
+            "numpy_and_pillow": compare_screenshots.image_diff.available(),
+            "tile_size": args.tile_size,
+        }
+        options = argparse.Namespace(dppx=1.0, overwrite=True, output_similar_composite=False,
+                                     defer_composites=False, cache_dir=None,
+                                     tile_size=args.tile_size, jobs=1)
+        report["compare_images"] = benchmark_compare_images(root, options)
+        report["compare_dirs"] = []
+        pair_count = sum(count for kind, count in counts.items() if not kind.startswith("missing"))
+        for jobs in args.jobs:
+            options.jobs = jobs
+            report["compare_dirs"].append(benchmark_compare_dirs(root, options, pair_count))
+    finally:
+        if args.keep:
+            print("Corpus and output kept in", root, file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Local stand-in for the Treeherder and Taskcluster endpoints used by fetch_screenshots.
+
+Serves a synthetic day of pushes, each with a screenshot job per platform, with
+configurable sizes, latency and error rate. Point fetch_screenshots at it with
+the environment variables printed on startup, e.g.:
+
+    python benchmarks/fake_services.py --port 8000 --pushes 20 --latency 50 --error-rate 0.01
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PLATFORMS = ["linux64", "linux32", "windows7-32", "windows10-64", "osx-10-10", "osx-10-7", "android-4-3"]
+JOB_TYPE_SYMBOL = "ss"
+JOB_GROUP_SYMBOL = "M"
+
+
+class Fixture(object):
+    """Pushes of one day with a successful screenshot job for each platform.
+
+    Each image changes between consecutive pushes with probability `change_rate`
+    so that most downloads are duplicates, as in production.
+    """
+
+    def __init__(self, date, project="mozilla-central", pushes=20, platforms=4, images=30, image_size=100 * 1024,
+                 change_rate=0.05, nightlies=2, seed=0):
+        self.project = project
+        self.platforms = PLATFORMS[:platforms]
+        self.images = images
+        self.image_size = image_size
+        self.change_rate = change_rate
+        self.seed = seed
+        self.contents = {}
+        self.lock = threading.Lock()
+
+        # Local midnight like fetch_screenshots.resultsets_for_date
+        day_start = int(datetime.strptime(date, "%Y-%m-%d").strftime("%s"))
+        self.pushes = []
+        self.tasks = {}
+        for i in range(pushes):
+            push_id = i + 1
+            push = {
+                "id": push_id,
+                "revision": hashlib.sha1(("%d-%d" % (seed, push_id)).encode("ascii")).hexdigest(),
+                "author": "fake@example.com",
+                "push_timestamp": day_start + i * (24 * 60 * 60 // pushes) + 1,
+                "repository_id": 1,
+                "revision_count": 1,
+            }
+            push["revisions"] = [{"revision": push["revision"], "author": push["author"], "comments": "Bug %d" % push_id}]
+            self.pushes.append(push)
+            for platform_index in range(len(self.platforms)):
+                job_id = push_id * 100 + platform_index
+                task_uuid = uuid.UUID(int=job_id)
+                # Like slugid.encode()
+                slug = base64.urlsafe_b64encode(task_uuid.bytes)[:-2].decode("ascii")
+                self.tasks[slug] = (push_id, platform_index)
+        self.nightly_revisions = [push["revision"] for push in self.pushes[::max(1, pushes // max(1, nightlies))]][:nightlies]
+
+    def job(self, push_id, platform_index):
+        job_id = push_id * 100 + platform_index
+        return {
+            "id": job_id,
+            "push_id": push_id,
+            "result_set_id": push_id,
+            "job_guid": "%s/0" % uuid.UUID(int=job_id),
+            "platform": self.platforms[platform_index],
+            "result": "success",
+            "state": "completed",
+            "job_type_name": "test-%s/opt-browser-screenshots-e10s" % self.platforms[platform_index],
+            "job_type_symbol": JOB_TYPE_SYMBOL,
+            "job_group_symbol": JOB_GROUP_SYMBOL,
+            "task_id": base64.urlsafe_b64encode(uuid.UUID(int=job_id).bytes)[:-2].decode("ascii"),
+            "retry_id": 0,
+        }
+
+    def jobs(self, push_ids):
+        return [self.job(push_id, platform_index)
+                for push_id in push_ids for platform_index in range(len(self.platforms))]
+
+    def image_name(self, image_index):
+        return "public/test_info/browserScreenshots_%03d_fake.png" % image_index
+
+    def _changed(self, push_id, platform_index, image_index):
+        digest = hashlib.sha1(("%d-%d-%d-%d" % (self.seed, push_id, platform_index, image_index)).encode("ascii"))
+        return int(digest.hexdigest()[:8], 16) / float(0xffffffff) < self.change_rate
+
+    def image(self, push_id, platform_index, image_index):
+        """Return the content of an image, the same as on the previous push unless it changed."""
+        version = push_id
+        while version > 1 and not self._changed(version, platform_index, image_index):
+            version -= 1
+        key = (platform_index, image_index, version)
+        with self.lock:
+            if key not in self.contents:
+                block = hashlib.sha512(("%d-%r" % (self.seed, key)).encode("ascii")).digest()
+                body_size = max(0, self.image_size - len(PNG_SIGNATURE))
+                self.contents[key] = PNG_SIGNATURE + (block * (body_size // len(block) + 1))[:body_size]
+            return self.contents[key]
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = [
+        ("GET", re.compile(r'^/api/project/(?P<project>[^/]+)/push/(?P<push_id>\d+)/$'), "push"),
+        ("GET", re.compile(r'^/api/project/(?P<project>[^/]+)/push/$'), "push_list"),
+        ("GET", re.compile(r'^/api/project/(?P<project>[^/]+)/jobs/$'), "jobs"),
+        ("GET", re.compile(r'^/queue/v1/task/(?P<task>[^/]+)/runs/(?P<run>\d+)/artifacts$'), "artifacts"),
+        ("GET", re.compile(r'^/queue/v1/task/(?P<task>[^/]+)/runs/(?P<run>\d+)/artifacts/(?P<name>.+\.png)$'), "artifact"),
+        ("POST", re.compile(r'^/index/v1/namespaces/gecko\.v2\.(?P<project>[^.]+)\.nightly\.'
+                            r'(?P<date>\d{4}\.\d{2}\.\d{2})\.revision$'), "namespaces"),
+    ]
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self.route("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+    def route(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        if server.latency:
+            time.sleep(server.random.uniform(0.5, 1.5) * server.latency)
+        with server.lock:
+            error = server.random.random() < server.error_rate
+        if error:
+            return self.respond(503, b'{"detail": "Service unavailable"}', "application/json")
+
+        for route_method, pattern, handler_name in self.ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                try:
+                    result = getattr(self, handler_name)(query, **match.groupdict())
+                except (KeyError, ValueError):
+                    result = None
+                if result is None:
+                    return self.respond(404, b'{"detail": "Not found"}', "application/json")
+                if isinstance(result, bytes):
+                    return self.respond(200, result, "image/png")
+                return self.respond(200, json.dumps(result).encode("utf-8"), "application/json")
+        return self.respond(404, b'{"detail": "Not found"}', "application/json")
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            stats = self.server.stats
+            stats["requests"] += 1
+            stats["bytes"] += len(body)
+            if status != 200:
+                stats["errors"] += 1
+
+    def push(self, query, project, push_id):
+        pushes = [push for push in self.server.fixture.pushes if push["id"] == int(push_id)]
+        return pushes[0] if pushes else None
+
+    def push_list(self, query, project):
+        pushes = self.server.fixture.pushes
+        if "revision" in query:
+            pushes = [push for push in pushes if push["revision"] == query["revision"]]
+        if "push_timestamp__gte" in query:
+            pushes = [push for push in pushes if push["push_timestamp"] >= int(query["push_timestamp__gte"])]
+        if "push_timestamp__lt" in query:
+            pushes = [push for push in pushes if push["push_timestamp"] < int(query["push_timestamp__lt"])]
+        if "id__lt" in query:
+            pushes = [push for push in pushes if push["id"] < int(query["id__lt"])]
+        pushes = sorted(pushes, key=lambda push: push["id"], reverse=True)[:int(query.get("count", 10))]
+        return {"meta": {"count": len(pushes), "repository": project}, "results": pushes}
+
+    def jobs(self, query, project):
+        if "push_id__in" in query:
+            push_ids = [int(push_id) for push_id in query["push_id__in"].split(",")]
+        else:
+            push_ids = [int(query["result_set_id"])]
+        jobs = [job for job in self.server.fixture.jobs(push_ids)
+                if job["job_type_symbol"] == query.get("job_type_symbol", JOB_TYPE_SYMBOL)]
+        offset = int(query.get("offset", 0))
+        count = int(query.get("count", 2000))
+        return {"meta": {"offset": offset, "count": count, "repository": project},
+                "results": jobs[offset:offset + count]}
+
+    def artifacts(self, query, task, run):
+        fixture = self.server.fixture
+        if task not in fixture.tasks:
+            return None
+        artifacts = [{"storageType": "s3", "name": fixture.image_name(image_index), "contentType": "image/png"}
+                     for image_index in range(fixture.images)]
+        artifacts.append({"storageType": "s3", "name": "public/logs/live_backing.log", "contentType": "text/plain"})
+        return {"artifacts": artifacts}
+
+    def artifact(self, query, task, run, name):
+        fixture = self.server.fixture
+        push_id, platform_index = fixture.tasks[task]
+        image_index = int(re.search(r'_(\d+)_fake\.png$', name).group(1))
+        return fixture.image(push_id, platform_index, image_index)
+
+    def namespaces(self, query, project, date):
+        return {"namespaces": [{"namespace": "gecko.v2.%s.nightly.%s.revision.%s" % (project, date, revision),
+                                "name": revision, "expires": "2099-01-01T00:00:00.000Z"}
+                               for revision in self.server.fixture.nightly_revisions]}
+
+
+class FakeServices(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixture, port=0, latency=0, error_rate=0, seed=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeServicesHandler)
+        self.fixture = fixture
+        # Seconds
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "errors": 0}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def environment(self):
+        """Return the environment variables pointing fetch_screenshots at this server."""
+        return {
+            "MOZSCREENSHOTS_TH_API": self.url + "/api",
+            "MOZSCREENSHOTS_TC_QUEUE_API": self.url + "/queue/v1",
+            "MOZSCREENSHOTS_TC_INDEX_API": self.url + "/index/v1",
+        }
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def take_stats(self):
+        """Return the statistics since the last call and reset them."""
+        with self.lock:
+            stats = self.stats
+            self.stats = {"requests": 0, "bytes": 0, "errors": 0}
+        return stats
+
+
+def add_fixture_arguments(parser):
+    parser.add_argument("--date", default="2017-01-17", metavar="YYYY-MM-DD", help="Date of the pushes [Default=%(default)s]")
+    parser.add_argument("--project", default="mozilla-central", help="[Default=%(default)s]")
+    parser.add_argument("--pushes", type=int, default=20, help="Pushes on the date [Default=%(default)s]")
+    parser.add_argument("--platforms", type=int, default=4, choices=range(1, len(PLATFORMS) + 1),
+                        help="Platforms with a screenshot job per push [Default=%(default)s]")
+    parser.add_argument("--images", type=int, default=30, help="Images per job [Default=%(default)s]")
+    parser.add_argument("--image-size", type=int, default=100, metavar="KB", help="Size of each image [Default=%(default)s]")
+    parser.add_argument("--change-rate", type=float, default=0.05,
+                        help="Probability of an image changing from one push to the next [Default=%(default)s]")
+    parser.add_argument("--nightlies", type=int, default=2, help="Nightly revisions on the date [Default=%(default)s]")
+    parser.add_argument("--latency", type=float, default=0, metavar="MS",
+                        help="Mean latency of each response (uniformly +/-50%%) [Default=%(default)s]")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of requests failing with 503 [Default=%(default)s]")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def services_from_arguments(args, port=0):
+    fixture = Fixture(args.date, args.project, args.pushes, args.platforms, args.images, args.image_size * 1024,
+                      args.change_rate, args.nightlies, args.seed)
+    return FakeServices(fixture, port, args.latency / 1000.0, args.error_rate, args.seed)
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Serve fake Treeherder and Taskcluster APIs for fetch_screenshots')
+    parser.add_argument("--port", type=int, default=8000, help="[Default=%(default)s]")
+    add_fixture_arguments(parser)
+    args = parser.parse_args(args)
+
+    services = services_from_arguments(args, args.port)
+    for name, value in sorted(services.environment().items()):
+        print("export {0}={1}".format(name, value))
+    print("# e.g. fetch_screenshots --project {0} --date {1} or -r {2}".format(
+        args.project, args.date, services.fixture.pushes[0]["revision"]))
+    try:
+        services.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark fetch_screenshots against the local stand-in of benchmarks/fake_services.py.
+
+Each mode (--rev, --date and --nightly) is fetched by a separate
+fetch_screenshots process into an empty directory without the metadata cache.
+The request rate and throughput seen by the server and the peak memory of the
+process are output as JSON, e.g.:
+
+    python benchmarks/fetch_benchmark.py --pushes 10 --latency 50 --error-rate 0.01 --output fetch_bench.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_services
+
+MOZSCREENSHOTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mozscreenshots")
+FETCH_COMMAND = "import sys; sys.path.insert(0, %r); import fetch_screenshots; fetch_screenshots.cli()"
+MODES = ["rev", "date", "nightly"]
+
+
+def count_images(directory):
+    return sum(len([filename for filename in files if filename.endswith(".png")])
+               for dirpath, dirs, files in os.walk(directory) if os.path.basename(dirpath) != "sha512")
+
+
+def benchmark_mode(services, mode, args):
+    fixture = services.fixture
+    mode_args = {
+        "rev": ["--rev", fixture.pushes[-1]["revision"]],
+        "date": ["--date", args.date],
+        "nightly": ["--nightly", args.date],
+    }[mode]
+    command = [args.python, "-c", FETCH_COMMAND % os.path.abspath(MOZSCREENSHOTS_DIR),
+               "--project", args.project, "--concurrency", str(args.concurrency), "--no-metadata-cache"] + mode_args
+    env = dict(os.environ)
+    env.update(services.environment())
+
+    workdir = tempfile.mkdtemp(prefix="fetch_benchmark-")
+    try:
+        services.take_stats()
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(command, cwd=workdir, env=env, stdout=devnull,
+                                       stderr=None if args.verbose else devnull)
+            # wait4 gives the resource usage of this process alone.
+            pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+        stats = services.take_stats()
+        images = count_images(workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        "mode": mode,
+        "exit_status": os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status),
+        "seconds": round(seconds, 3),
+        "requests": stats["requests"],
+        "errors_injected": stats["errors"],
+        "requests_per_second": round(stats["requests"] / seconds, 1),
+        "megabytes": round(stats["bytes"] / 1048576.0, 2),
+        "megabytes_per_second": round(stats["bytes"] / 1048576.0 / seconds, 2),
+        "images": images,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        "peak_memory_mb": round(usage.ru_maxrss / (1048576.0 if sys.platform == "darwin" else 1024.0), 1),
+    }
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Benchmark fetch_screenshots against fake Treeherder and Taskcluster APIs')
+    fake_services.add_fixture_arguments(parser)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES, help="fetch_screenshots modes to benchmark")
+    parser.add_argument("--concurrency", type=int, default=10, help="--concurrency of fetch_screenshots [Default=%(default)s]")
+    parser.add_argument("--python", default=sys.executable, help="Python interpreter to run fetch_screenshots with")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the stderr of fetch_screenshots")
+    parser.add_argument("-o", "--output", default=None, help="File to write the JSON report to instead of stdout")
+    args = parser.parse_args(args)
+
+    services = fake_services.services_from_arguments(args).start()
+    report = {
+        "fixture": {
+            "pushes": args.pushes,
+            "platforms": args.platforms,
+            "images": args.images,
+            "image_size_kb": args.image_size,
+            "change_rate": args.change_rate,
+            "nightlies": args.nightlies,
+            "latency_ms": args.latency,
+            "error_rate": args.error_rate,
+        },
+        "concurrency": args.concurrency,
+        "runs": [benchmark_mode(services, mode, args) for mode in args.modes],
+    }
+    services.shutdown()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    cli()
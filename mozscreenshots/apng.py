@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Minimal animated PNG writer for frames already decoded by image_diff.
+
+Frames are RGBA numpy arrays. Frames smaller than the largest one are padded
+with transparent pixels on the right and bottom so that frames of different
+dimensions can still be animated.
+"""
+
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+COMPRESSION_LEVEL = 6
+
+# fcTL dispose_op and blend_op
+APNG_DISPOSE_OP_NONE = 0
+APNG_BLEND_OP_SOURCE = 0
+
+
+def chunk(chunk_type, data):
+    return (struct.pack(">I", len(data)) + chunk_type + data +
+            struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def pad(frame, height, width):
+    if frame.shape[:2] == (height, width):
+        return frame
+    padded = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    padded[:frame.shape[0], :frame.shape[1]] = frame
+    return padded
+
+
+def compress(frame):
+    """Return the zlib stream of `frame` using the Sub filter for every scanline."""
+    height, width = frame.shape[:2]
+    rows = numpy.ascontiguousarray(frame).reshape(height, width * 4)
+    scanlines = numpy.empty((height, width * 4 + 1), dtype=numpy.uint8)
+    scanlines[:, 0] = 1
+    scanlines[:, 1:5] = rows[:, :4]
+    # uint8 arithmetic wraps modulo 256 as the filter requires.
+    numpy.subtract(rows[:, 4:], rows[:, :-4], out=scanlines[:, 5:])
+    return zlib.compress(scanlines.tobytes(), COMPRESSION_LEVEL)
+
+
+def write_apng(path, frames, delay_ms):
+    """Write `frames` to `path` as an infinitely looping animation showing each for `delay_ms`."""
+    height = max(frame.shape[0] for frame in frames)
+    width = max(frame.shape[1] for frame in frames)
+
+    chunks = [
+        chunk(b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        chunk(b'acTL', struct.pack(">II", len(frames), 0)),
+    ]
+    sequence = 0
+    for index, frame in enumerate(frames):
+        chunks.append(chunk(b'fcTL', struct.pack(">IIIIIHHBB", sequence, width, height, 0, 0,
+                                                 delay_ms, 1000,
+                                                 APNG_DISPOSE_OP_NONE, APNG_BLEND_OP_SOURCE)))
+        sequence += 1
+        data = compress(pad(frame, height, width))
+        if index == 0:
+            # The first frame is also the default image for decoders without APNG support.
+            chunks.append(chunk(b'IDAT', data))
+        else:
+            chunks.append(chunk(b'fdAT', struct.pack(">I", sequence) + data))
+            sequence += 1
+    chunks.append(chunk(b'IEND', b''))
+
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        for data in chunks:
+            f.write(data)
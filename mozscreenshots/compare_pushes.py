@@ -2,41 +2,51 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import argparse
+import concurrent.futures as cf
 import datetime
 import json
+import multiprocessing
 import os
-import re
 import sys
+import tempfile
 import time
 from collections import namedtuple
+from itertools import izip
 from pytz import timezone
 
 import compare_screenshots
-from compare_screenshots import ComparisonResult, comparisonResultNames
-from fetch_screenshots import resultsets_for_date
+from comparison_common import ComparisonResult, comparisonResultNames, pair_subdirs
+from fetch_screenshots import METADATA_CACHE_PATH, resultsets_for_range, use_metadata_cache
+from known_inconsistencies import KNOWN_INCONSISTENCIES_PATH, KnownInconsistencies
+from outbox import Outbox
 
-archive = os.getcwd()
 RECENT_DATA_PATH = os.path.join(os.path.dirname(__file__), "..", "web", "recent_data.json")
+STATE_FILENAME = "compare_pushes_state.json"
+OUTBOX_DIRNAME = "outbox"
+RESULTS_INDEX_FILENAME = "results.sqlite"
+EMAIL_HOSTNAME = "screenshots.mattn.ca"
 VIEW_URL_FORMAT = "https://screenshots.mattn.ca/compare/?oldProject=%s&oldRev=%s"
 compare_url_format = "https://screenshots.mattn.ca/compare/?oldProject=%s&oldRev=%s&newProject=%s&newRev=%s"
-project = "mozilla-central"
-END_DAY = datetime.date.today()
-numdays = 7
+DEFAULT_PROJECT = "mozilla-central"
+# Days of pushes to look at when there is no state yet
+DEFAULT_NUMDAYS = 7
 # Wait a minimum number of hours to reduce sending partial emails for
 # in-progress pushes (e.g. linux one email and win in another).
 MIN_TIME_SINCE_PUSH = datetime.timedelta(hours=3)
+# Number of reported pairs to remember for each project
+MAX_REPORTED_PAIRS = 1000
 timezone = timezone('US/Pacific')
 
-resultsets = []
-resultset_ids = set()
-recent_data = {}
+CompareDirOptions = namedtuple('CompareDirOptions',
+                               'dppx overwrite include_completed cache_dir results_index defer_composites')
 
 
-def email_results(project, oldResultset, newResultset, comparison, known_inconsistencies):
+def email_results(project, oldResultset, newResultset, comparison, known_inconsistencies, outbox):
+    """Queue an email of the differences between two pushes, if any, and return whether there were any."""
     import bleach
     import email
     import re
-    import smtplib
 
     from email.mime.multipart import MIMEMultipart
     from email.mime.text import MIMEText
@@ -89,19 +99,16 @@ def email_results(project, oldResultset, newResultset, comparison, known_inconsi
             body += "\n"
         body += "\n\n"
 
-    recent_data['last_compared_central_old'] = oldRev
-    recent_data['last_compared_central_new'] = newRev
-
     if not difference_found:
         print "\nNo differences found\n\n"
-        return
+        return False
 
     print "====\n"
     print body
 
     msg = MIMEMultipart('alternative')
-    #msg['Date'] = email.utils.formatdate(float(newResultset['push_timestamp']))
-    msg['Message-ID'] = re.sub("@[^>]+>", "@screenshots.mattn.ca>", email.utils.make_msgid())
+    # The outbox adds the Date and threading headers.
+    msg['Message-ID'] = re.sub("@[^>]+>", "@" + EMAIL_HOSTNAME + ">", email.utils.make_msgid())
     msg['Subject'] = '{} Screenshot Changes: {} to {}'.format(project, oldRev[:12], newRev[:12])
     msg['From'] = 'Screenshot Changes <screenshot-changes@screenshots.mattn.ca>'
     msg['To'] = 'dev-ui-alerts@lists.mozilla.org'
@@ -109,43 +116,80 @@ def email_results(project, oldResultset, newResultset, comparison, known_inconsi
     msg.attach(MIMEText(body, 'plain'))
     msg.attach(MIMEText('<pre>\n' + bleach.linkify(body) + '</pre>', 'html'))
 
-    s = smtplib.SMTP('localhost', None, 'screenshots.mattn.ca')
-    s.sendmail(msg['From'], [msg['To']], msg.as_string())
-    s.quit()
-    # Delay before the next email so they get received in the correct order
-    time.sleep(20)
+    outbox.enqueue(project, msg, [msg['To']])
+    return True
 
 
 def matches_inconsistency(inconsistencies, platform, basename, result):
-    for known in inconsistencies:
-        if not known['platformRegex'].search(platform):
-            continue
-
-        if not known['pixelRegex'].search(str(result['difference'])):
-            continue
-
-        if not any(pattern.search(basename) for pattern in known['nameRegexes']):
-            continue
-        return True
-
-    return False
-
-
-# Load the known inconsistencies file
-known_inconsistencies_path = os.path.join(os.path.dirname(__file__), "..", "web", "known_inconsistencies.json")
-with open(known_inconsistencies_path, 'r') as ki_file:
-    known_inconsistencies = json.load(ki_file)
-    print "Known inconsistencies:", known_inconsistencies
-    for known in known_inconsistencies:
-        known['platformRegex'] = re.compile(known['platformRegex'])
-        known['pixelRegex'] = re.compile(known['pixelRegex'])
-        known['nameRegexes'] = map(lambda pattern: re.compile(pattern), known['nameRegexes'])
-
-for offset in range(0, numdays):
-    d = END_DAY - datetime.timedelta(days=offset)
-    print d.isoformat()
-    date_resultsets = resultsets_for_date(project, d.isoformat())
-    for r in date_resultsets:
+    return inconsistencies.match(platform, basename, result['difference']) is not None
+
+
+def load_known_inconsistencies(path=KNOWN_INCONSISTENCIES_PATH):
+    with open(path, 'r') as ki_file:
+        known_inconsistencies = KnownInconsistencies(json.load(ki_file))
+    print "Known inconsistencies:", len(known_inconsistencies), "rules"
+    return known_inconsistencies
+
+
+class State(object):
+    """What was already processed for each project, persisted as JSON in the archive.
+
+    `last_push` is the newest push compared with its predecessor so that it's the
+    base of the next comparison and `reported` has the "<old rev>..<new rev>"
+    pairs whose results were already reported so they're never emailed twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as state_file:
+                self.data = json.load(state_file)
+        except (IOError, ValueError):
+            self.data = {}
+
+    def project(self, project):
+        return self.data.setdefault(project, {"last_push": None, "reported": []})
+
+    def last_push(self, project):
+        return self.project(project)["last_push"]
+
+    def is_reported(self, project, oldRev, newRev):
+        return "{}..{}".format(oldRev, newRev) in self.project(project)["reported"]
+
+    def push_reported(self, project, oldResultset, newResultset):
+        project_state = self.project(project)
+        pair = "{}..{}".format(oldResultset['revision'], newResultset['revision'])
+        if pair not in project_state["reported"]:
+            project_state["reported"] = (project_state["reported"] + [pair])[-MAX_REPORTED_PAIRS:]
+        project_state["last_push"] = dict((key, newResultset[key]) for key in ('id', 'revision', 'push_timestamp'))
+        self.save()
+
+    def save(self):
+        # Write to a temporary file and rename so a crash never leaves partial state.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        with os.fdopen(fd, 'w') as state_file:
+            json.dump(self.data, state_file, indent=2, separators=(',', ': '), sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def discover_pushes(project, last_push=None, numdays=DEFAULT_NUMDAYS):
+    """Return the pushes to compare sorted by push timestamp.
+
+    With a `last_push` (from State) only it and the pushes after it are fetched,
+    otherwise the last `numdays` days of pushes are. Pushes more recent than
+    MIN_TIME_SINCE_PUSH are left for later.
+    """
+    if last_push:
+        start_time = last_push['push_timestamp']
+    else:
+        start_day = datetime.date.today() - datetime.timedelta(days=numdays - 1)
+        start_time = datetime.datetime.combine(start_day, datetime.time()).strftime("%s")
+    end_time = int(time.time()) + 1
+    print "Discovering pushes since", start_time
+
+    resultsets = []
+    resultset_ids = set()
+    for r in resultsets_for_range(project, start_time, end_time):
         if r['id'] in resultset_ids:
             continue
         if datetime.datetime.fromtimestamp(r['push_timestamp'], timezone) > datetime.datetime.now(timezone) - MIN_TIME_SINCE_PUSH:
@@ -156,18 +200,34 @@ for offset in range(0, numdays):
 
     print resultset_ids, len(resultset_ids), len(resultsets)
 
-# Sort by push timestamp since a nightly could be triggered on an older revision
-# later (e.g. if the newer revision is busted).
-sorted_resultsets = sorted(resultsets, key=lambda resultset: resultset['push_timestamp'])
+    # Sort by push timestamp since a nightly could be triggered on an older revision
+    # later (e.g. if the newer revision is busted).
+    return sorted(resultsets, key=lambda resultset: (resultset['push_timestamp'], resultset['id']))
+
+
+def comparison_completed(archive, project, oldRev, newRev):
+    """Return whether both revisions were fetched and every platform they have in common was compared."""
+    rev_dirs = [os.path.join(archive, project, rev) for rev in (oldRev, newRev)]
+    if not all(os.path.isdir(rev_dir) for rev_dir in rev_dirs):
+        return False
+    old_dirs, new_dirs = [[name for name in os.listdir(rev_dir) if os.path.isdir(os.path.join(rev_dir, name))]
+                          for rev_dir in rev_dirs]
+    if not (old_dirs and new_dirs):
+        return False
+    outdir = os.path.join(archive, "comparisons", project, oldRev, project, newRev)
+    return all(os.path.isfile(os.path.join(outdir, dir_prefix, "comparison.json"))
+               for dir_prefix, old_dir, new_dir in pair_subdirs(old_dirs, new_dirs) if new_dir)
 
-print
-for i, resultset in enumerate(sorted_resultsets):
-    if i == 0:
-        continue
-    oldResultset = sorted_resultsets[i - 1]
+
+def compare_push_pair(archive, project, oldResultset, newResultset, options):
+    """Compare the fetched screenshots of two pushes and return the comparison like compare_dirs.
+
+    Returns None if the pair couldn't be compared completely e.g. since a push
+    isn't fetched yet or another process holds the lock of a platform.
+    """
     oldRev = oldResultset['revision']
-    newRev = resultset['revision']
-    print i, resultset['id'], resultset['push_timestamp'], datetime.datetime.fromtimestamp(resultset['push_timestamp'], timezone), resultset['revision']
+    newRev = newResultset['revision']
+    print newResultset['id'], newResultset['push_timestamp'], datetime.datetime.fromtimestamp(newResultset['push_timestamp'], timezone), newRev
     print compare_url_format % (project, oldRev, project, newRev)
 
     outdir = os.path.join(archive, "comparisons", project, oldRev, project, newRev)
@@ -178,18 +238,118 @@ for i, resultset in enumerate(sorted_resultsets):
             print('Error creating directory: %s' % outdir)
             sys.exit(1)
 
-    CompareDirOptions = namedtuple('CompareDirOptions', 'dppx overwrite include_completed')
-    options = CompareDirOptions(dppx=1.0, overwrite=False, include_completed=False)
-
     comparison = compare_screenshots.compare_dirs(os.path.join(archive, project, oldRev),
                                                   os.path.join(archive, project, newRev),
                                                   outdir, options)
-    lastRev = newRev
-
-    email_results(project, oldResultset, resultset, comparison, known_inconsistencies)
-
-
-# Write to a file so the default web view can link to these as examples.
-if 'last_compared_central_old' in recent_data and 'last_compared_central_new' in recent_data:
-    with open(RECENT_DATA_PATH, 'w') as outfile:
-        json.dump(recent_data, outfile)
+    if not comparison_completed(archive, project, oldRev, newRev):
+        return None
+    return comparison
+
+
+def run(archive, project=DEFAULT_PROJECT, state_path=None, numdays=DEFAULT_NUMDAYS, send_email=True,
+        known_inconsistencies=None, workers=1, outbox=None):
+    """Compare and report each push newer than the last one processed with its predecessor.
+
+    Pairs are compared by `workers` processes but reported in push order as soon
+    as all the pairs before them are. The state only advances past completely
+    compared pairs so the first incomplete one, and those after it, are compared
+    again by the next run. Emails are queued in `outbox` (by default
+    ARCHIVE/outbox) and delivered together at the end, along with any left from
+    previous runs. `known_inconsistencies` is a KnownInconsistencies or a list of
+    rules and defaults to web/known_inconsistencies.json. Returns the number of
+    pairs compared.
+    """
+    state = State(state_path or os.path.join(archive, STATE_FILENAME))
+    if send_email and outbox is None:
+        outbox = Outbox(os.path.join(archive, OUTBOX_DIRNAME), local_hostname=EMAIL_HOSTNAME)
+    if known_inconsistencies is None:
+        known_inconsistencies = load_known_inconsistencies()
+    elif not isinstance(known_inconsistencies, KnownInconsistencies):
+        known_inconsistencies = KnownInconsistencies(known_inconsistencies)
+    options = CompareDirOptions(dppx=1.0, overwrite=False, include_completed=False,
+                                cache_dir=os.path.join(archive, "comparison_cache"),
+                                results_index=os.path.join(archive, RESULTS_INDEX_FILENAME),
+                                # Built by comparison_service when the web page requests them
+                                defer_composites=True)
+
+    last_push = state.last_push(project)
+    sorted_resultsets = discover_pushes(project, last_push, numdays)
+    if last_push and not any(resultset['id'] == last_push['id'] for resultset in sorted_resultsets):
+        # Still compare the first new push against the last processed one.
+        sorted_resultsets.insert(0, last_push)
+
+    pairs = zip(sorted_resultsets, sorted_resultsets[1:])
+    if workers <= 1:
+        comparisons = (compare_push_pair(archive, project, oldResultset, resultset, options)
+                       for oldResultset, resultset in pairs)
+    else:
+        executor = cf.ProcessPoolExecutor(max_workers=workers)
+        futures = [executor.submit(compare_push_pair, archive, project, oldResultset, resultset, options)
+                   for oldResultset, resultset in pairs]
+        comparisons = (future.result() for future in futures)
+
+    recent_data = {}
+    compared = 0
+    print
+    try:
+        # izip so that serial comparisons stop at the first incomplete pair too.
+        for (oldResultset, resultset), comparison in izip(pairs, comparisons):
+            if comparison is None:
+                print "Stopping at the incomplete comparison of {} and {}, it's retried by the next run".format(
+                    oldResultset['revision'], resultset['revision'])
+                break
+            compared += 1
+            if not state.is_reported(project, oldResultset['revision'], resultset['revision']):
+                if send_email:
+                    email_results(project, oldResultset, resultset, comparison, known_inconsistencies, outbox)
+            recent_data['last_compared_central_old'] = oldResultset['revision']
+            recent_data['last_compared_central_new'] = resultset['revision']
+            state.push_reported(project, oldResultset, resultset)
+    finally:
+        if workers > 1:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+    # Write to a file so the default web view can link to these as examples.
+    if 'last_compared_central_old' in recent_data and 'last_compared_central_new' in recent_data:
+        with open(RECENT_DATA_PATH, 'w') as outfile:
+            json.dump(recent_data, outfile)
+
+    if send_email:
+        sent = outbox.deliver()
+        print "Sent", sent, "emails,", len(outbox.pending()), "left in the outbox"
+    return compared
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Compare each new push with the previous one and email the differences')
+    parser.add_argument("--project", default=DEFAULT_PROJECT, help="[Default=%(default)s]")
+    parser.add_argument("--archive", default=os.getcwd(),
+                        help="Directory with the screenshots fetched by fetch_screenshots [Default=current directory]")
+    parser.add_argument("--state", default=None, metavar="PATH",
+                        help="File recording what was already processed [Default=ARCHIVE/%s]" % STATE_FILENAME)
+    parser.add_argument("--days", type=int, default=DEFAULT_NUMDAYS,
+                        help="Days of pushes to compare when there is no state yet [Default=%(default)s]")
+    parser.add_argument("--no-email", dest="send_email", action="store_false", help="Only compare the pushes")
+    parser.add_argument("--outbox", default=None, metavar="DIR",
+                        help="Directory of emails waiting to be delivered [Default=ARCHIVE/%s]" % OUTBOX_DIRNAME)
+    parser.add_argument("--smtp-host", default="localhost", help="[Default=%(default)s]")
+    parser.add_argument("--known-inconsistencies", default=KNOWN_INCONSISTENCIES_PATH, metavar="PATH",
+                        help="Rules for the differences to leave out of emails [Default=web/known_inconsistencies.json]")
+    parser.add_argument("-j", "--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of pairs of pushes to compare in parallel [Default=number of CPUs]")
+    args = parser.parse_args(args)
+
+    archive = os.path.abspath(args.archive)
+    use_metadata_cache(os.path.join(archive, METADATA_CACHE_PATH))
+    outbox = None
+    if args.send_email:
+        outbox = Outbox(args.outbox or os.path.join(archive, OUTBOX_DIRNAME), args.smtp_host, EMAIL_HOSTNAME)
+    count = run(archive, args.project, args.state, args.days, args.send_email,
+                load_known_inconsistencies(args.known_inconsistencies), args.workers, outbox)
+    print "Compared", count, "pairs of pushes"
+
+
+if __name__ == "__main__":
+    cli()
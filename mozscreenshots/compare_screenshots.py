@@ -5,54 +5,283 @@
 from __future__ import print_function
 
 import argparse
+import concurrent.futures as cf
 import fcntl
-import glob
 import json
 import os
 import re
+import shutil
+import sqlite3
 import subprocess
 import sys
 import tempfile
-from collections import defaultdict, namedtuple
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import apng
+import comparison_cache
+from comparison_common import ComparisonResult, comparisonResultNames, index_dir, pair_subdirs, remove_prefix
+import image_diff
+import known_inconsistencies
+import results_index
+
+FUZZ_PERCENT = 3
+COMPOSITES_JSON_FILENAME = "composites.json"
+APNG_DELAY_MS = 400
+
+# Seconds spent in each stage of comparisons run by this process (i.e. not
+# including --jobs workers), for benchmarking.
+stage_timings = defaultdict(float)
+
+
+@contextmanager
+def timed(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        stage_timings[stage] += time.time() - start
 
-comparisonResultNames = ["SIMILAR", "DIFFERENT", "ERROR", "MISSING_BEFORE", "MISSING_AFTER"]
-ComparisonResult = namedtuple("ComparisonResult", comparisonResultNames)._make(range(0, len(comparisonResultNames)))
 
+def composite_name(before, after):
+    before_name_unprefixed = remove_prefix(os.path.basename(before))
+    after_name_unprefixed = remove_prefix(os.path.basename(after))
 
-def remove_prefix(filename):
-    return re.sub(r'^((before|after)_)?[^-_]*[-_]', '', filename)
+    # Use the shorter of the two names so the name is the common subset
+    if len(after_name_unprefixed) > len(before_name_unprefixed):
+        return before_name_unprefixed
+    return after_name_unprefixed
 
 
-def get_suffixes(path):
-    return [remove_prefix(filename)
-             for filename in os.listdir(path) if filename.endswith(".png")]
+def compare_pair(before, after, outdir, similar_dir, args):
+    """compare_images but short-circuiting identical files and using the comparison cache."""
+    output_similar_composite = getattr(args, "output_similar_composite", False)
+    before_chop = system_ui_chop(before, getattr(args, "dppx", 1.0))
+    after_chop = system_ui_chop(after, getattr(args, "dppx", 1.0))
+    if before_chop == after_chop and not output_similar_composite:
+        if comparison_cache.same_file(before, after):
+            return (ComparisonResult.SIMILAR, "0", None, None)
+
+    # Byte-identical copies with different inodes, e.g. outside the sha512 store.
+    before_hash = comparison_cache.file_sha512(before)
+    after_hash = comparison_cache.file_sha512(after)
+    if before_hash == after_hash and before_chop == after_chop and not output_similar_composite:
+        return (ComparisonResult.SIMILAR, "0", None, None)
+
+    cache_dir = getattr(args, "cache_dir", None)
+    if not cache_dir:
+        return compare_images(before, after, outdir, similar_dir, args)
+
+    cache = comparison_cache.get_cache(cache_dir)
+    tile_size = getattr(args, "tile_size", 0)
+    # The engines can disagree slightly, e.g. on translucent pixels.
+    engine = "numpy" if image_diff.available() else "imagemagick"
+    key = cache.key(before_hash, after_hash, FUZZ_PERCENT,
+                    [engine, before_chop, after_chop] + ([tile_size] if tile_size else []))
+    cached = cache.get(key)
+    if cached and cached[0] == ComparisonResult.ERROR:
+        # Errors can be temporary, e.g. a file being written, so compare again.
+        cached = None
+    composite_dir = outdir
+    if cached and cached[0] == ComparisonResult.SIMILAR:
+        if not output_similar_composite:
+            return cached
+        composite_dir = similar_dir
+    composite_path = os.path.join(composite_dir, composite_name(before, after))
+    if cached and (getattr(args, "defer_composites", False) or cache.link_composite(key, composite_path)):
+        return cached
+
+    comparison = compare_images(before, after, outdir, similar_dir, args)
+    if comparison[0] == ComparisonResult.ERROR:
+        return comparison
+    if comparison[0] == ComparisonResult.SIMILAR:
+        composite_path = os.path.join(similar_dir, composite_name(before, after))
+    cache.put(key, comparison, composite_path)
+    return comparison
+
+
+def compare_pair_with_output(before, after, outdir, similar_dir, args):
+    """compare_pair for the --jobs workers, returning what it printed too.
+
+    The output is printed with the rest of its directory's once that finishes
+    instead of in the middle of other directories.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        comparison = compare_pair(before, after, outdir, similar_dir, args)
+        return (comparison, sys.stdout.getvalue())
+    finally:
+        sys.stdout = stdout
 
 
 def compare_images(before, after, outdir, similar_dir, args):
     # https://medium.com/@rhuber/imagemagick-is-on-fire-cve-2016-3714-379faf762247#.ftia8t3qs
-    if not is_png_file(before) or not is_png_file(after):
+    with timed("validate"):
+        valid = is_png_file(before) and is_png_file(after)
+    if not valid:
         print("No PNG magic number")
-        return (ComparisonResult.ERROR, -1, None)
+        return (ComparisonResult.ERROR, -1, None, None)
 
     output_similar_composite = getattr(args, "output_similar_composite", False)
-    before_trimmed = trim_system_ui("before", before, outdir, args)
-    after_trimmed = trim_system_ui("after", after, outdir, args)
-    before_name_unprefixed = remove_prefix(os.path.basename(before_trimmed))
-    after_name_unprefixed = remove_prefix(os.path.basename(after_trimmed))
-
-    outname = None
-    # Use the shorter of the two names so the name is the common subset
-    if len(after_name_unprefixed) > len(before_name_unprefixed):
-        outname = before_name_unprefixed
+    before_chop = system_ui_chop(before, getattr(args, "dppx", 1.0))
+    after_chop = system_ui_chop(after, getattr(args, "dppx", 1.0))
+    if image_diff.available():
+        # System UI is cropped from the decoded pixels instead.
+        before_trimmed, after_trimmed = before, after
     else:
-        outname = after_name_unprefixed
+        with timed("trim"):
+            before_trimmed = trim_system_ui("before", before, outdir, before_chop)
+            after_trimmed = trim_system_ui("after", after, outdir, after_chop)
+    outname = composite_name(before, after)
     outpath = os.path.join(outdir, outname)
+    tile_size = getattr(args, "tile_size", 0)
+    before_pixels = after_pixels = mask = diff_regions = None
+    if image_diff.available():
+        try:
+            with timed("decode"):
+                before_pixels = load_cropped_png(before, before_chop)
+                after_pixels = load_cropped_png(after, after_chop)
+            with timed("diff"):
+                if tile_size:
+                    difference = image_diff.diff_tiled(before_pixels, after_pixels,
+                                                       FUZZ_PERCENT / 100.0, tile_size)
+                else:
+                    difference = image_diff.diff(before_pixels, after_pixels, FUZZ_PERCENT / 100.0)
+        except image_diff.DimensionMismatch as e:
+            # The decoded images are kept for write_composite to animate them.
+            result, diff, diff_bounds = ComparisonResult.ERROR, str(e), None
+        except (IOError, SyntaxError, ValueError) as e:
+            # Unreadable or truncated PNGs (DimensionMismatch is handled above).
+            before_pixels = after_pixels = None
+            result, diff, diff_bounds = ComparisonResult.ERROR, str(e), None
+        else:
+            mask = difference.mask
+            diff = str(difference.count)
+            diff_bounds = difference.bounds
+            diff_regions = difference.regions
+            result = ComparisonResult.DIFFERENT if difference.count else ComparisonResult.SIMILAR
+    else:
+        with timed("diff"):
+            result, diff, diff_bounds = compare_imagemagick(before_trimmed, after_trimmed)
+
+    defer_composites = getattr(args, "defer_composites", False)
+    if (result != ComparisonResult.SIMILAR or output_similar_composite) and not defer_composites:
+        write_composite(before_trimmed, after_trimmed, outpath, before_pixels, after_pixels, mask)
+
+    if result == ComparisonResult.SIMILAR:
+        if output_similar_composite and not defer_composites:
+            os.rename(outpath, similar_dir + "/" + outname)
+    elif result == ComparisonResult.DIFFERENT:
+        pass
+    else:
+        result = ComparisonResult.ERROR
+        print("error")
+
+    # Cleanup intermediate trimmed images
+    if os.path.exists(before_trimmed) and os.path.abspath(before) != os.path.abspath(before_trimmed):
+        os.remove(before_trimmed)
+    if os.path.exists(after_trimmed) and os.path.abspath(after) != os.path.abspath(after_trimmed):
+        os.remove(after_trimmed)
+    return (result, diff, diff_bounds, diff_regions)
+
+
+def write_composite(before, after, outpath, before_pixels=None, after_pixels=None, mask=None):
+    """Write the composite highlighting the differences, animated with the originals if possible.
+
+    `before_pixels`, `after_pixels` and `mask` are the decoded images and difference
+    mask from image_diff, when it was used for the comparison. Without a mask,
+    e.g. when the dimensions differ, only the originals are animated.
+    """
+    if before_pixels is not None and after_pixels is not None:
+        frames = [before_pixels, after_pixels]
+        if mask is not None:
+            with timed("composite"):
+                frames.insert(0, image_diff.composite(before_pixels, mask))
+        with timed("apng"):
+            apng.write_apng(outpath, frames, APNG_DELAY_MS)
+        return
+    if image_diff.available():
+        # The images couldn't be decoded so there's nothing to show.
+        return
+
+    with timed("composite"):
+        subprocess.call(["compare", "-quiet", "-lowlight-color", "rgba(255,255,255,0)",
+                         before, after, outpath])
+    try:
+        FNULL = open(os.devnull, 'w')
+        with timed("apng"):
+            exitcode = subprocess.call(["apngasm", "--force", "--delay", str(APNG_DELAY_MS), outpath,
+                                        before, after,
+                                        "--output", outpath + ".animated"],
+                                       stdout=FNULL, close_fds=True)
+        if exitcode != 0:
+            raise Exception("Could not create APNG. Leaving non-animated in-place")
+        os.remove(outpath) # For Windows
+        os.rename(outpath + ".animated", outpath)
+    except (OSError, Exception):
+        # Not a fatal error if the APNG can't be created since we have the
+        # compare output already
+        pass
+
+
+def build_composite(outdir, name):
+    """Build the composite `name` which was deferred by --defer-composites in `outdir`.
+
+    Returns the path of the composite, which is only built the first time, or None if
+    the comparison doesn't have a deferred composite with that name.
+    """
+    try:
+        with open(os.path.join(outdir, COMPOSITES_JSON_FILENAME), 'r') as json_file:
+            composites = json.load(json_file)
+    except IOError:
+        return None
+    if name not in composites:
+        return None
+
+    entry = composites[name]
+    before_chop, after_chop = tuple(entry["before_chop"]), tuple(entry["after_chop"])
+    outpath = os.path.join(outdir, entry["path"])
+    if os.path.isfile(outpath):
+        return outpath
+
+    # Build in a private directory and rename so concurrent requests don't see partial files.
+    tmpdir = tempfile.mkdtemp(dir=outdir)
+    try:
+        before_pixels = after_pixels = mask = None
+        if image_diff.available():
+            before_trimmed, after_trimmed = entry["before"], entry["after"]
+            before_pixels = load_cropped_png(before_trimmed, before_chop)
+            after_pixels = load_cropped_png(after_trimmed, after_chop)
+            try:
+                mask = image_diff.diff(before_pixels, after_pixels, FUZZ_PERCENT / 100.0).mask
+            except image_diff.DimensionMismatch:
+                pass
+        else:
+            before_trimmed = trim_system_ui("before", entry["before"], tmpdir, before_chop)
+            after_trimmed = trim_system_ui("after", entry["after"], tmpdir, after_chop)
+        tmp_outpath = os.path.join(tmpdir, name)
+        write_composite(before_trimmed, after_trimmed, tmp_outpath, before_pixels, after_pixels, mask)
+        os.rename(tmp_outpath, outpath)
+    finally:
+        shutil.rmtree(tmpdir)
+    return outpath
+
+
+def compare_imagemagick(before, after):
+    """Fallback for when numpy or Pillow aren't installed."""
     result = 0
     diff = -1
     diff_bounds = None
     try:
-        process = subprocess.Popen(["compare", "-quiet", "-fuzz", "3%", "-metric", "AE",
-                                    before_trimmed, after_trimmed,
+        process = subprocess.Popen(["compare", "-quiet", "-fuzz", "%d%%" % FUZZ_PERCENT, "-metric", "AE",
+                                    before, after,
                                     # Arguments to dump the differing pixel data as text
                                     "-highlight-color", "green", "-compose", "src", "sparse-color:"],
                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -83,53 +312,29 @@ def compare_images(before, after, outdir, similar_dir, args):
         print("\n\nEnsure that ImageMagick is installed and on your PATH, specifically `compare`.\n")
         raise
 
-    print(diff)
-
-    if result != ComparisonResult.SIMILAR or output_similar_composite:
-        subprocess.call(["compare", "-quiet", "-lowlight-color", "rgba(255,255,255,0)",
-                         before_trimmed, after_trimmed, outpath])
-        try:
-            FNULL = open(os.devnull, 'w')
-            exitcode = subprocess.call(["apngasm", "--force", "--delay", "400", outpath,
-                                        before_trimmed, after_trimmed,
-                                        "--output", outpath + ".animated"],
-                                       stdout=FNULL, close_fds=True)
-            if exitcode != 0:
-                # TODO: handle when dimensions of frames differ!
-                raise Exception("Could not create APNG. Leaving non-animated in-place")
-            os.remove(outpath) # For Windows
-            os.rename(outpath + ".animated", outpath)
-        except (OSError, Exception):
-            # Not a fatal error if the APNG can't be created since we have the
-            # compare output already
-            pass
-
-    if result == ComparisonResult.SIMILAR:
-        if output_similar_composite:
-            os.rename(outpath, similar_dir + "/" + outname)
-    elif result == ComparisonResult.DIFFERENT:
-        pass
-    else:
-        result = ComparisonResult.ERROR
-        print("error")
-
-    # Cleanup intermediate trimmed images
-    if os.path.exists(before_trimmed) and os.path.abspath(before) != os.path.abspath(before_trimmed):
-        os.remove(before_trimmed)
-    if os.path.exists(after_trimmed) and os.path.abspath(after) != os.path.abspath(after_trimmed):
-        os.remove(after_trimmed)
     return (result, diff, diff_bounds)
 
 
-# Not needed in most cases since bug 1403686
-def trim_system_ui(prefix, imagefile, outdir, args):
-    outpath = os.path.join(outdir, prefix + "_" + os.path.basename(imagefile))
+def system_ui_chop(imagefile, dppx=1.0):
+    """Return the number of (top, right, bottom, left) device pixels of system UI to remove."""
     chop_top = chop_right = chop_bottom = chop_left = 0
     if "windows10-" in imagefile or "windows7-" in imagefile:
         if "_maximized_" in imagefile:
             # Two pixels from the taskbar are visible for maximized windows
             # This should be fixed in the widget code ideally.
             chop_bottom = 2
+    return tuple(int(round(chop * dppx)) for chop in (chop_top, chop_right, chop_bottom, chop_left))
+
+
+def load_cropped_png(imagefile, chop):
+    """Decode `imagefile` and return a view of it without the `chop` from system_ui_chop."""
+    return image_diff.crop(image_diff.load_png(imagefile), chop)
+
+
+# Not needed in most cases since bug 1403686
+def trim_system_ui(prefix, imagefile, outdir, chop):
+    outpath = os.path.join(outdir, prefix + "_" + os.path.basename(imagefile))
+    chop_top, chop_right, chop_bottom, chop_left = chop
 
     if chop_top == chop_right == chop_bottom == chop_left == 0:
         return imagefile
@@ -155,28 +360,144 @@ def is_png_file(path):
     f.close()
     return data[:8] == '\x89PNG\x0d\x0a\x1a\x0a'
 
-def compare_dirs(before, after, outdir, args):
-    rv = {}
-    if not (os.path.isdir(before) and os.path.isdir(after)):
-        print("\nBefore or after doesn't exist")
-        return rv
-    for before_dirpath, before_dirs, before_files in os.walk(before):
-        for before_dir in before_dirs:
-            dir_prefix = re.sub(r'-\d{3,}$', '', before_dir)
-            matches = glob.glob(os.path.join(after, dir_prefix) + "*")
-            if matches and os.path.isdir(matches[-1]):
-                rv.update(compare_dirs(os.path.join(before, before_dir), matches[-1],
-                                       os.path.join(outdir, dir_prefix), args))
+class DirComparison(object):
+    """The image pairs of one directory and the results gathered for them so far."""
+
+    def __init__(self, before, after, outdir, lock_fd, similar_dir):
+        self.before = before.path
+        self.after = after.path
+        self.before_images = before.images
+        self.after_images = after.images
+        self.outdir = outdir
+        self.lock_fd = lock_fd
+        self.similar_dir = similar_dir
+        self.suffixes = sorted(set(before.images) | set(after.images))
+        self.max_width = reduce(lambda x, y: max(x, len(y)), self.suffixes, 0)
+        self.pairs = []
+        self.result_dict = defaultdict(list)
+        self.file_output_dict = defaultdict(dict)
+        # What the comparison of each image printed, for --jobs
+        self.messages = {}
+        # KnownInconsistencies to leave out of the output, set by compare_dirs
+        self.known_inconsistencies = None
+
+        for f in self.suffixes:
+            if f not in before.images:
+                self.record(f, ComparisonResult.MISSING_BEFORE)
+            elif f not in after.images:
+                self.record(f, ComparisonResult.MISSING_AFTER)
             else:
-                print("\nNo matching after directory for {0}".format(os.path.join(after, dir_prefix)))
-
-    print('\nComparing {0} and {1} in {2}'.format(before, after, outdir))
+                self.pairs.append((f, before.images[f], after.images[f]))
+        self.remaining = len(self.pairs)
+
+    def record(self, f, result, diff=None, diff_bounds=None, diff_regions=None):
+        self.result_dict[result].append(f)
+        self.file_output_dict[f]["result"] = result
+        if result in (ComparisonResult.MISSING_BEFORE, ComparisonResult.MISSING_AFTER):
+            return
+        self.file_output_dict[f]["difference"] = diff
+        if (diff_bounds):
+            self.file_output_dict[f]["difference_bounds"] = diff_bounds
+        if diff_regions:
+            self.file_output_dict[f]["difference_regions"] = diff_regions
+        self.remaining -= 1
+
+    def is_known_inconsistency(self, f):
+        output = self.file_output_dict[f]
+        if self.known_inconsistencies is None or output["result"] != ComparisonResult.DIFFERENT:
+            return False
+        return self.known_inconsistencies.match(os.path.basename(self.outdir), re.sub(r'\.png$', '', f),
+                                                output["difference"]) is not None
+
+    def row(self, f):
+        output = self.file_output_dict[f]
+        if output["result"] == ComparisonResult.MISSING_BEFORE:
+            return "{0} exists in after but not in before".format(f)
+        if output["result"] == ComparisonResult.MISSING_AFTER:
+            return "{0} exists in before but not in after".format(f)
+        return "{0} {1}{2}".format(f, "".ljust(self.max_width - len(f)), output["difference"])
+
+    def write_deferred_composites(self, output_similar_composite, dppx):
+        """Record what's needed for build_composite to create each composite later."""
+        composites = {}
+        for f, image1, image2 in self.pairs:
+            result = self.file_output_dict[f]["result"]
+            name = composite_name(image1, image2)
+            if result == ComparisonResult.DIFFERENT:
+                path = name
+            elif result == ComparisonResult.SIMILAR and output_similar_composite:
+                path = os.path.join(os.path.basename(self.similar_dir), name)
+            else:
+                continue
+            composites[name] = {
+                "before": os.path.abspath(image1),
+                "after": os.path.abspath(image2),
+                "before_chop": system_ui_chop(image1, dppx),
+                "after_chop": system_ui_chop(image2, dppx),
+                "path": path,
+            }
+
+        with open(os.path.join(self.outdir, COMPOSITES_JSON_FILENAME), 'w') as json_file:
+            json.dump(composites, json_file, sort_keys=True)
+
+    def print_header(self):
+        print("\n{0} and {1}:".format(self.before, self.after))
+        print("SCREENSHOT SUFFIX".ljust(self.max_width), "DIFFERING PIXELS (WITH FUZZ)")
+
+    def finish(self, args):
+        known = len([f for f in self.result_dict[ComparisonResult.DIFFERENT] if self.is_known_inconsistency(f)])
+        print("{0} similar, {1} different, {2} missing, {3} errors{4}"
+              .format(len(self.result_dict[ComparisonResult.SIMILAR]),
+                      len(self.result_dict[ComparisonResult.DIFFERENT]) - known,
+                      len(self.result_dict[ComparisonResult.MISSING_BEFORE])
+                      + len(self.result_dict[ComparisonResult.MISSING_AFTER]),
+                      len(self.result_dict[ComparisonResult.ERROR]),
+                      ", {0} known inconsistencies".format(known) if self.known_inconsistencies is not None else ""))
+
+        if getattr(args, "defer_composites", False):
+            self.write_deferred_composites(getattr(args, "output_similar_composite", False),
+                                           getattr(args, "dppx", 1.0))
+
+        with timed("json"):
+            json_file = open(os.path.join(self.outdir, "comparison.json"), 'w')
+            json.dump(self.file_output_dict, json_file, allow_nan=False, sort_keys=True)
+            json_file.close()
+
+        if getattr(args, "results_index", None):
+            with timed("results_index"):
+                try:
+                    index = results_index.ResultsIndex(args.results_index)
+                    index.add(self.outdir, self.file_output_dict, self.before_images, self.after_images, time.time())
+                    index.close()
+                except sqlite3.Error as e:
+                    # comparison.json is written so `results_index backfill` can add it later.
+                    print("Error recording the results in {0}: {1}".format(args.results_index, e))
+
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN);
+        self.lock_fd.close()
+        return self.file_output_dict
+
+
+def plan_dirs(before, after, outdir, args, rv, comparisons):
+    """Lock every directory of the comparison and append a DirComparison for each to `comparisons`.
+
+    `before` and `after` are DirIndex trees. Completed comparisons are added to `rv`
+    if requested, like `compare_dirs`.
+    """
+    for dir_prefix, before_name, after_name in pair_subdirs(before.subdirs, after.subdirs):
+        if after_name:
+            plan_dirs(before.subdirs[before_name], after.subdirs[after_name],
+                      os.path.join(outdir, dir_prefix), args, rv, comparisons)
+        else:
+            print("\nNo matching after directory for {0}".format(os.path.join(after.path, dir_prefix)))
+
+    print('\nComparing {0} and {1} in {2}'.format(before.path, after.path, outdir))
     try:
         os.makedirs(outdir)
     except OSError:
         if not os.path.isdir(outdir):
             print('Error creating directory: %s' % outdir)
-            return rv
+            return
 
     json_path = os.path.join(outdir, "comparison.json")
     if os.path.isfile(json_path) and not getattr(args, "overwrite", False):
@@ -184,63 +505,98 @@ def compare_dirs(before, after, outdir, args):
         if getattr(args, "include_completed", False):
             with open(json_path, 'r') as json_file:
                 rv[outdir] = json.load(json_file)
-        return rv
+        return
 
     lock_fd = open(os.path.join(outdir, "comparison.lock"), 'w')
     try:
         fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB);
     except IOError:
         print("Comparison already in progress")
-        return rv
+        lock_fd.close()
+        return
 
     similar_dir = os.path.join(outdir, "similar")
-    if getattr(args, "output_similar_composite", False):
+    if getattr(args, "output_similar_composite", False) and not os.path.isdir(similar_dir):
         os.makedirs(similar_dir)
-    sorted_suffixes = sorted(set(get_suffixes(before) + get_suffixes(after)))
 
-    if len(sorted_suffixes) == 0:
+    if not before.images and not after.images:
         print("No images in the directory")
-        return rv
+        fcntl.flock(lock_fd, fcntl.LOCK_UN);
+        lock_fd.close()
+        return
 
-    maxFWidth = reduce(lambda x, y: max(x, len(y)), sorted_suffixes, 0)
-
-    print("SCREENSHOT SUFFIX".ljust(maxFWidth), "DIFFERING PIXELS (WITH FUZZ)")
-    result_dict = defaultdict(list)
-    file_output_dict = defaultdict(dict)
-    for f in sorted_suffixes:
-        image1 = glob.glob(before + "/*[-_]" + f)
-        image2 = glob.glob(after + "/*[-_]" + f)
-        if not image1:
-            print("{0} exists in after but not in before".format(f))
-            result_dict[ComparisonResult.MISSING_BEFORE].append(f)
-            file_output_dict[f]["result"] = ComparisonResult.MISSING_BEFORE
-            continue
-        if not image2:
-            print("{0} exists in before but not in after".format(f))
-            result_dict[ComparisonResult.MISSING_AFTER].append(f)
-            file_output_dict[f]["result"] = ComparisonResult.MISSING_AFTER
-            continue
-        print(f, "", end="".ljust(maxFWidth - len(f)))
-        result, diff, diff_bounds = compare_images(image1[0], image2[0], outdir, similar_dir, args)
-        result_dict[result].append(f)
-        file_output_dict[f]["result"] = result
-        file_output_dict[f]["difference"] = diff
-        if (diff_bounds):
-            file_output_dict[f]["difference_bounds"] = diff_bounds
-    print("{0} similar, {1} different, {2} missing, {3} errors"
-          .format(len(result_dict[ComparisonResult.SIMILAR]),
-                  len(result_dict[ComparisonResult.DIFFERENT]),
-                  len(result_dict[ComparisonResult.MISSING_BEFORE])
-                  + len(result_dict[ComparisonResult.MISSING_AFTER]),
-                  len(result_dict[ComparisonResult.ERROR])))
+    comparisons.append(DirComparison(before, after, outdir, lock_fd, similar_dir))
 
-    json_file = open(json_path, 'w')
-    json.dump(file_output_dict, json_file, allow_nan=False, sort_keys=True)
-    json_file.close()
 
-    fcntl.flock(lock_fd, fcntl.LOCK_UN);
+def compare_dirs(before, after, outdir, args, jobs=None):
+    """Compare the images of `before` and `after` and their matching subdirectories.
+
+    `jobs` (defaulting to `args.jobs` or 1) is the number of worker processes used to
+    compare image pairs. The pairs of all directories share the one pool and each
+    directory's comparison.json is written as soon as its last pair completes.
+    Images matching the rules of `args.known_inconsistencies`, if any, are left
+    out of the printed rows but not comparison.json.
+    """
+    rv = {}
+    if not (os.path.isdir(before) and os.path.isdir(after)):
+        print("\nBefore or after doesn't exist")
+        return rv
+
+    if jobs is None:
+        jobs = getattr(args, "jobs", None) or 1
+
+    comparisons = []
+    plan_dirs(index_dir(before), index_dir(after), outdir, args, rv, comparisons)
+    if getattr(args, "known_inconsistencies", None):
+        known = known_inconsistencies.load(args.known_inconsistencies)
+        for comparison in comparisons:
+            comparison.known_inconsistencies = known
+
+    if jobs <= 1:
+        for comparison in comparisons:
+            comparison.print_header()
+            pairs = dict((f, (image1, image2)) for f, image1, image2 in comparison.pairs)
+            for f in comparison.suffixes:
+                if f in pairs:
+                    image1, image2 = pairs[f]
+                    comparison.record(f, *compare_pair(image1, image2, comparison.outdir,
+                                                       comparison.similar_dir, args))
+                if not comparison.is_known_inconsistency(f):
+                    print(comparison.row(f))
+            rv[comparison.outdir] = comparison.finish(args)
+        return rv
+
+    executor = cf.ProcessPoolExecutor(max_workers=jobs)
+    futures = {}
+    for comparison in comparisons:
+        for f, image1, image2 in comparison.pairs:
+            future = executor.submit(compare_pair_with_output, image1, image2, comparison.outdir,
+                                     comparison.similar_dir, args)
+            futures[future] = (comparison, f)
+
+    def finish(comparison):
+        comparison.print_header()
+        for f in comparison.suffixes:
+            if comparison.messages.get(f):
+                sys.stdout.write(comparison.messages[f])
+            if not comparison.is_known_inconsistency(f):
+                print(comparison.row(f))
+        rv[comparison.outdir] = comparison.finish(args)
+
+    # Directories without any pairs to compare are already done.
+    for comparison in comparisons:
+        if comparison.remaining == 0:
+            finish(comparison)
+    try:
+        for future in cf.as_completed(futures):
+            comparison, f = futures[future]
+            result, comparison.messages[f] = future.result()
+            comparison.record(f, *result)
+            if comparison.remaining == 0:
+                finish(comparison)
+    finally:
+        executor.shutdown()
 
-    rv[outdir] = file_output_dict;
     return rv
 
 
@@ -251,7 +607,17 @@ def cli(args=sys.argv[1:]):
     parser.add_argument("--dppx", type=float, default=1.0, help="Scale factor to use for cropping system UI")
     parser.add_argument("-o", "--output", default=None, metavar="DIRECTORY", help="Directory to output JSON and composite images to")
     parser.add_argument("--output-similar-composite", action="store_true", help="Output a composite image even when images are 'similar'")
+    parser.add_argument("--defer-composites", action="store_true",
+                        help="Only record how to build composite images so build_composite can create them when requested")
     parser.add_argument("--overwrite", action="store_true", default=False, help="Whether to overwrite an existing directory comparison")
+    parser.add_argument("--cache-dir", default=None, metavar="DIRECTORY", help="Directory to cache comparison results by image content in")
+    parser.add_argument("--tile-size", type=int, default=0, metavar="PIXELS",
+                        help="Only diff the PIXELS-sized square tiles which changed and report the bounds of each changed region")
+    parser.add_argument("--results-index", default=None, metavar="PATH",
+                        help="SQLite index (e.g. results.sqlite) to also record the results in, see screenshot_results")
+    parser.add_argument("--known-inconsistencies", default=None, metavar="PATH",
+                        help="Leave the differences matching these rules (e.g. web/known_inconsistencies.json) out of the output")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N", help="Number of image pairs to compare in parallel")
 
     args = parser.parse_args(args)
 
@@ -272,12 +638,27 @@ def cli(args=sys.argv[1:]):
         compare_dirs(before, after, outdir, args)
     elif (os.path.isfile(before) and os.path.isfile(after)):
         print()
-        compare_images(before, after, outdir, outdir, args)
+        print(compare_images(before, after, outdir, outdir, args)[1])
     else:
         print("Two files or two directories expected")
         return
 
     print("Image comparison results:", outdir)
 
+def build_composite_cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Build composite images deferred by compare_screenshots --defer-composites')
+    parser.add_argument("outdir", help="Output directory of a platform's comparison")
+    parser.add_argument("names", nargs="+", metavar="name", help="File name of the composite image")
+
+    args = parser.parse_args(args)
+
+    for name in args.names:
+        path = build_composite(args.outdir, name)
+        if not path:
+            print("No deferred composite named {0} in {1}".format(name, args.outdir))
+            continue
+        print(path)
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Persistent cache of image pair comparisons keyed by the content of both images.
+
+Entries are laid out like the sha512/ store of fetch_screenshots:
+<cache_dir>/<k0>/<k1>/<key>.json holds the result, difference and bounds and
+<key>.png, when present, is the composite which gets hard-linked into the
+output directory of later comparisons.
+"""
+
+import errno
+import json
+import os
+import shutil
+import tempfile
+from hashlib import sha1, sha512
+
+# (st_dev, st_ino, st_size, st_mtime) -> sha512 for the files hashed by this process.
+# The size and modification time are included in case a file is rewritten in place.
+_hashes = {}
+# cache_dir -> ComparisonCache, see get_cache
+_caches = {}
+
+
+def file_sha512(path):
+    stat = os.stat(path)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+    if key not in _hashes:
+        digest = sha512()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def same_file(before, after):
+    before_stat = os.stat(before)
+    after_stat = os.stat(after)
+    return (before_stat.st_dev, before_stat.st_ino) == (after_stat.st_dev, after_stat.st_ino)
+
+
+def link_or_copy(src, dest):
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def get_cache(cache_dir):
+    """Return the ComparisonCache of `cache_dir`, created once per process."""
+    if cache_dir not in _caches:
+        _caches[cache_dir] = ComparisonCache(cache_dir)
+    return _caches[cache_dir]
+
+
+class ComparisonCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(before_hash, after_hash, fuzz, variant=None):
+        """`variant` describes anything else affecting the result e.g. cropping."""
+        return sha1(json.dumps([before_hash, after_hash, fuzz, variant])).hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.cache_dir, key[0], key[1], key + extension)
+
+    def get(self, key):
+        """Return the cached (result, difference, difference_bounds, difference_regions) or None."""
+        try:
+            with open(self._path(key, ".json"), 'r') as entry_file:
+                entry = json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+        return (entry["result"], entry["difference"], entry.get("difference_bounds"),
+                entry.get("difference_regions"))
+
+    def put(self, key, comparison, composite=None):
+        result, diff, diff_bounds, diff_regions = comparison
+        entry_path = self._path(key, ".json")
+        entry_dir = os.path.dirname(entry_path)
+        try:
+            os.makedirs(entry_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        if composite and os.path.isfile(composite):
+            link_or_copy(composite, self._path(key, ".png"))
+
+        # Write to a temporary file and rename so readers never see partial entries.
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as entry_file:
+            json.dump({
+                "result": result,
+                "difference": diff,
+                "difference_bounds": diff_bounds,
+                "difference_regions": diff_regions,
+            }, entry_file, allow_nan=False, sort_keys=True)
+        os.rename(tmp_path, entry_path)
+
+    def link_composite(self, key, dest):
+        """Link the cached composite to `dest` and return whether there was one."""
+        composite = self._path(key, ".png")
+        if not os.path.isfile(composite):
+            return False
+        link_or_copy(composite, dest)
+        return True
@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Comparison results and the pairing of screenshot directories, shared by compare_screenshots and results_index."""
+
+import re
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+comparisonResultNames = ["SIMILAR", "DIFFERENT", "ERROR", "MISSING_BEFORE", "MISSING_AFTER"]
+ComparisonResult = namedtuple("ComparisonResult", comparisonResultNames)._make(range(0, len(comparisonResultNames)))
+
+# `images` maps the suffix of each PNG in `path` to its path and `subdirs`
+# maps subdirectory names to their own DirIndex.
+DirIndex = namedtuple("DirIndex", "path images subdirs")
+
+
+def remove_prefix(filename):
+    return re.sub(r'^((before|after)_)?[^-_]*[-_]', '', filename)
+
+
+def index_dir(path):
+    """Index the PNG images of `path` by suffix and its subdirectories by name.
+
+    Each directory of the tree is only listed once.
+    """
+    images = {}
+    subdirs = {}
+    for entry in sorted(scandir(path), key=lambda entry: entry.name):
+        if entry.is_dir():
+            subdirs[entry.name] = index_dir(entry.path)
+        elif entry.name.endswith(".png"):
+            images.setdefault(remove_prefix(entry.name), entry.path)
+    return DirIndex(path, images, subdirs)
+
+
+def job_dir_prefix(name):
+    """Return the name of a job directory (e.g. linux64-123456) without the job ID."""
+    return re.sub(r'-\d{3,}$', '', name)
+
+
+def matching_name(names, name):
+    """Return the last of the directory `names` for the same platform as `name`, ignoring the job ID, or None."""
+    dir_prefix = job_dir_prefix(name)
+    matches = sorted(other for other in names if job_dir_prefix(other) == dir_prefix)
+    return matches[-1] if matches else None
+
+
+def matching_subdir(index, name):
+    """Return the subdirectory of `index` for the same platform as `name`, ignoring the job ID."""
+    match = matching_name(index.subdirs, name)
+    return (job_dir_prefix(name), index.subdirs[match] if match else None)
+
+
+def pair_subdirs(before_names, after_names):
+    """Return the (platform prefix, before name, after name or None) of each pair of directories to compare.
+
+    The first of the before directories of a platform is compared with the
+    matching_name of the after directories.
+    """
+    pairs = []
+    prefixes = set()
+    for before_name in sorted(before_names):
+        dir_prefix = job_dir_prefix(before_name)
+        if dir_prefix in prefixes:
+            continue
+        prefixes.add(dir_prefix)
+        pairs.append((dir_prefix, before_name, matching_name(after_names, before_name)))
+    return pairs
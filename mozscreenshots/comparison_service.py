@@ -0,0 +1,336 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Local HTTP service running the comparisons of pairs of pushes requested by the web page.
+
+Each pair is a job identified by <project>/<rev>/<project>/<rev>, like its
+directory in comparisons/, and requests for a pair which is already queued or
+running share that job instead of starting another comparison. Jobs are kept
+in a JSON file of the archive so queued ones survive restarts and at most
+--workers run at a time, each with fetch_and_compare. A job's status can be
+polled with `wait` to be answered as soon as it finishes:
+
+    POST /comparisons  oldProject=mozilla-central&oldRev=08138045c38c&newProject=try&newRev=5f6ca9194dd9
+    GET  /comparisons/mozilla-central/08138045c38c/try/5f6ca9194dd9?wait=30
+    GET  /status
+
+The composites of comparisons run with --defer-composites are built the first
+time they're requested:
+
+    GET  /composites/mozilla-central/08138045c38c/try/5f6ca9194dd9/linux64/browserWindow_01_normal.png
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import compare_screenshots
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+DEFAULT_PORT = 8091
+DEFAULT_WORKERS = 2
+QUEUE_FILENAME = "comparison_queue.json"
+PROJECT_RE = re.compile(r'^[\w.-]+$')
+REV_RE = re.compile(r'^[0-9a-f]{12,40}$')
+JOB_PATH_RE = re.compile(r'^/comparisons/([\w.-]+/[0-9a-f]{12,40}/[\w.-]+/[0-9a-f]{12,40})$')
+# Job ID, platform directory and composite name. None of the parts may start with a dot.
+COMPOSITE_PATH_RE = re.compile(r'^/composites/(\w[\w.-]*/[0-9a-f]{12,40}/\w[\w.-]*/[0-9a-f]{12,40})/'
+                               r'(\w[\w.-]*)/(\w[\w.-]*\.png)$')
+# Longest a status request can wait for its job to finish
+MAX_WAIT_SECONDS = 60
+# Requests for a pair finished this recently get its job instead of comparing again
+REUSE_SECONDS = 60
+MAX_FINISHED_AGE = 7 * 24 * 60 * 60
+# Lines of the output of fetch_and_compare kept for the status of a job
+OUTPUT_LINES = 20
+FETCH_AND_COMPARE_COMMAND = "import sys; sys.path.insert(0, %r); import fetch_and_compare; fetch_and_compare.cli()"
+
+
+class ComparisonQueue(object):
+    """Comparison jobs by ID, persisted as JSON, and a condition to wait for changes to them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.condition = threading.Condition()
+        try:
+            with open(path, 'r') as queue_file:
+                self.jobs = json.load(queue_file)
+        except (IOError, ValueError):
+            self.jobs = {}
+        for job in self.jobs.values():
+            if job["state"] == "running":
+                # Interrupted by a restart
+                job["state"] = "queued"
+
+    def save(self):
+        """Write the jobs, forgetting old finished ones. Called with the condition held."""
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job["finished"] and now - job["finished"] > MAX_FINISHED_AGE:
+                del self.jobs[job_id]
+        # Write to a temporary file and rename so a crash never leaves a partial queue.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        with os.fdopen(fd, 'w') as queue_file:
+            json.dump(self.jobs, queue_file, indent=2, separators=(',', ': '), sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def describe(self, job):
+        description = dict(job)
+        if job["state"] == "queued":
+            queued = sorted(other["requested"] for other in self.jobs.values() if other["state"] == "queued")
+            description["position"] = queued.index(job["requested"]) + 1
+        return description
+
+    def request(self, old_project, old_rev, new_project, new_rev):
+        """Queue a comparison unless the same one is queued, running or just finished and return its job."""
+        job_id = "/".join([old_project, old_rev, new_project, new_rev])
+        now = time.time()
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or (job["finished"] and now - job["finished"] > REUSE_SECONDS):
+                job = self.jobs[job_id] = {
+                    "id": job_id,
+                    "old_project": old_project,
+                    "old_rev": old_rev,
+                    "new_project": new_project,
+                    "new_rev": new_rev,
+                    "state": "queued",
+                    "requested": now,
+                    "requests": 0,
+                    "started": None,
+                    "finished": None,
+                    "exit_status": None,
+                    "output": [],
+                }
+                self.condition.notify_all()
+            job["requests"] += 1
+            self.save()
+            return self.describe(job)
+
+    def get(self, job_id, wait=0):
+        """Return the job, waiting up to `wait` seconds for it to finish, or None if there is no such job."""
+        deadline = time.time() + wait
+        with self.condition:
+            while job_id in self.jobs and self.jobs[job_id]["state"] in ("queued", "running"):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.describe(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def next_job(self):
+        """Wait for a queued job, mark the oldest running and return it."""
+        with self.condition:
+            while True:
+                queued = [job for job in self.jobs.values() if job["state"] == "queued"]
+                if queued:
+                    break
+                self.condition.wait()
+            job = min(queued, key=lambda job: job["requested"])
+            job["state"] = "running"
+            job["started"] = time.time()
+            job["output"] = []
+            self.save()
+            self.condition.notify_all()
+            return dict(job)
+
+    def add_output(self, job_id, line):
+        with self.condition:
+            output = self.jobs[job_id]["output"]
+            output.append(line)
+            del output[:-OUTPUT_LINES]
+
+    def finish(self, job_id, exit_status):
+        with self.condition:
+            job = self.jobs[job_id]
+            job["state"] = "done" if exit_status == 0 else "failed"
+            job["exit_status"] = exit_status
+            job["finished"] = time.time()
+            self.save()
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            jobs = sorted(self.jobs.values(), key=lambda job: job["requested"])
+            return {
+                "queued": [job["id"] for job in jobs if job["state"] == "queued"],
+                "running": [job["id"] for job in jobs if job["state"] == "running"],
+                "done": len([job for job in jobs if job["state"] == "done"]),
+                "failed": len([job for job in jobs if job["state"] == "failed"]),
+            }
+
+
+def run_jobs(queue, archive, fetch_and_compare_args):
+    """Run the queued jobs one after the other with fetch_and_compare, forever."""
+    command = [sys.executable, "-c", FETCH_AND_COMPARE_COMMAND % os.path.dirname(os.path.abspath(__file__))]
+    while True:
+        job = queue.next_job()
+        print("Comparing", job["id"])
+        outdir = os.path.join("comparisons", job["id"])
+        try:
+            process = subprocess.Popen(command + ["{0}/{1}".format(job["old_project"], job["old_rev"]),
+                                                  "{0}/{1}".format(job["new_project"], job["new_rev"]),
+                                                  "-o", outdir] + fetch_and_compare_args,
+                                       cwd=archive, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in iter(process.stdout.readline, b''):
+                queue.add_output(job["id"], line.decode("utf-8", "replace").rstrip())
+            exit_status = process.wait()
+        except OSError as e:
+            queue.add_output(job["id"], str(e))
+            exit_status = -1
+        print("Finished", job["id"], "with exit status", exit_status)
+        queue.finish(job["id"], exit_status)
+
+
+def compared_platforms(archive, job_id):
+    """Return the platforms of a job whose comparison.json is written."""
+    outdir = os.path.join(archive, "comparisons", job_id)
+    if not os.path.isdir(outdir):
+        return []
+    return sorted(platform for platform in os.listdir(outdir)
+                  if os.path.isfile(os.path.join(outdir, platform, "comparison.json")))
+
+
+def composite_path(archive, job_id, platform, name):
+    """Return the path of a composite of a job, building it first if it was deferred, or None."""
+    outdir = os.path.join(archive, "comparisons", job_id, platform)
+    path = compare_screenshots.build_composite(outdir, name)
+    if path is None and os.path.isfile(os.path.join(outdir, name)):
+        # Built during the comparison
+        path = os.path.join(outdir, name)
+    return path
+
+
+class ComparisonServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        if url.path == "/status":
+            return self.respond(200, self.server.queue.status())
+        match = COMPOSITE_PATH_RE.match(url.path)
+        if match:
+            return self.send_composite(*match.groups())
+        match = JOB_PATH_RE.match(url.path)
+        if not match:
+            return self.respond(404, {"detail": "Not found"})
+        try:
+            wait = min(float(query.get("wait", 0)), MAX_WAIT_SECONDS)
+        except ValueError:
+            return self.respond(400, {"detail": "wait must be a number of seconds"})
+        job = self.server.queue.get(match.group(1), wait)
+        if job is None:
+            return self.respond(404, {"detail": "No comparison of {0} was requested".format(match.group(1))})
+        self.respond(200, self.with_progress(job))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        if url.path != "/comparisons":
+            return self.respond(404, {"detail": "Not found"})
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        params.update((key, values[-1]) for key, values in parse_qs(body).items())
+        try:
+            pair = [params[name].strip() for name in ("oldProject", "oldRev", "newProject", "newRev")]
+        except KeyError as e:
+            return self.respond(400, {"detail": "Missing {0}".format(e.args[0])})
+        pair[1] = pair[1].lower()
+        pair[3] = pair[3].lower()
+        if not (PROJECT_RE.match(pair[0]) and REV_RE.match(pair[1]) and
+                PROJECT_RE.match(pair[2]) and REV_RE.match(pair[3])):
+            return self.respond(400, {"detail": "Invalid project or revision"})
+        job = self.server.queue.request(*pair)
+        self.respond(202 if job["state"] in ("queued", "running") else 200, self.with_progress(job))
+
+    def send_composite(self, job_id, platform, name):
+        try:
+            path = composite_path(self.server.archive, job_id, platform, name)
+        except (IOError, OSError, SyntaxError, ValueError) as e:
+            return self.respond(500, {"detail": "Couldn't build {0}: {1}".format(name, e)})
+        if path is None:
+            return self.respond(404, {"detail": "No composite {0} for {1} of {2}".format(name, platform, job_id)})
+        with open(path, 'rb') as composite_file:
+            body = composite_file.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def with_progress(self, job):
+        job["platforms_compared"] = compared_platforms(self.server.archive, job["id"])
+        return job
+
+    def respond(self, status, data):
+        body = json.dumps(data, sort_keys=True).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ComparisonService(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, archive, host="127.0.0.1", port=DEFAULT_PORT):
+        HTTPServer.__init__(self, (host, port), ComparisonServiceHandler)
+        self.archive = archive
+        self.queue = ComparisonQueue(os.path.join(archive, QUEUE_FILENAME))
+
+    def start_workers(self, workers, fetch_and_compare_args):
+        for i in range(workers):
+            thread = threading.Thread(target=run_jobs, args=(self.queue, self.archive, fetch_and_compare_args))
+            thread.daemon = True
+            thread.start()
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Serve requests from the web page to compare pairs of pushes')
+    parser.add_argument("--archive", default=os.getcwd(),
+                        help="Directory to fetch the screenshots and write comparisons/ in [Default=current directory]")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on [Default=%(default)s]")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="[Default=%(default)s]")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Number of comparisons to run at the same time [Default=%(default)s]")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="Number of image pairs each comparison compares in parallel [Default=%(default)s]")
+    args = parser.parse_args(args)
+
+    archive = os.path.abspath(args.archive)
+    service = ComparisonService(archive, args.host, args.port)
+    service.start_workers(args.workers, [
+        "--jobs", str(args.jobs),
+        "--cache-dir", os.path.join(archive, "comparison_cache"),
+        "--results-index", os.path.join(archive, "results.sqlite"),
+        "--defer-composites",
+    ])
+    print("Serving comparisons of {0} on http://{1}:{2}".format(archive, *service.server_address))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    cli()
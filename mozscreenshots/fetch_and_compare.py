@@ -0,0 +1,186 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Fetch the screenshots of two pushes and compare them at the same time.
+
+Each platform is compared as soon as the job directories of both pushes for it
+have all of their images, while the images of other platforms are still being
+downloaded, so the total time is closer to the slower of fetching and comparing
+than to their sum.
+"""
+
+from __future__ import print_function
+
+import argparse
+import concurrent.futures as cf
+import logging
+import os
+import sys
+import threading
+
+import compare_screenshots
+import comparison_common
+import fetch_screenshots
+
+
+class PipelinedComparison(object):
+    """Compares the job directories of a platform once both revision directories have them.
+
+    A platform is compared as soon as every job listed for it on both sides has
+    all of its images, pairing the directories with the same
+    comparison_common.pair_subdirs as compare_dirs. Platforms with jobs which
+    failed to download are compared once fetching is done, without those jobs.
+    Comparisons run one at a time, each with `compare_args.jobs` workers.
+    """
+
+    def __init__(self, before_dir, after_dir, outdir, compare_args):
+        self.rev_dirs = (before_dir, after_dir)
+        self.outdir = outdir
+        self.compare_args = compare_args
+        # Names of the job directories listed and fully fetched, for before and after
+        self.listed = (set(), set())
+        self.fetched = (set(), set())
+        self.compared = set()
+        self.futures = []
+        self.lock = threading.Lock()
+        self.executor = cf.ThreadPoolExecutor(max_workers=1)
+
+    def jobs_listed(self, rev_dir, job_dirs):
+        with self.lock:
+            self.listed[self.rev_dirs.index(rev_dir)].update(os.path.basename(job_dir) for job_dir in job_dirs)
+
+    def job_fetched(self, job_dir):
+        side = self.rev_dirs.index(os.path.dirname(job_dir))
+        with self.lock:
+            self.fetched[side].add(os.path.basename(job_dir))
+            for dir_prefix, before_name, after_name in comparison_common.pair_subdirs(self.listed[0],
+                                                                                      self.listed[1]):
+                if after_name:
+                    self.compare_fetched(dir_prefix, settled=True)
+
+    def compare_fetched(self, dir_prefix, settled=False):
+        """Compare the fetched directories of a platform unless it already was.
+
+        With `settled`, only once all of the directories listed for it on both
+        sides are fetched since another one could be the one to compare.
+        """
+        if dir_prefix in self.compared:
+            return
+        before_names = [name for name in self.fetched[0]
+                        if comparison_common.job_dir_prefix(name) == dir_prefix]
+        if not before_names:
+            return
+        if settled:
+            listed_before = [name for name in self.listed[0]
+                             if comparison_common.job_dir_prefix(name) == dir_prefix]
+            listed_after = [name for name in self.listed[1]
+                            if comparison_common.job_dir_prefix(name) == dir_prefix]
+            if not (self.fetched[0].issuperset(listed_before) and self.fetched[1].issuperset(listed_after)):
+                return
+        pairs = comparison_common.pair_subdirs(before_names, self.fetched[1])
+        after_name = pairs[0][2]
+        if not after_name:
+            return
+        self.compared.add(dir_prefix)
+        before, after = [os.path.join(rev_dir, name) for rev_dir, name in zip(self.rev_dirs, pairs[0][1:])]
+        self.futures.append(self.executor.submit(compare_screenshots.compare_dirs, before, after,
+                                                 os.path.join(self.outdir, dir_prefix), self.compare_args))
+
+    def wait(self):
+        """Wait for the comparisons once fetching is done and return them like compare_dirs."""
+        with self.lock:
+            for dir_prefix, before_name, after_name in comparison_common.pair_subdirs(self.fetched[0],
+                                                                                      self.fetched[1]):
+                if after_name:
+                    self.compare_fetched(dir_prefix)
+                else:
+                    print("\nNo matching after directory for {0}".format(os.path.join(self.rev_dirs[1], dir_prefix)))
+        rv = {}
+        try:
+            for future in self.futures:
+                rv.update(future.result())
+        finally:
+            self.executor.shutdown()
+        return rv
+
+
+def fetch_and_compare(args, before, after, outdir):
+    """Fetch and compare the screenshots of two pushes, each a (project, resultset) tuple.
+
+    `args` has the options of both fetch_screenshots (except the project) and
+    compare_screenshots. Returns the comparisons, like compare_dirs, and the
+    number of fetch errors.
+    """
+    rev_dirs = [os.path.join(project, resultset['revision']) for project, resultset in (before, after)]
+    pipeline = PipelinedComparison(rev_dirs[0], rev_dirs[1], outdir, args)
+    fetcher = fetch_screenshots.Fetcher(args.concurrency, pipeline.job_fetched, pipeline.jobs_listed)
+    for project, resultset in (before, after):
+        project_args = argparse.Namespace(**vars(args))
+        project_args.project = project
+        fetcher.fetch_resultset(project_args, resultset)
+    fetcher.wait()
+    fetch_screenshots.print_request_stats()
+    return (pipeline.wait(), fetcher.errors)
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Fetch the screenshots of two pushes and compare them as they arrive')
+    parser.add_argument("before", metavar="PROJECT/REV", help="Push to compare against e.g. mozilla-central/08138045c38c")
+    parser.add_argument("after", metavar="PROJECT/REV", help="Push to compare e.g. try/5f6ca9194dd9")
+    parser.add_argument("-o", "--output", default=None, metavar="DIRECTORY",
+                        help="Directory to output JSON and composite images to [Default=comparisons/PROJECT/REV/PROJECT/REV]")
+
+    fetch_group = parser.add_argument_group("fetching")
+    fetch_group.add_argument('--job-type-symbol', default='ss',
+                             help='Treeherder symbol of the job to fetch from (aka. job_type_symbol) [Default="ss"]')
+    fetch_group.add_argument('--job-group-symbol', default='M',
+                             help='Treeherder symbol group of the job to fetch from (aka. job_group_symbol) [Default="M" for Mochitests]')
+    fetch_group.add_argument('--job-type-name', default=None,
+                             help='Type of job to fetch from (aka. job_type_name e.g. test-windows7-32/opt-browser-screenshots-e10s)')
+    fetch_group.add_argument('--concurrency', type=int, default=fetch_screenshots.DEFAULT_CONCURRENCY,
+                             help='Maximum number of requests in flight [Default=%(default)s]')
+    fetch_group.add_argument('--log-level', default='WARNING')
+
+    compare_group = parser.add_argument_group("comparing")
+    compare_group.add_argument("--dppx", type=float, default=1.0, help="Scale factor to use for cropping system UI")
+    compare_group.add_argument("--output-similar-composite", action="store_true",
+                               help="Output a composite image even when images are 'similar'")
+    compare_group.add_argument("--defer-composites", action="store_true",
+                               help="Only record how to build composite images so build_composite can create them when requested")
+    compare_group.add_argument("--overwrite", action="store_true", default=False,
+                               help="Whether to overwrite an existing directory comparison")
+    compare_group.add_argument("--cache-dir", default=None, metavar="DIRECTORY",
+                               help="Directory to cache comparison results by image content in")
+    compare_group.add_argument("--tile-size", type=int, default=0, metavar="PIXELS",
+                               help="Only diff the PIXELS-sized square tiles which changed and report the bounds of each changed region")
+    compare_group.add_argument("--results-index", default=None, metavar="PATH",
+                               help="SQLite index (e.g. results.sqlite) to also record the results in")
+    compare_group.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                               help="Number of image pairs to compare in parallel")
+
+    args = parser.parse_args(args)
+    fetch_screenshots.log.setLevel(getattr(logging, args.log_level))
+    # Next to the revision directories, like fetch_screenshots
+    fetch_screenshots.use_metadata_cache(os.path.abspath(fetch_screenshots.METADATA_CACHE_PATH))
+
+    pushes = []
+    for push in (args.before, args.after):
+        if push.count("/") != 1:
+            parser.error("Expected PROJECT/REV instead of %s" % push)
+        project, rev = push.split("/")
+        response = fetch_screenshots.resultset_response_for_push(project, rev)
+        if not response:
+            sys.exit(1)
+        pushes.append((project, response['results'][0]))
+
+    outdir = args.output or os.path.join("comparisons", pushes[0][0], pushes[0][1]['revision'],
+                                         pushes[1][0], pushes[1][1]['revision'])
+    comparisons, errors = fetch_and_compare(args, pushes[0], pushes[1], outdir)
+    print("Image comparison results:", outdir)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -4,18 +4,23 @@
 
 import argparse
 import concurrent.futures as cf
+import json
 import logging
 import os
 import pprint
 import requests
 import slugid
 import sys
+import tempfile
+import threading
 import uuid
 
 from datetime import datetime, timedelta
 from hashlib import sha512
-from requests_futures.sessions import FuturesSession
+from metadata_cache import IMMUTABLE, MetadataCache
 from mozscreenshots import __version__
+from request_scheduler import DEFAULT_MAX_RETRIES, RequestScheduler
+from store_maintenance import store_lock
 
 
 DEFAULT_REQUEST_HEADERS = {
@@ -23,11 +28,40 @@ DEFAULT_REQUEST_HEADERS = {
     'Content-Type': 'application/json',
     'User-Agent': 'mozscreenshots/%s' % __version__,
 }
+FETCH_MANIFEST_FILENAME = 'fetch_manifest.json'
 HASHED_IMAGE_PATH = 'sha512'
-TC_INDEX_API = 'https://firefox-ci-tc.services.mozilla.com/api/index/v1'
-TC_QUEUE_API = "https://firefox-ci-tc.services.mozilla.com/api/queue/v1"
-TH_API = 'https://treeherder.mozilla.org/api'
+# Directory inside HASHED_IMAGE_PATH for downloads in progress
+HASHED_IMAGE_TMP_DIR = 'tmp'
+# The APIs can be overridden with environment variables e.g. to use benchmarks/fake_services.py
+TC_INDEX_API = os.environ.get('MOZSCREENSHOTS_TC_INDEX_API', 'https://firefox-ci-tc.services.mozilla.com/api/index/v1')
+TC_QUEUE_API = os.environ.get('MOZSCREENSHOTS_TC_QUEUE_API', "https://firefox-ci-tc.services.mozilla.com/api/queue/v1")
+TH_API = os.environ.get('MOZSCREENSHOTS_TH_API', 'https://treeherder.mozilla.org/api')
 TH_WEB = 'https://treeherder.mozilla.org'
+DEFAULT_CONCURRENCY = 10
+DOWNLOAD_TIMEOUT = 60
+DEFAULT_JSON_TIMEOUT = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Maximum page sizes of the Treeherder push and job lists
+PUSH_PAGE_SIZE = 1000
+JOBS_PAGE_SIZE = 2000
+# Number of pushes to list the jobs of with each query
+JOBS_BATCH_SIZE = 20
+METADATA_CACHE_PATH = 'metadata_cache'
+# Pushes and dates older than this are assumed to have all of their jobs finished.
+SETTLED_AGE = timedelta(days=1)
+# Seconds to reuse cached metadata which can still change
+RECENT_MAX_AGE = 10 * 60
+SETTLED_MAX_AGE = 7 * 24 * 60 * 60
+
+# Cache of fetch_json responses, None to disable it. Set by use_metadata_cache.
+metadata_cache = None
+
+# Shared by all requests so connections are reused.
+http_session = requests.Session()
+# Retries requests and limits the concurrency of each host.
+scheduler = RequestScheduler(http_session, DEFAULT_CONCURRENCY)
+# Timeout in seconds of each fetch_json request
+json_timeout = DEFAULT_JSON_TIMEOUT
 
 log = logging.getLogger('fetch_screenshots')
 handler = logging.StreamHandler(sys.stderr)
@@ -35,28 +69,13 @@ handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)
 log.addHandler(handler)
 
 
-def resultset_response_for_id(project, resultset_id):
-    print 'Fetching resultset for id: %d' % resultset_id
-    resultset_url = '%s/project/%s/push/%s/' % (TH_API, project, resultset_id)
-    log.info(resultset_url)
-    try:
-        json = fetch_json(resultset_url)
-    except requests.exceptions.HTTPError:
-        log.error('Invalid resultset for id: %d' % resultset_id)
-        return None
-
-    if not json['id']:
-        log.error('No resultset for id: %s' % resultset_id)
-        return None
-    log.debug('resultset_response_for_id: %s' % pprint.pformat(json, depth=1))
-    return json
-
-
 def resultset_response_for_push(project, rev):
     print 'Fetching resultset for revision: %s' % rev
     resultset_url = '%s/project/%s/push/?count=2&full=true&revision=%s' % (TH_API, project, rev)
     log.info(resultset_url)
-    response = fetch_json(resultset_url)
+    # Only cache once the push exists as it won't change after that.
+    response = fetch_json(resultset_url, max_age=IMMUTABLE,
+                          cacheable=lambda response: len(response['results']) == 1)
 
     if len(response['results']) == 0:
         log.error('No resultset for revision: %s' % rev)
@@ -68,10 +87,9 @@ def resultset_response_for_push(project, rev):
     return response
 
 
-def jobs_for_resultset(project, resultset_id, job_type_name, job_type_symbol, job_group_symbol):
-    print 'Fetching jobs for resultset: %d' % resultset_id
-
-    jobs_url = '%s/project/%s/jobs/?count=2000&result_set_id=%d&exclusion_profile=false' % (TH_API, project, resultset_id)
+def fetch_jobs(project, query, job_type_name, job_type_symbol, max_age):
+    """Return all jobs matching the `query` string, following pagination."""
+    jobs_url = '%s/project/%s/jobs/?count=%d&%s&exclusion_profile=false' % (TH_API, project, JOBS_PAGE_SIZE, query)
     if job_type_name:
         jobs_url += '&job_type_name=' + job_type_name
     if job_type_symbol:
@@ -83,13 +101,17 @@ def jobs_for_resultset(project, resultset_id, job_type_name, job_type_symbol, jo
     # if job_group_symbol:
     #     jobs_url += '&job_group_symbol=' + job_group_symbol
 
-    log.info(jobs_url)
-    jobs = fetch_json(jobs_url)
-    if len(jobs['results']) == 0:
-        log.error('No jobs found for resultset: %d' % resultset_id)
-        return None
-    log.debug('jobs_for_resultset: %s' % pprint.pformat(jobs))
+    jobs = []
+    while True:
+        page_url = '%s&offset=%d' % (jobs_url, len(jobs))
+        log.info(page_url)
+        page = fetch_json(page_url, max_age=max_age, cacheable=lambda page: len(page['results']) > 0)
+        jobs.extend(page['results'])
+        if len(page['results']) < JOBS_PAGE_SIZE:
+            return jobs
 
+
+def successful_jobs(project, jobs, job_group_symbol):
     def filter_jobs(job):
         if job['result'] == 'testfailed' and job_group_symbol and job['job_group_symbol'] == job_group_symbol:
             log.warning('Job %s failed for platform: %s. %s/#/jobs?repo=%s&selectedTaskRun=%s-%s' % (job['id'], job['platform'], TH_WEB, project, job['task_id'], job['retry_id']))
@@ -99,7 +121,36 @@ def jobs_for_resultset(project, resultset_id, job_type_name, job_type_symbol, jo
             return True
         return job['job_group_symbol'] == job_group_symbol
 
-    return list(filter(filter_jobs, jobs['results']))
+    return list(filter(filter_jobs, jobs))
+
+
+def jobs_for_resultsets(project, resultsets, job_type_name, job_type_symbol, job_group_symbol):
+    """Return a dict of the id of each of `resultsets` to its successful jobs using one query for all of them."""
+    resultset_ids = [resultset['id'] for resultset in resultsets]
+    print 'Fetching jobs for resultsets: %s' % ', '.join(str(resultset_id) for resultset_id in resultset_ids)
+    newest_push_time = datetime.utcfromtimestamp(max(resultset['push_timestamp'] for resultset in resultsets))
+    jobs = fetch_jobs(project, 'push_id__in=%s' % ','.join(str(resultset_id) for resultset_id in resultset_ids),
+                      job_type_name, job_type_symbol, max_age_since(newest_push_time))
+    log.debug('jobs_for_resultsets: %s' % pprint.pformat(jobs))
+
+    jobs_by_resultset = dict((resultset_id, []) for resultset_id in resultset_ids)
+    for job in successful_jobs(project, jobs, job_group_symbol):
+        jobs_by_resultset[job['push_id']].append(job)
+    return jobs_by_resultset
+
+
+def max_age_since(push_time):
+    """Return how long metadata about something from `push_time` (a UTC datetime) should be cached for."""
+    if datetime.utcnow() - push_time > SETTLED_AGE:
+        return SETTLED_MAX_AGE
+    return RECENT_MAX_AGE
+
+
+def max_age_for_date(date_obj):
+    """Lists of things from a whole day don't change once the day has settled."""
+    if datetime.utcnow() - (date_obj + timedelta(days=1)) > SETTLED_AGE:
+        return IMMUTABLE
+    return RECENT_MAX_AGE
 
 
 def makedirs(path):
@@ -119,78 +170,276 @@ def task_and_retry_ids(job_guid):
     return (slug_id, retry_id)
 
 
-def download_image_artifacts_for_job(project, job, dir_path):
-    print 'Fetching artifact list for job: %d (%s)' % (job['id'], job['job_guid'])
-    (slug_id, retry_id) = task_and_retry_ids(job['job_guid'])
-    artifacts_url = '%s/task/%s/runs/%s/artifacts' % (TC_QUEUE_API, slug_id, retry_id)
-    log.info(artifacts_url)
-    details = fetch_json(artifacts_url)
-
-    job_dir = os.path.join(dir_path, '%s-%s' % (job['platform'], job['id']))
-    makedirs(job_dir)
-
-    session = FuturesSession(max_workers=5)  # TODO
-    request_futures = {}
-    for artifact in details['artifacts']:
-        log.debug('artifact details: %s' % pprint.pformat(artifact))
-        if not artifact['contentType'] == 'image/png' or not artifact['name'].endswith('.png') or 'mozilla-test-fail-' in artifact['name']:
-            continue
-        filepath = os.path.join(job_dir, os.path.basename(artifact['name']))
-        artifact_url = '%s/%s' % (artifacts_url, artifact['name'])
-        future = request_artifact(session, artifact_url, filepath)
-        if future:
-            request_futures[future] = filepath
-
-    for future in cf.as_completed(request_futures, timeout=600):
-        res = future.result()
-        filepath = request_futures[future]
-        handle_artifact_download(res, filepath)
-
-    # Remove any empty directories that we created
-    try:
-        os.rmdir(job_dir)
-    except OSError:
-        return job_dir
-        pass
-
+class FetchManifest(object):
+    """Record of the jobs of a revision directory whose images were all fetched.
+
+    Jobs are keyed by task id and retry so later runs can skip them without
+    listing their artifacts again while still fetching new retries.
+    """
+
+    def __init__(self, rev_dir):
+        self.path = os.path.join(rev_dir, FETCH_MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        self.jobs = self._read()['jobs']
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as manifest_file:
+                return json.load(manifest_file)
+        except (IOError, ValueError):
+            return {'jobs': {}}
+
+    def job(self, key):
+        return self.jobs.get(key)
+
+    def add_job(self, key, job, job_dir, artifacts):
+        with self.lock:
+            # Re-read to keep jobs recorded by other runs in the meantime.
+            manifest = self._read()
+            manifest['jobs'][key] = {
+                'id': job['id'],
+                'platform': job['platform'],
+                'dir': os.path.basename(job_dir),
+                'artifacts': artifacts,
+            }
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=2, separators=(',', ': '), sort_keys=True)
+            os.rename(tmp_path, self.path)
+            self.jobs = manifest['jobs']
+
+
+class Fetcher(object):
+    """Fetches the image artifacts of jobs from any number of resultsets on one bounded thread pool.
+
+    Listing the jobs of a resultset, listing the artifacts of a job and downloading
+    each image are separate tasks, so they overlap across all jobs and resultsets
+    while at most `concurrency` requests are in flight. Tasks never wait for other
+    tasks so the pool can't deadlock.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, job_callback=None, jobs_listed_callback=None):
+        self.executor = cf.ThreadPoolExecutor(max_workers=concurrency)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        http_session.mount('https://', adapter)
+        http_session.mount('http://', adapter)
+        scheduler.set_max_concurrency(concurrency)
+        # Called with the directory of each job once all of its images are downloaded.
+        self.job_callback = job_callback
+        # Called with a revision directory and the directories of all of its jobs before
+        # any of them are fetched.
+        self.jobs_listed_callback = jobs_listed_callback
+        self.job_dirs = []
+        self.errors = 0
+        self.pending = 0
+        # Revision directory -> FetchManifest
+        self.manifests = {}
+        self.condition = threading.Condition()
+
+    def submit(self, fn, *args):
+        with self.condition:
+            self.pending += 1
+        self.executor.submit(self._run, fn, *args)
+
+    def _run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception:
+            log.exception('Error in %s%s' % (fn.__name__, args))
+            with self.condition:
+                self.errors += 1
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def wait(self):
+        """Wait for all tasks, including ones they submitted, and return the job directories with images."""
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+        self.executor.shutdown()
+        return self.job_dirs
+
+    def fetch_resultset(self, args, resultset):
+        self.fetch_resultsets(args, [resultset])
+
+    def fetch_resultsets(self, args, resultsets):
+        """Fetch the jobs of `resultsets`, listing the jobs of up to JOBS_BATCH_SIZE of them per query."""
+        for i in range(0, len(resultsets), JOBS_BATCH_SIZE):
+            self.submit(self._fetch_resultsets, args, resultsets[i:i + JOBS_BATCH_SIZE])
+
+    def _fetch_resultsets(self, args, resultsets):
+        jobs_by_resultset = jobs_for_resultsets(args.project, resultsets, args.job_type_name,
+                                                args.job_type_symbol, args.job_group_symbol)
+        for resultset in resultsets:
+            jobs = jobs_by_resultset[resultset['id']]
+            if not jobs:
+                log.error('No jobs found for resultset: %d' % resultset['id'])
+                with self.condition:
+                    self.errors += 1
+                continue
 
-def request_artifact(session, url, filepath):
-    ''' Returns a future or None '''
-    print 'Requesting %s' % filepath,
-    if os.path.isfile(filepath):
-        print '- Not overwriting existing file'
-        return
-    print
-    return session.get(url)
+            rev_dir = os.path.join(args.project, resultset['revision'])
+            makedirs(rev_dir)
+            manifest = self.manifest(rev_dir)
+            fetched_jobs = [manifest.job('%s/%s' % task_and_retry_ids(job['job_guid'])) for job in jobs]
+            if self.jobs_listed_callback:
+                job_dirs = [os.path.join(rev_dir, fetched['dir'] if fetched else job_dir_name(job))
+                            for job, fetched in zip(jobs, fetched_jobs)]
+                self.jobs_listed_callback(rev_dir, job_dirs)
+            for job, fetched in zip(jobs, fetched_jobs):
+                if not fetched:
+                    self.fetch_job(args.project, job, rev_dir)
+                    continue
+                job_dir = os.path.join(rev_dir, fetched['dir'])
+                if fetched['artifacts'] and not os.path.isdir(job_dir):
+                    # The images were removed since so fetch them again.
+                    self.fetch_job(args.project, job, rev_dir)
+                    continue
+                log.info('Already fetched job: %d (%s)' % (job['id'], job['job_guid']))
+                if fetched['artifacts']:
+                    self._job_finished(job_dir)
+
+    def manifest(self, rev_dir):
+        with self.condition:
+            if rev_dir not in self.manifests:
+                self.manifests[rev_dir] = FetchManifest(rev_dir)
+            return self.manifests[rev_dir]
+
+    def fetch_job(self, project, job, dir_path):
+        self.submit(self._fetch_job, project, job, dir_path)
+
+    def _fetch_job(self, project, job, dir_path):
+        print 'Fetching artifact list for job: %d (%s)' % (job['id'], job['job_guid'])
+        (slug_id, retry_id) = task_and_retry_ids(job['job_guid'])
+        artifacts_url = '%s/task/%s/runs/%s/artifacts' % (TC_QUEUE_API, slug_id, retry_id)
+        log.info(artifacts_url)
+        # Only successful, and therefore completed, runs are fetched so their artifacts won't change.
+        details = fetch_json(artifacts_url, max_age=IMMUTABLE)
+
+        job_dir = os.path.join(dir_path, job_dir_name(job))
+        makedirs(job_dir)
+
+        artifacts = []
+        downloads = []
+        for artifact in details['artifacts']:
+            log.debug('artifact details: %s' % pprint.pformat(artifact))
+            if not artifact['contentType'] == 'image/png' or not artifact['name'].endswith('.png') or 'mozilla-test-fail-' in artifact['name']:
+                continue
+            artifacts.append(artifact['name'])
+            filepath = os.path.join(job_dir, os.path.basename(artifact['name']))
+            if os.path.isfile(filepath):
+                print 'Requesting %s - Not overwriting existing file' % filepath
+                continue
+            downloads.append(('%s/%s' % (artifacts_url, artifact['name']), filepath))
+
+        progress = {
+            'key': '%s/%s' % (slug_id, retry_id),
+            'job': job,
+            'job_dir': job_dir,
+            'artifacts': artifacts,
+            'remaining': len(downloads),
+            'failed': 0,
+        }
+        if not downloads:
+            self._job_fetched(dir_path, progress)
+        for url, filepath in downloads:
+            self.submit(self._download, url, filepath, dir_path, progress)
+
+    def _download(self, url, filepath, rev_dir, progress):
+        downloaded = False
+        try:
+            print 'Requesting %s' % filepath
+            downloaded = handle_artifact_download(scheduler.request('get', url, stream=True, timeout=DOWNLOAD_TIMEOUT), filepath)
+        finally:
+            with self.condition:
+                progress['remaining'] -= 1
+                if not downloaded:
+                    progress['failed'] += 1
+                finished = progress['remaining'] == 0
+            if finished:
+                self._job_fetched(rev_dir, progress)
+
+    def _job_fetched(self, rev_dir, progress):
+        # Only record jobs with all images so that a later run retries the others.
+        complete = not progress['failed']
+        if complete:
+            self.manifest(rev_dir).add_job(progress['key'], progress['job'], progress['job_dir'],
+                                           progress['artifacts'])
+        self._job_finished(progress['job_dir'], complete)
+
+    def _job_finished(self, job_dir, complete=True):
+        # Remove any empty directories that we created
+        try:
+            os.rmdir(job_dir)
+            return
+        except OSError:
+            pass
+        with self.condition:
+            self.job_dirs.append(job_dir)
+        # Jobs missing images would be reported as missing them rather than compared.
+        if self.job_callback and complete:
+            self.job_callback(job_dir)
+
+
+def job_dir_name(job):
+    return '%s-%s' % (job['platform'], job['id'])
 
 
 def handle_artifact_download(image, filepath):
+    """Stream the body of the `image` response into the sha512/ store and link `filepath` to it.
+
+    The body is written in chunks to a temporary file inside the store while its
+    sha512 is computed so memory use doesn't depend on the image size. The file
+    is then renamed into place, or dropped if the store already has the data.
+    Returns whether `filepath` was created.
+    """
+    tmp_path = None
     try:
         image.raise_for_status()
-        sha512sum = sha512(image.content).hexdigest()
+        tmp_dir = os.path.join(HASHED_IMAGE_PATH, HASHED_IMAGE_TMP_DIR)
+        makedirs(tmp_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix='download-')
+        hasher = sha512()
+        with os.fdopen(fd, 'wb') as tmp_file:
+            for chunk in image.iter_content(DOWNLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                tmp_file.write(chunk)
+        sha512sum = hasher.hexdigest()
         print 'Download finished: %s (%s)' % (filepath, sha512sum)
         # Write data if the sha512 doesn't exist
         data_dir = os.path.join(HASHED_IMAGE_PATH, sha512sum[0], sha512sum[1])
         data_path = os.path.join(data_dir, sha512sum)
-        if os.path.isfile(data_path):
-            log.debug('Data file %s already exists' % data_path)
-        else:
-            makedirs(data_dir)
-            file = open(data_path, 'wb')
-            file.write(image.content)
-            file.close()
-
-        # Make a hard link to the data with the image file name
-        os.link(data_path, filepath)
-    except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError) as e:
+        # Keep store_maintenance from removing the data until it's linked.
+        with store_lock(HASHED_IMAGE_PATH):
+            if os.path.isfile(data_path):
+                log.debug('Data file %s already exists' % data_path)
+                os.remove(tmp_path)
+            else:
+                makedirs(data_dir)
+                # Atomic so concurrent downloads of the same data never expose a partial file.
+                os.rename(tmp_path, data_path)
+            tmp_path = None
+
+            # Make a hard link to the data with the image file name
+            os.link(data_path, filepath)
+        return True
+    except (requests.exceptions.RequestException, EnvironmentError) as e:
+        # The body is streamed so it isn't read for the message.
         print 'Download FAILED: %s' % filepath
-        log.error('%s: %s\n\t%s %s' % (filepath, image.content, e.errno, e.strerror))
+        log.error('%s: %s\n\t%s' % (filepath, image.url, e))
+        return False
+    finally:
+        image.close()
+        if tmp_path and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
 
 
 def nightly_revs_for_date(project, date):
     revs_url = '%s/namespaces/gecko.v2.%s.nightly.%s.revision' % (TC_INDEX_API, project, date.replace('-', '.'))
     log.debug(revs_url)
-    result = fetch_json(revs_url, "post")
+    result = fetch_json(revs_url, "post", max_age=max_age_for_date(datetime.strptime(date, '%Y-%m-%d')))
 
     found_revs = set()
     for namespace in result['namespaces']:
@@ -201,30 +450,89 @@ def nightly_revs_for_date(project, date):
     return found_revs
 
 
+def resultsets_for_range(project, start_time, end_time, max_age=RECENT_MAX_AGE):
+    """Return the pushes with a push_timestamp from `start_time` up to `end_time`, newest first.
+
+    The push list has the same details as the push of each ID so no request is
+    needed per push. Pages are followed using the lowest id so that pushes arriving
+    meanwhile don't shift them.
+    """
+    revs_url = '{TH_API}/project/{project}/push/?push_timestamp__gte={start_time}&push_timestamp__lt={end_time}&count={count}'.format(TH_API=TH_API, project=project, start_time=start_time, end_time=end_time, count=PUSH_PAGE_SIZE)
+
+    found_resultset_ids = set()
+    resultsets = []
+    page_url = revs_url
+    while True:
+        log.debug(page_url)
+        result = fetch_json(page_url, max_age=max_age)
+        for resultset in result['results']:
+            result_set_id = resultset['id']
+            if result_set_id not in found_resultset_ids:
+                found_resultset_ids.add(result_set_id)
+                log.debug('Found result_set_id: %s' % (result_set_id,))
+                resultsets.append(resultset)
+        if len(result['results']) < PUSH_PAGE_SIZE:
+            return resultsets
+        page_url = '%s&id__lt=%d' % (revs_url, min(resultset['id'] for resultset in result['results']))
+
+
 def resultsets_for_date(project, date):
     date_obj = datetime.strptime(date, '%Y-%m-%d')
     start_time = date_obj.strftime("%s")
     end_time = (date_obj + timedelta(days=1)).strftime("%s")
-    revs_url = '{TH_API}/project/{project}/push/?push_timestamp__gte={start_time}&push_timestamp__lt={end_time}'.format(TH_API=TH_API, project=project, start_time=start_time, end_time=end_time)
-    log.debug(revs_url)
-    result = fetch_json(revs_url)
+    return resultsets_for_range(project, start_time, end_time, max_age_for_date(date_obj))
+
+
+def use_metadata_cache(path):
+    """Cache fetch_json responses in the directory `path` from now on, or not at all if it's None."""
+    global metadata_cache
+    metadata_cache = MetadataCache(path) if path else None
+    return metadata_cache
+
+
+def fetch_json(url, method="get", max_age=0, cacheable=None):
+    """Fetch JSON from `url` using metadata_cache for `max_age` seconds (or IMMUTABLE for ever).
+
+    Stale entries are revalidated with a conditional request if the server sent an
+    ETag or Last-Modified. `cacheable` is an optional predicate of the response
+    deciding whether to cache it e.g. to avoid caching empty results.
+    """
+    cache = metadata_cache if max_age != 0 else None
+    entry = cache.get(method, url) if cache else None
+    if entry and MetadataCache.is_fresh(entry):
+        log.debug('Cached: %s' % url)
+        return entry['body']
+
+    headers = dict(DEFAULT_REQUEST_HEADERS)
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    response = scheduler.request(method, url, headers=headers, timeout=json_timeout)
+    if entry and response.status_code == 304:
+        log.debug('Not modified: %s' % url)
+        cache.touch(method, url, entry)
+        return entry['body']
+    response.raise_for_status()
+    body = response.json()
+    if cache and (cacheable is None or cacheable(body)):
+        cache.put(method, url, body, max_age,
+                  response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return body
 
-    found_resultset_ids = set()
-    resultsets = []
-    for resultset in result['results']:
-        result_set_id = resultset['id']
-        if result_set_id not in found_resultset_ids:
-            found_resultset_ids.add(result_set_id);
-            log.debug('Found result_set_id: %s' % (result_set_id,))
-            resultsets.append(resultset_response_for_id(project, result_set_id))
 
-    return resultsets
+def print_request_stats():
+    for host, stats in sorted(scheduler.stats().items()):
+        print '%s: %d requests (%d retries, %d throttled, %d failed), %.2fs average, concurrency limit %d' % (
+            host, stats['requests'], stats['retries'], stats['throttled'], stats['failures'],
+            stats['seconds'] / max(1, stats['requests']), stats['limit'])
 
 
-def fetch_json(url, method="get"):
-    response = getattr(requests, method)(url, headers=DEFAULT_REQUEST_HEADERS, timeout=30)
-    response.raise_for_status()
-    return response.json()
+def print_cache_stats(cache):
+    stats = cache.stats()
+    print 'Metadata cache: %s' % cache.cache_dir
+    print '%d entries (%d immutable, %d fresh, %d stale) using %.1f MB' % (
+        stats['entries'], stats['immutable'], stats['fresh'], stats['stale'], stats['bytes'] / 1048576.0)
 
 
 def run(args):
@@ -244,26 +552,18 @@ def run(args):
     elif args.date:
         resultsets = resultsets_for_date(args.project, args.date)
 
-    for resultset in resultsets:
-        run_for_resultset(args, resultset)
-
-
-def run_for_resultset(args, resultset):
-    jobs = jobs_for_resultset(args.project, resultset['id'], args.job_type_name, args.job_type_symbol, args.job_group_symbol)
-    if not jobs:
+    fetcher = Fetcher(getattr(args, 'concurrency', DEFAULT_CONCURRENCY))
+    fetcher.fetch_resultsets(args, resultsets)
+    fetcher.wait()
+    print_request_stats()
+    if fetcher.errors:
         sys.exit(1)
 
-    rev_dir = os.path.join(args.project, resultset['revision'])
-    makedirs(rev_dir)
-
-    job_dirs = []
-    for job in jobs:
-        job_dir = download_image_artifacts_for_job(args.project, job, rev_dir)
-        if not job_dir:
-            continue
-        job_dirs.append(job_dir)
 
-    return job_dirs
+def run_for_resultset(args, resultset):
+    fetcher = Fetcher(getattr(args, 'concurrency', DEFAULT_CONCURRENCY))
+    fetcher.fetch_resultset(args, resultset)
+    return fetcher.wait()
 
 
 def cli():
@@ -276,6 +576,10 @@ def cli():
                           help='Date to fetch screenshots from')
     required.add_argument('-r', '--rev',
                           help='Revision to fetch screenshots from')
+    required.add_argument('--cache-stats', action='store_true',
+                          help='Print statistics about the metadata cache and exit')
+    required.add_argument('--clear-cache', nargs='?', const='all', choices=['all', 'stale'],
+                          help='Remove all (or only stale) metadata cache entries and exit')
 
     parser.add_argument('--job-type-symbol', default='ss',
                         help='Treeherder symbol of the job to fetch from (aka. job_type_symbol) [Default="ss"]')
@@ -284,11 +588,36 @@ def cli():
     parser.add_argument('--job-type-name', default=None,
                         help='Type of job to fetch from (aka. job_type_name e.g. test-windows7-32/opt-browser-screenshots-e10s)')
     parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('-j', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of requests in flight across all jobs and resultsets [Default=%d]' % DEFAULT_CONCURRENCY)
+
+    parser.add_argument('--timeout', type=float, default=DEFAULT_JSON_TIMEOUT,
+                        help='Seconds to wait for each Treeherder and Taskcluster API response [Default=%d]' % DEFAULT_JSON_TIMEOUT)
+    parser.add_argument('--retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help='Times to retry requests failing with a connection error or 429/5xx status [Default=%d]' % DEFAULT_MAX_RETRIES)
+    parser.add_argument('--metadata-cache', default=None, metavar='DIR',
+                        help='Directory to cache Treeherder and Taskcluster responses in [Default=%s in the current directory, '
+                             'next to the fetched screenshots]' % METADATA_CACHE_PATH)
+    parser.add_argument('--no-metadata-cache', action='store_true',
+                        help='Always fetch metadata from the network')
 
     parser.add_argument('--project',
                         help='Project that the revision is from. [Default="mozilla-central" for --nightly, "try" otherwise]')
 
     args = parser.parse_args()
+    global json_timeout
+    json_timeout = args.timeout
+    scheduler.max_retries = args.retries
+    cache = None if args.no_metadata_cache else use_metadata_cache(
+        os.path.abspath(args.metadata_cache or METADATA_CACHE_PATH))
+    if args.cache_stats or args.clear_cache:
+        if not cache:
+            parser.error('--no-metadata-cache can\'t be used with --cache-stats or --clear-cache')
+        if args.clear_cache:
+            print 'Removed %d entries' % cache.clear(stale_only=args.clear_cache == 'stale')
+        print_cache_stats(cache)
+        return
+
     if not args.project:
         args.project = "mozilla-central" if args.nightly or args.date else "try"
     log.setLevel(getattr(logging, args.log_level))
@@ -0,0 +1,176 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Index of perceptual fingerprints of the images in the sha512/ store.
+
+Each blob gets a 64-bit difference hash (dHash) of its greyscale thumbnail
+plus its dimensions, keyed by its sha512. The index also records which image
+files of the revision directories link to each blob so that the pushes which
+produced a visually equivalent image can be found without decoding anything.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+
+import image_diff
+from comparison_cache import file_sha512
+
+DEFAULT_INDEX_PATH = "fingerprints.sqlite"
+DEFAULT_STORE_PATH = "sha512"
+SHA512_FILENAME_RE = re.compile(r'^[0-9a-f]{128}$')
+HASH_WIDTH = 8
+HASH_HEIGHT = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    sha512 TEXT PRIMARY KEY,
+    phash TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fingerprints_phash ON fingerprints (phash, width, height);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    sha512 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_sha512 ON images (sha512);
+"""
+
+
+def compute_fingerprint(pixels):
+    """Return the (phash, width, height) of decoded RGBA `pixels`."""
+    height, width = pixels.shape[:2]
+    thumbnail = Image.fromarray(pixels, "RGBA").convert("L").resize((HASH_WIDTH + 1, HASH_HEIGHT),
+                                                                    Image.LANCZOS)
+    grey = numpy.asarray(thumbnail, dtype=numpy.int16)
+    bits = (grey[:, 1:] > grey[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return ("%016x" % value, width, height)
+
+
+class FingerprintIndex(object):
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, sha512sum):
+        """Return the (phash, width, height) of a blob or None if it isn't indexed."""
+        row = self.connection.execute("SELECT phash, width, height FROM fingerprints WHERE sha512 = ?",
+                                      (sha512sum,)).fetchone()
+        return tuple(row) if row else None
+
+    def add(self, sha512sum, path):
+        """Fingerprint the image at `path`, with content `sha512sum`, if it isn't indexed yet."""
+        existing = self.get(sha512sum)
+        if existing:
+            return existing
+        fingerprint = compute_fingerprint(image_diff.load_png(path))
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                                    (sha512sum,) + fingerprint)
+        return fingerprint
+
+    def update_store(self, store_path):
+        """Fingerprint the blobs of the store which aren't indexed yet and return a map of inodes to them."""
+        known = set(row[0] for row in self.connection.execute("SELECT sha512 FROM fingerprints"))
+        inodes = {}
+        added = 0
+        for dirpath, dirs, files in os.walk(store_path):
+            for filename in files:
+                if not SHA512_FILENAME_RE.match(filename):
+                    continue
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                inodes[(stat.st_dev, stat.st_ino)] = filename
+                if filename in known:
+                    continue
+                try:
+                    self.add(filename, path)
+                except IOError as e:
+                    print("Could not fingerprint {0}: {1}".format(path, e))
+                    continue
+                added += 1
+        print("Fingerprinted {0} new images".format(added))
+        return inodes
+
+    def update_images(self, directory, inodes):
+        """Record which blobs the PNG files of `directory` link to using the inodes from update_store."""
+        rows = []
+        for dirpath, dirs, files in os.walk(directory):
+            for filename in files:
+                if not filename.endswith(".png"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                sha512sum = inodes.get((stat.st_dev, stat.st_ino))
+                if sha512sum:
+                    rows.append((os.path.normpath(path), sha512sum))
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO images VALUES (?, ?)", rows)
+        print("Indexed {0} images in {1}".format(len(rows), directory))
+
+    def equivalent(self, fingerprint):
+        """Return the sha512s of the blobs with the same (phash, width, height)."""
+        return [row[0] for row in self.connection.execute(
+            "SELECT sha512 FROM fingerprints WHERE phash = ? AND width = ? AND height = ?", fingerprint)]
+
+    def paths(self, sha512sums):
+        """Return the image paths linking to any of `sha512sums`, sorted."""
+        paths = []
+        for sha512sum in sha512sums:
+            paths.extend(row[0] for row in self.connection.execute(
+                "SELECT path FROM images WHERE sha512 = ?", (sha512sum,)))
+        return sorted(paths)
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Index perceptual fingerprints of fetched screenshots')
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="Path of the SQLite index [Default=%(default)s]")
+    subparsers = parser.add_subparsers(dest="command")
+
+    update_parser = subparsers.add_parser("update", help="Fingerprint new images in the store")
+    update_parser.add_argument("--store", default=DEFAULT_STORE_PATH,
+                               help="Content-addressed store of fetch_screenshots [Default=%(default)s]")
+    update_parser.add_argument("directories", nargs="*", metavar="DIRECTORY",
+                               help="Revision directories (e.g. mozilla-central/<rev>) to index the images of")
+
+    lookup_parser = subparsers.add_parser("lookup", help="List images visually equivalent to an image")
+    lookup_parser.add_argument("image", help="Image file")
+
+    args = parser.parse_args(args)
+    if not image_diff.available():
+        print("numpy and Pillow are required for fingerprinting")
+        sys.exit(1)
+
+    index = FingerprintIndex(args.index)
+    if args.command == "update":
+        inodes = index.update_store(args.store)
+        for directory in args.directories:
+            index.update_images(directory, inodes)
+    elif args.command == "lookup":
+        fingerprint = index.get(file_sha512(args.image)) or compute_fingerprint(image_diff.load_png(args.image))
+        print("Fingerprint: {0} ({1}x{2})".format(*fingerprint))
+        for path in index.paths(index.equivalent(fingerprint)):
+            print(path)
+    index.close()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""In-process equivalent of `compare -metric AE -fuzz` using numpy and Pillow.
+
+Both images are decoded once and the differing pixel count, the bounds of the
+differences and the highlight composite are all derived from the same mask.
+"""
+
+from __future__ import division
+
+from collections import namedtuple
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+
+# ImageMagick's default -highlight-color (#f1001ecc)
+HIGHLIGHT_COLOR = (241, 0, 30)
+HIGHLIGHT_OPACITY = 0.8
+
+# `regions` is only computed by diff_tiled and is a list of bounds like `bounds`.
+Difference = namedtuple("Difference", "count bounds mask regions")
+
+
+class DimensionMismatch(ValueError):
+    pass
+
+
+def available():
+    return numpy is not None
+
+
+def load_png(path):
+    image = Image.open(path)
+    # Decode now so that a truncated file raises instead of giving a 0-d object array.
+    image.load()
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    return numpy.asarray(image)
+
+
+def crop(pixels, chop):
+    """Return a view of `pixels` without the (top, right, bottom, left) edges of `chop`."""
+    top, right, bottom, left = chop
+    height, width = pixels.shape[:2]
+    return pixels[top:height - bottom, left:width - right]
+
+
+def difference_mask(before, after, fuzz):
+    """Return a boolean array of the pixels which aren't similar within `fuzz` (0-1).
+
+    This follows ImageMagick's IsMagickColorSimilar: the alpha channels are
+    compared first and then the squared RGB distance, weighted by the opacity
+    of both pixels, is compared against three times the squared fuzz.
+    """
+    if before.shape != after.shape:
+        raise DimensionMismatch("image widths or heights differ")
+
+    fuzz_squared = (fuzz * 255) ** 2
+    before_rgb = before[..., :3].astype(numpy.int32)
+    after_rgb = after[..., :3].astype(numpy.int32)
+    distance = numpy.square(before_rgb - after_rgb).sum(axis=2)
+
+    before_alpha = before[..., 3]
+    after_alpha = after[..., 3]
+    if before_alpha.min() == 255 and after_alpha.min() == 255:
+        return distance > 3 * fuzz_squared
+
+    alpha_distance = numpy.square(before_alpha.astype(numpy.float64) - after_alpha)
+    scale = (before_alpha / 255.0) * (after_alpha / 255.0)
+    return ((alpha_distance > fuzz_squared) |
+            ((3 * alpha_distance + scale * distance > 3 * fuzz_squared) & (scale > 1e-12)))
+
+
+def mask_bounds(mask):
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return None
+    columns = numpy.flatnonzero(mask.any(axis=0))
+    return {
+        "top": int(rows[0]),
+        "right": int(columns[-1]),
+        "bottom": int(rows[-1]),
+        "left": int(columns[0]),
+    }
+
+
+def diff(before, after, fuzz):
+    mask = difference_mask(before, after, fuzz)
+    return Difference(int(numpy.count_nonzero(mask)), mask_bounds(mask), mask, None)
+
+
+def changed_tiles(before, after, tile_size):
+    """Return a grid of which `tile_size` square tiles have any byte changed."""
+    height, width = before.shape[:2]
+    # Compare whole RGBA pixels at once by viewing each one as a uint32. Cropping
+    # the sides makes a non-contiguous view which must be copied for that.
+    before = numpy.ascontiguousarray(before)
+    after = numpy.ascontiguousarray(after)
+    changed = (before.view(numpy.uint32)[..., 0] != after.view(numpy.uint32)[..., 0])
+    rows = -(-height // tile_size)
+    columns = -(-width // tile_size)
+    padded = numpy.zeros((rows * tile_size, columns * tile_size), dtype=bool)
+    padded[:height, :width] = changed
+    return padded.reshape(rows, tile_size, columns, tile_size).any(axis=3).any(axis=1)
+
+
+def merge_bounds(bounds_list):
+    return {
+        "top": min(bounds["top"] for bounds in bounds_list),
+        "right": max(bounds["right"] for bounds in bounds_list),
+        "bottom": max(bounds["bottom"] for bounds in bounds_list),
+        "left": min(bounds["left"] for bounds in bounds_list),
+    }
+
+
+def diff_tiled(before, after, fuzz, tile_size):
+    """Like diff but only computing the fuzzed difference for tiles containing changes.
+
+    Adjacent differing tiles are grouped and the bounds of each group are returned
+    as the regions, sorted from the top-left.
+    """
+    if before.shape != after.shape:
+        raise DimensionMismatch("image widths or heights differ")
+
+    mask = numpy.zeros(before.shape[:2], dtype=bool)
+    tile_bounds = {}
+    for row, column in zip(*numpy.nonzero(changed_tiles(before, after, tile_size))):
+        row, column = int(row), int(column)
+        top = row * tile_size
+        left = column * tile_size
+        tile = (slice(top, top + tile_size), slice(left, left + tile_size))
+        tile_mask = difference_mask(before[tile], after[tile], fuzz)
+        bounds = mask_bounds(tile_mask)
+        if not bounds:
+            continue
+        mask[tile] = tile_mask
+        tile_bounds[(row, column)] = {
+            "top": top + bounds["top"],
+            "right": left + bounds["right"],
+            "bottom": top + bounds["bottom"],
+            "left": left + bounds["left"],
+        }
+
+    regions = []
+    unvisited = set(tile_bounds)
+    for start in sorted(tile_bounds):
+        if start not in unvisited:
+            continue
+        unvisited.remove(start)
+        group = [start]
+        for row, column in group:
+            for neighbour in ((row - 1, column), (row + 1, column), (row, column - 1), (row, column + 1)):
+                if neighbour in unvisited:
+                    unvisited.remove(neighbour)
+                    group.append(neighbour)
+        regions.append(merge_bounds([tile_bounds[tile] for tile in group]))
+
+    bounds = merge_bounds(regions) if regions else None
+    return Difference(int(numpy.count_nonzero(mask)), bounds, mask, regions)
+
+
+def composite(before, mask):
+    """Return `before` with the differing pixels highlighted and a transparent lowlight."""
+    pixels = before.copy()
+    pixels[..., 3] = 255
+    highlighted = pixels[mask][:, :3].astype(numpy.float64)
+    highlighted *= 1 - HIGHLIGHT_OPACITY
+    highlighted += numpy.array(HIGHLIGHT_COLOR) * HIGHLIGHT_OPACITY
+    rgb = pixels[..., :3]
+    rgb[mask] = numpy.rint(highlighted).astype(numpy.uint8)
+    return pixels
+
+
+def write_png(path, pixels):
+    Image.fromarray(pixels, "RGBA").save(path, "PNG")
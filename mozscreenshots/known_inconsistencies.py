@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Matching of differing images against the rules of web/known_inconsistencies.json.
+
+Each rule has a `reason`, a `platformRegex`, `nameRegexes` (searched in the
+image name without .png) and the numbers of differing pixels it applies to:
+a `pixelRegex` and/or `pixels`, a list of counts and inclusive [min, max]
+ranges e.g. [8, [80, 90]].
+
+Rules are grouped by platform pattern and the name patterns of each group are
+combined into one regex so that the images which aren't known inconsistencies,
+the vast majority, are rejected with a single search per group. Which rules
+apply to each (platform, image name) is remembered since the same names come up
+in every comparison.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import re
+from collections import OrderedDict
+
+KNOWN_INCONSISTENCIES_PATH = os.path.join(os.path.dirname(__file__), "..", "web", "known_inconsistencies.json")
+# Python 2.7 regexes support at most 100 groups.
+MAX_GROUPS = 99
+# Patterns with backreferences can't be combined since their group numbers would change,
+# nor patterns with named groups since two rules could use the same name, nor patterns
+# with inline flags e.g. (?i) since those apply to the whole combined regex.
+UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)')
+
+
+class KnownInconsistency(object):
+    """One rule of known_inconsistencies.json."""
+
+    def __init__(self, rule, index=0):
+        self.index = index
+        self.reason = rule.get("reason")
+        self.platform_pattern = rule["platformRegex"]
+        self.name_patterns = list(rule["nameRegexes"])
+        self.name_regexes = [re.compile(pattern) for pattern in self.name_patterns]
+        if "pixelRegex" not in rule and "pixels" not in rule:
+            raise ValueError("Known inconsistency {0!r} has neither pixelRegex nor pixels".format(self.reason))
+        self.pixel_regex = re.compile(rule["pixelRegex"]) if "pixelRegex" in rule else None
+        self.pixel_counts = set()
+        self.pixel_ranges = []
+        for pixels in rule.get("pixels", []):
+            if isinstance(pixels, list):
+                self.pixel_ranges.append((pixels[0], pixels[1]))
+            else:
+                self.pixel_counts.add(pixels)
+
+    def matches_name(self, basename):
+        return any(regex.search(basename) for regex in self.name_regexes)
+
+    def matches_difference(self, difference):
+        try:
+            count = int(difference)
+        except (TypeError, ValueError):
+            count = None
+        if count is not None and (count in self.pixel_counts or
+                                  any(low <= count <= high for low, high in self.pixel_ranges)):
+            return True
+        return self.pixel_regex is not None and self.pixel_regex.search(str(difference)) is not None
+
+
+def combine_patterns(patterns):
+    """Return regexes which together search for any of `patterns`, as few as the group limit allows."""
+    regexes = []
+    chunk = []
+    chunk_groups = 0
+    for pattern in patterns:
+        groups = re.compile(pattern).groups
+        if UNCOMBINABLE_RE.search(pattern) or groups > MAX_GROUPS:
+            regexes.append(re.compile(pattern))
+            continue
+        if chunk and chunk_groups + groups > MAX_GROUPS:
+            regexes.append(re.compile("|".join(chunk)))
+            chunk = []
+            chunk_groups = 0
+        chunk.append("(?:{0})".format(pattern))
+        chunk_groups += groups
+    if chunk:
+        regexes.append(re.compile("|".join(chunk)))
+    return regexes
+
+
+class PlatformGroup(object):
+    """The rules sharing a platform pattern, with their name patterns combined."""
+
+    def __init__(self, platform_pattern):
+        self.platform_regex = re.compile(platform_pattern)
+        self.rules = []
+        self.name_regexes = None
+
+    def compile(self):
+        patterns = OrderedDict((pattern, None) for rule in self.rules for pattern in rule.name_patterns)
+        self.name_regexes = combine_patterns(patterns)
+
+    def rules_for_name(self, basename):
+        if not any(regex.search(basename) for regex in self.name_regexes):
+            return []
+        return [rule for rule in self.rules if rule.matches_name(basename)]
+
+
+class KnownInconsistencies(object):
+    def __init__(self, rules):
+        self.rules = [KnownInconsistency(rule, index) for index, rule in enumerate(rules)]
+        self.groups = OrderedDict()
+        for rule in self.rules:
+            group = self.groups.get(rule.platform_pattern)
+            if group is None:
+                group = self.groups[rule.platform_pattern] = PlatformGroup(rule.platform_pattern)
+            group.rules.append(rule)
+        for group in self.groups.values():
+            group.compile()
+        self._platform_groups = {}
+        self._name_rules = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def rules_for(self, platform, basename):
+        """Return the rules applying to an image name on a platform whatever the difference."""
+        key = (platform, basename)
+        rules = self._name_rules.get(key)
+        if rules is None:
+            groups = self._platform_groups.get(platform)
+            if groups is None:
+                groups = self._platform_groups[platform] = [group for group in self.groups.values()
+                                                            if group.platform_regex.search(platform)]
+            rules = sorted((rule for group in groups for rule in group.rules_for_name(basename)),
+                           key=lambda rule: rule.index)
+            self._name_rules[key] = rules
+        return rules
+
+    def match(self, platform, basename, difference):
+        """Return the first rule of the file matching a DIFFERENT image or None."""
+        for rule in self.rules_for(platform, basename):
+            if rule.matches_difference(difference):
+                return rule
+        return None
+
+
+def load(path=KNOWN_INCONSISTENCIES_PATH):
+    with open(path, 'r') as ki_file:
+        return KnownInconsistencies(json.load(ki_file))
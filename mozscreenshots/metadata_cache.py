@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Persistent cache of JSON responses from Treeherder and Taskcluster.
+
+Entries are laid out like the sha512/ store: <cache_dir>/<k0>/<k1>/<key>.json
+where the key is the sha1 of the method and URL. Each entry has the time it was
+fetched and how long it's fresh for (None meaning that it never changes) as well
+as any validators for conditional requests once it's stale.
+"""
+
+import errno
+import json
+import os
+import shutil
+import tempfile
+import time
+from hashlib import sha1
+
+# max_age for responses which never change
+IMMUTABLE = None
+
+
+class MetadataCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, method, url):
+        key = sha1(method.lower() + " " + url).hexdigest()
+        return os.path.join(self.cache_dir, key[0], key[1], key + ".json")
+
+    def get(self, method, url):
+        """Return the entry for the request, fresh or not, or None."""
+        try:
+            with open(self._path(method, url), 'r') as entry_file:
+                return json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def is_fresh(entry, now=None):
+        if entry["max_age"] is IMMUTABLE:
+            return True
+        return (now or time.time()) < entry["fetched"] + entry["max_age"]
+
+    def put(self, method, url, body, max_age, etag=None, last_modified=None):
+        entry_path = self._path(method, url)
+        entry_dir = os.path.dirname(entry_path)
+        try:
+            os.makedirs(entry_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write to a temporary file and rename so readers never see partial entries.
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as entry_file:
+            json.dump({
+                "method": method,
+                "url": url,
+                "fetched": time.time(),
+                "max_age": max_age,
+                "etag": etag,
+                "last_modified": last_modified,
+                "body": body,
+            }, entry_file)
+        os.rename(tmp_path, entry_path)
+
+    def touch(self, method, url, entry):
+        """Mark a stale entry as fresh again after a 304 Not Modified."""
+        self.put(method, url, entry["body"], entry["max_age"], entry["etag"], entry["last_modified"])
+
+    def entries(self):
+        for dirpath, dirs, files in os.walk(self.cache_dir):
+            for filename in files:
+                if filename.endswith(".json"):
+                    yield os.path.join(dirpath, filename)
+
+    def stats(self):
+        stats = {"entries": 0, "immutable": 0, "fresh": 0, "stale": 0, "bytes": 0}
+        now = time.time()
+        for path in self.entries():
+            try:
+                with open(path, 'r') as entry_file:
+                    entry = json.load(entry_file)
+            except (IOError, ValueError):
+                continue
+            stats["entries"] += 1
+            stats["bytes"] += os.path.getsize(path)
+            if entry["max_age"] is IMMUTABLE:
+                stats["immutable"] += 1
+            elif self.is_fresh(entry, now):
+                stats["fresh"] += 1
+            else:
+                stats["stale"] += 1
+        return stats
+
+    def clear(self, stale_only=False):
+        """Remove all entries, or only the stale ones, and return how many were removed."""
+        if not stale_only:
+            count = sum(1 for path in self.entries())
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            return count
+
+        count = 0
+        now = time.time()
+        for path in list(self.entries()):
+            try:
+                with open(path, 'r') as entry_file:
+                    entry = json.load(entry_file)
+            except (IOError, ValueError):
+                entry = None
+            if entry is None or not self.is_fresh(entry, now):
+                os.remove(path)
+                count += 1
+        return count
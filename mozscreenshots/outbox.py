@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Persistent queue of email messages delivered in order over one SMTP connection.
+
+Each queued message is a JSON file named by its sequence number. Messages get
+strictly increasing Date headers and are threaded (In-Reply-To and References)
+with the previous messages of the same thread e.g. project, so mail clients show
+them in order no matter how quickly they're delivered. A message which can't be
+delivered stops delivery so that later ones don't overtake it and is retried the
+next time.
+"""
+
+from __future__ import print_function
+
+import email.utils
+import errno
+import fcntl
+import json
+import os
+import smtplib
+import socket
+import tempfile
+import time
+from contextlib import contextmanager
+
+DEFAULT_SMTP_HOST = "localhost"
+DEFAULT_MAX_RETRIES = 3
+RETRY_DELAY = 5
+STATE_FILENAME = "state.json"
+LOCK_FILENAME = ".lock"
+# Directory of the outbox for messages which were permanently rejected
+FAILED_DIRNAME = "failed"
+# Message-IDs to keep in References: the first of the thread and the most recent ones
+MAX_REFERENCES = 10
+
+
+def is_rejection(error):
+    """Return whether the SMTP `error` is a permanent (5xx) rejection of the message itself."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    # Errors greeting the server are about the connection rather than the message.
+    if isinstance(error, (smtplib.SMTPConnectError, smtplib.SMTPHeloError)):
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+
+class Outbox(object):
+    def __init__(self, path, host=DEFAULT_SMTP_HOST, local_hostname=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.path = path
+        self.host = host
+        self.local_hostname = local_hostname
+        self.max_retries = max_retries
+        try:
+            os.makedirs(os.path.join(path, FAILED_DIRNAME))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.path, LOCK_FILENAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_json(self, path, data):
+        # Write to a temporary file and rename so a crash never leaves a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, 'w') as json_file:
+            json.dump(data, json_file, indent=2, separators=(',', ': '), sort_keys=True)
+        os.rename(tmp_path, path)
+
+    def _read_state(self):
+        try:
+            with open(os.path.join(self.path, STATE_FILENAME), 'r') as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError):
+            return {"sequence": 0, "last_date": 0, "threads": {}}
+
+    def enqueue(self, thread, msg, to_addrs):
+        """Queue `msg` after all the queued messages, as a reply to the previous one of `thread`."""
+        with self._locked():
+            state = self._read_state()
+            date = max(time.time(), state["last_date"] + 1)
+            msg["Date"] = email.utils.formatdate(date, localtime=True)
+            references = state["threads"].get(thread, [])
+            if references:
+                msg["In-Reply-To"] = references[-1]
+                msg["References"] = " ".join(references)
+            references = references + [msg["Message-ID"]]
+            state["threads"][thread] = references[:1] + references[1:][-(MAX_REFERENCES - 1):]
+            state["sequence"] += 1
+            state["last_date"] = date
+
+            self._write_json(os.path.join(self.path, "%010d.json" % state["sequence"]), {
+                "thread": thread,
+                "from": msg["From"],
+                "to": to_addrs,
+                "message": msg.as_string(),
+            })
+            self._write_json(os.path.join(self.path, STATE_FILENAME), state)
+
+    def pending(self):
+        """Return the paths of the queued messages in order."""
+        return sorted(os.path.join(self.path, filename) for filename in os.listdir(self.path)
+                      if filename.endswith(".json") and filename != STATE_FILENAME)
+
+    def deliver(self):
+        """Send the queued messages in order over one connection and return how many were sent."""
+        sent = 0
+        connection = None
+        with self._locked():
+            try:
+                for path in self.pending():
+                    with open(path, 'r') as message_file:
+                        message = json.load(message_file)
+                    attempt = 0
+                    while True:
+                        try:
+                            if connection is None:
+                                connection = smtplib.SMTP(self.host, None, self.local_hostname)
+                            connection.sendmail(message["from"], message["to"], message["message"])
+                            break
+                        except (smtplib.SMTPException, socket.error) as e:
+                            if is_rejection(e):
+                                # Retrying won't help so set it aside rather than holding up the others.
+                                print("Message {0} was rejected: {1}".format(os.path.basename(path), e))
+                                os.rename(path, os.path.join(self.path, FAILED_DIRNAME, os.path.basename(path)))
+                                break
+                            print("Error delivering message {0}: {1}".format(os.path.basename(path), e))
+                            if connection is not None:
+                                try:
+                                    connection.close()
+                                except socket.error:
+                                    pass
+                                connection = None
+                            attempt += 1
+                            if attempt > self.max_retries:
+                                return sent
+                            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+                    if os.path.exists(path):
+                        os.remove(path)
+                        sent += 1
+            finally:
+                if connection is not None:
+                    try:
+                        connection.quit()
+                    except (smtplib.SMTPException, socket.error):
+                        pass
+        return sent
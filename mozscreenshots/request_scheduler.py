@@ -0,0 +1,150 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Retrying HTTP requests with an adaptive concurrency limit per host.
+
+Each host starts at the maximum concurrency. When it responds with 429 or 503
+its limit is halved (at most once per THROTTLE_INTERVAL so that one overload
+doesn't collapse it) and each successful response grows it back by about one
+request per round trip. Failed requests are retried after a jittered
+exponential backoff, or after the Retry-After the server asked for.
+"""
+
+import random
+import threading
+import time
+
+import requests
+from requests.compat import urlparse
+
+# Statuses worth retrying and the subset that means the host is overloaded.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+THROTTLE_STATUSES = frozenset([429, 503])
+THROTTLE_INTERVAL = 1.0
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+class HostLimiter(object):
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.last_throttled = 0
+        self.condition = threading.Condition()
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "failures": 0,
+            "seconds": 0.0,
+        }
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, seconds, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            self.stats["requests"] += 1
+            self.stats["seconds"] += seconds
+            now = time.time()
+            if throttled:
+                self.stats["throttled"] += 1
+                if now - self.last_throttled > THROTTLE_INTERVAL:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_throttled = now
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def set_max_concurrency(self, max_concurrency):
+        with self.condition:
+            self.max_concurrency = max_concurrency
+            self.limit = min(self.limit, float(max_concurrency))
+            self.condition.notify_all()
+
+
+class RequestScheduler(object):
+    def __init__(self, session, max_concurrency, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.session = session
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, host):
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(self.max_concurrency)
+            return self.limiters[host]
+
+    def set_max_concurrency(self, max_concurrency):
+        with self.lock:
+            self.max_concurrency = max_concurrency
+            limiters = list(self.limiters.values())
+        for limiter in limiters:
+            limiter.set_max_concurrency(max_concurrency)
+
+    def delay(self, attempt, response=None):
+        """Return the seconds to wait before retry number `attempt` (from 1)."""
+        if response is not None:
+            try:
+                return min(MAX_BACKOFF, float(response.headers.get("Retry-After")))
+            except (TypeError, ValueError):
+                pass
+        # "Full jitter" so that clients which failed together don't retry together.
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        """Make the request with the session, retrying connection errors, timeouts and RETRY_STATUSES.
+
+        The response of the last attempt is returned even if it has an error status.
+        Only the request, not the reading of a streamed body, counts toward the limit.
+        """
+        limiter = self.limiter(urlparse(url).netloc)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            start = time.time()
+            try:
+                response = getattr(self.session, method)(url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                limiter.release(time.time() - start, throttled=True)
+                if attempt >= self.max_retries:
+                    with limiter.condition:
+                        limiter.stats["failures"] += 1
+                    raise
+                response = None
+            else:
+                limiter.release(time.time() - start, throttled=response.status_code in THROTTLE_STATUSES)
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                if attempt >= self.max_retries:
+                    with limiter.condition:
+                        limiter.stats["failures"] += 1
+                    return response
+                response.close()
+
+            attempt += 1
+            with limiter.condition:
+                limiter.stats["retries"] += 1
+            time.sleep(self.delay(attempt, response))
+
+    def stats(self):
+        """Return a dict of each host to its request statistics and current concurrency limit."""
+        with self.lock:
+            limiters = dict(self.limiters)
+        stats = {}
+        for host, limiter in limiters.items():
+            with limiter.condition:
+                host_stats = dict(limiter.stats)
+                host_stats["limit"] = int(limiter.limit)
+            stats[host] = host_stats
+        return stats
@@ -0,0 +1,262 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""SQLite index of the results of all the directory comparisons.
+
+compare_dirs records each platform's comparison.json here when given a
+results index (--results-index) and `backfill` adds the comparisons of an
+existing archive. Comparisons of pushes, i.e. written to
+comparisons/<project>/<rev>/<project>/<rev>/<platform>/, also record the pair
+of pushes so the history of an image across pushes can be queried along with
+how often it differs and which known inconsistency rules still match anything.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import sys
+
+import comparison_common
+import known_inconsistencies
+from comparison_cache import file_sha512
+
+DEFAULT_INDEX_PATH = "results.sqlite"
+COMPARISON_PATH_RE = re.compile(r'(?:^|/)comparisons/([^/]+)/([0-9a-f]{12,40})/([^/]+)/([0-9a-f]{12,40})/([^/]+)$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS comparisons (
+    id INTEGER PRIMARY KEY,
+    outdir TEXT UNIQUE NOT NULL,
+    old_project TEXT,
+    old_rev TEXT,
+    new_project TEXT,
+    new_rev TEXT,
+    platform TEXT NOT NULL,
+    compared REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comparisons_pair ON comparisons (old_project, old_rev, new_project, new_rev);
+CREATE INDEX IF NOT EXISTS comparisons_platform ON comparisons (platform, compared);
+CREATE TABLE IF NOT EXISTS results (
+    comparison_id INTEGER NOT NULL REFERENCES comparisons (id),
+    image TEXT NOT NULL,
+    result INTEGER NOT NULL,
+    difference INTEGER,
+    bounds TEXT,
+    before_sha512 TEXT,
+    after_sha512 TEXT,
+    PRIMARY KEY (comparison_id, image)
+);
+CREATE INDEX IF NOT EXISTS results_image ON results (image, result);
+CREATE INDEX IF NOT EXISTS results_result ON results (result);
+"""
+
+
+def parse_difference(difference):
+    try:
+        return int(difference)
+    except (TypeError, ValueError):
+        return None
+
+
+def image_sha512(images, suffix):
+    """Return the sha512 of the image with `suffix` or None if there is no such image anymore."""
+    path = images.get(suffix)
+    if not path:
+        return None
+    try:
+        return file_sha512(path)
+    except (IOError, OSError):
+        return None
+
+
+class ResultsIndex(object):
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def compared(self, outdir):
+        """Return when the comparison in `outdir` was indexed or None if it wasn't."""
+        row = self.connection.execute("SELECT compared FROM comparisons WHERE outdir = ?",
+                                      (os.path.abspath(outdir),)).fetchone()
+        return row[0] if row else None
+
+    def add(self, outdir, results, before_images, after_images, compared):
+        """Record the `results` of a comparison.json, replacing any previous ones for `outdir`.
+
+        `before_images` and `after_images` map image suffixes to the compared files
+        to record their content hashes.
+        """
+        outdir = os.path.abspath(outdir)
+        match = COMPARISON_PATH_RE.search(outdir)
+        pair = match.groups()[:4] if match else (None, None, None, None)
+        rows = []
+        for image, output in sorted(results.items()):
+            bounds = output.get("difference_bounds")
+            rows.append((image, output["result"], parse_difference(output.get("difference")),
+                         json.dumps(bounds, sort_keys=True) if bounds else None,
+                         image_sha512(before_images, image), image_sha512(after_images, image)))
+
+        with self.connection:
+            existing = self.connection.execute("SELECT id FROM comparisons WHERE outdir = ?", (outdir,)).fetchone()
+            if existing:
+                self.connection.execute("DELETE FROM results WHERE comparison_id = ?", existing)
+                self.connection.execute("DELETE FROM comparisons WHERE id = ?", existing)
+            comparison_id = self.connection.execute(
+                "INSERT INTO comparisons (outdir, old_project, old_rev, new_project, new_rev, platform, compared) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (outdir,) + pair + (os.path.basename(outdir), compared)).lastrowid
+            self.connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [(comparison_id,) + row for row in rows])
+
+    def history(self, image, platform=None, project=None, limit=None):
+        """Return the results of `image`, most recent first."""
+        query = ("SELECT c.compared, c.old_project, c.old_rev, c.new_project, c.new_rev, c.platform, "
+                 "r.result, r.difference FROM results r JOIN comparisons c ON c.id = r.comparison_id "
+                 "WHERE r.image = ?")
+        params = [image]
+        if platform:
+            query += " AND c.platform = ?"
+            params.append(platform)
+        if project:
+            query += " AND c.new_project = ?"
+            params.append(project)
+        query += " ORDER BY c.compared DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.connection.execute(query, params).fetchall()
+
+    def flaky(self, platform=None, min_comparisons=1, limit=None):
+        """Return (platform, image, comparisons, differences, distinct differences, min, max) by difference rate."""
+        query = ("SELECT c.platform, r.image, COUNT(*) AS total, SUM(r.result = ?) AS different, "
+                 "COUNT(DISTINCT CASE WHEN r.result = ? THEN r.difference END), "
+                 "MIN(CASE WHEN r.result = ? THEN r.difference END), MAX(CASE WHEN r.result = ? THEN r.difference END) "
+                 "FROM results r JOIN comparisons c ON c.id = r.comparison_id")
+        params = [comparison_common.ComparisonResult.DIFFERENT] * 4
+        if platform:
+            query += " WHERE c.platform = ?"
+            params.append(platform)
+        query += (" GROUP BY c.platform, r.image HAVING total >= ? AND different > 0"
+                  " ORDER BY CAST(different AS REAL) / total DESC, total DESC")
+        params.append(min_comparisons)
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.connection.execute(query, params).fetchall()
+
+    def rule_matches(self, rules):
+        """Return, for each rule of a KnownInconsistencies, the number of differences it matches and the last time."""
+        matches = [[0, None] for rule in rules.rules]
+        query = ("SELECT c.platform, r.image, r.difference, c.compared FROM results r "
+                 "JOIN comparisons c ON c.id = r.comparison_id WHERE r.result = ?")
+        for platform, image, difference, compared in self.connection.execute(
+                query, (comparison_common.ComparisonResult.DIFFERENT,)):
+            for rule in rules.rules_for(platform, re.sub(r'\.png$', '', image)):
+                if rule.matches_difference(difference):
+                    matches[rule.index][0] += 1
+                    matches[rule.index][1] = max(matches[rule.index][1], compared)
+        return matches
+
+    def backfill(self, archive, force=False):
+        """Index the comparison.json files of ARCHIVE/comparisons which aren't indexed yet.
+
+        Returns the number of comparisons added.
+        """
+        added = 0
+        revision_indexes = {}
+        for dirpath, dirs, files in os.walk(os.path.join(archive, "comparisons")):
+            dirs.sort()
+            if "comparison.json" not in files:
+                continue
+            json_path = os.path.join(dirpath, "comparison.json")
+            mtime = os.stat(json_path).st_mtime
+            indexed = self.compared(dirpath)
+            if indexed is not None and indexed >= mtime and not force:
+                continue
+            try:
+                with open(json_path, 'r') as json_file:
+                    results = json.load(json_file)
+            except ValueError as e:
+                print("Skipping {0}: {1}".format(json_path, e))
+                continue
+
+            images = ({}, {})
+            match = COMPARISON_PATH_RE.search(os.path.abspath(dirpath))
+            if match:
+                old_project, old_rev, new_project, new_rev, platform = match.groups()
+                for side, (project, rev) in enumerate([(old_project, old_rev), (new_project, new_rev)]):
+                    rev_dir = os.path.join(archive, project, rev)
+                    if rev_dir not in revision_indexes:
+                        revision_indexes[rev_dir] = (comparison_common.index_dir(rev_dir)
+                                                     if os.path.isdir(rev_dir) else None)
+                    if revision_indexes[rev_dir] is not None:
+                        subdir = comparison_common.matching_subdir(revision_indexes[rev_dir], platform)[1]
+                        if subdir is not None:
+                            images[side].update(subdir.images)
+            self.add(dirpath, results, images[0], images[1], mtime)
+            added += 1
+        return added
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M") if timestamp else "never"
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Index and query the results of screenshot comparisons')
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="Path of the SQLite index [Default=%(default)s]")
+    subparsers = parser.add_subparsers(dest="command")
+
+    backfill_parser = subparsers.add_parser("backfill", help="Index the comparisons of an archive which aren't indexed yet")
+    backfill_parser.add_argument("archive", nargs="?", default=".",
+                                 help="Directory containing comparisons/ and the <project>/<rev> directories [Default=current directory]")
+    backfill_parser.add_argument("--force", action="store_true", help="Index every comparison again")
+
+    history_parser = subparsers.add_parser("history", help="List the results of an image, most recent first")
+    history_parser.add_argument("image", help="Image suffix e.g. browserWindow_01_normal.png")
+    history_parser.add_argument("--platform", default=None, help="Only this platform e.g. linux64")
+    history_parser.add_argument("--project", default=None, help="Only comparisons of pushes to this project")
+    history_parser.add_argument("--limit", type=int, default=50, help="[Default=%(default)s]")
+
+    flaky_parser = subparsers.add_parser("flaky", help="List the images which differ most often")
+    flaky_parser.add_argument("--platform", default=None, help="Only this platform e.g. linux64")
+    flaky_parser.add_argument("--min-comparisons", type=int, default=5, metavar="N",
+                              help="Only images compared at least N times [Default=%(default)s]")
+    flaky_parser.add_argument("--limit", type=int, default=50, help="[Default=%(default)s]")
+
+    rules_parser = subparsers.add_parser("rules", help="Count the differences matched by each known inconsistency")
+    rules_parser.add_argument("--known-inconsistencies", default=known_inconsistencies.KNOWN_INCONSISTENCIES_PATH,
+                              metavar="PATH", help="[Default=web/known_inconsistencies.json]")
+
+    args = parser.parse_args(args)
+    index = ResultsIndex(args.index)
+    if args.command == "backfill":
+        print("Indexed {0} comparisons".format(index.backfill(args.archive, args.force)))
+    elif args.command == "history":
+        for row in index.history(args.image, args.platform, args.project, args.limit):
+            compared, old_project, old_rev, new_project, new_rev, platform, result, difference = row
+            pair = "{0}/{1}..{2}/{3}".format(old_project, old_rev[:12], new_project, new_rev[:12]) if old_rev else "-"
+            print(format_time(compared), pair, platform, comparison_common.comparisonResultNames[result],
+                  "" if difference is None else difference)
+    elif args.command == "flaky":
+        print("PLATFORM IMAGE DIFFERENT/COMPARED DISTINCT_DIFFERENCES MIN MAX")
+        for platform, image, total, different, distinct, minimum, maximum in index.flaky(
+                args.platform, args.min_comparisons, args.limit):
+            print(platform, image, "{0}/{1}".format(different, total), distinct, minimum, maximum)
+    elif args.command == "rules":
+        rules = known_inconsistencies.load(args.known_inconsistencies)
+        for rule, (count, last) in zip(rules.rules, index.rule_matches(rules)):
+            print("{0:6d} last matched {1}: {2}".format(count, format_time(last), rule.reason))
+    index.close()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,275 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Garbage collection and disk budgeting of the sha512/ store of fetch_screenshots.
+
+Image files of revision directories (<project>/<rev>/<platform>-<job>/) are
+hard links to the blobs of the store so a blob with a link count of one isn't
+referenced by any revision anymore. fetch_screenshots holds the store lock
+shared while linking to blobs and blobs are only removed while holding it
+exclusively, after checking the link count again, so this is safe to run
+during fetches. Blobs and downloads more recent than the grace period are
+never removed either.
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+
+DEFAULT_STORE_PATH = "sha512"
+# Directory of the store with downloads in progress
+STORE_TMP_DIR = "tmp"
+LOCK_FILENAME = ".lock"
+STATS_FILENAME = "stats.json"
+SHA512_FILENAME_RE = re.compile(r'^[0-9a-f]{128}$')
+REVISION_RE = re.compile(r'^[0-9a-f]{12,40}$')
+DEFAULT_GRACE_SECONDS = 60 * 60
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+# `links` maps the inode of each image to [blob size, link count, links in the revision].
+Revision = namedtuple("Revision", "path fetched used links")
+
+
+@contextmanager
+def store_lock(store_path, shared=True):
+    """Hold the store lock: shared to link to blobs and exclusive to remove them."""
+    try:
+        os.makedirs(store_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with open(os.path.join(store_path, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def parse_size(size):
+    """Parse a number of bytes with an optional K, M, G or T suffix e.g. 50G."""
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    for suffix in ("T", "G", "M", "K"):
+        if abs(size) >= SIZE_SUFFIXES[suffix]:
+            return "%.1f%sB" % (size / float(SIZE_SUFFIXES[suffix]), suffix)
+    return "%dB" % size
+
+
+def blobs(store_path):
+    """Yield the (path, stat) of each blob of the store."""
+    for dirpath, dirs, files in os.walk(store_path):
+        if dirpath == store_path and STORE_TMP_DIR in dirs:
+            dirs.remove(STORE_TMP_DIR)
+        for filename in files:
+            if not SHA512_FILENAME_RE.match(filename):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                yield (path, os.stat(path))
+            except OSError:
+                # Removed since it was listed
+                continue
+
+
+def store_stats(store_path):
+    """Return the blob count and sizes of the store and how much deduplication saves."""
+    stats = {
+        "blobs": 0,
+        "unreferenced_blobs": 0,
+        "links": 0,
+        "bytes": 0,
+        "unreferenced_bytes": 0,
+        # Size of all the image files if they weren't hard links to the same blobs
+        "linked_bytes": 0,
+    }
+    for path, stat in blobs(store_path):
+        links = stat.st_nlink - 1
+        stats["blobs"] += 1
+        stats["bytes"] += stat.st_size
+        stats["links"] += links
+        stats["linked_bytes"] += stat.st_size * links
+        if links == 0:
+            stats["unreferenced_blobs"] += 1
+            stats["unreferenced_bytes"] += stat.st_size
+    referenced_bytes = stats["bytes"] - stats["unreferenced_bytes"]
+    stats["dedup_ratio"] = round(stats["linked_bytes"] / float(referenced_bytes), 2) if referenced_bytes else None
+    stats["bytes_saved"] = stats["linked_bytes"] - referenced_bytes
+    stats["time"] = int(time.time())
+    return stats
+
+
+def write_stats(store_path, stats):
+    fd, tmp_path = tempfile.mkstemp(dir=store_path, suffix=".tmp")
+    with os.fdopen(fd, 'w') as stats_file:
+        json.dump(stats, stats_file, indent=2, separators=(',', ': '), sort_keys=True)
+    os.rename(tmp_path, os.path.join(store_path, STATS_FILENAME))
+
+
+def print_stats(stats):
+    print("{0} blobs ({1}) with {2} links ({3}), dedup ratio {4}, {5} saved".format(
+        stats["blobs"], format_size(stats["bytes"]), stats["links"], format_size(stats["linked_bytes"]),
+        stats["dedup_ratio"], format_size(stats["bytes_saved"])))
+    print("{0} unreferenced blobs ({1})".format(stats["unreferenced_blobs"], format_size(stats["unreferenced_bytes"])))
+
+
+def collect_garbage(store_path, grace=DEFAULT_GRACE_SECONDS, dry_run=False):
+    """Remove unreferenced blobs and abandoned downloads older than `grace` seconds.
+
+    Returns the number of files removed and their total size.
+    """
+    now = time.time()
+    candidates = [path for path, stat in blobs(store_path)
+                  if stat.st_nlink == 1 and now - stat.st_mtime > grace]
+    tmp_dir = os.path.join(store_path, STORE_TMP_DIR)
+    if os.path.isdir(tmp_dir):
+        candidates.extend(os.path.join(tmp_dir, filename) for filename in os.listdir(tmp_dir))
+
+    removed = 0
+    freed = 0
+    with store_lock(store_path, shared=False):
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # A fetch may have linked to the blob, or still be writing the download, since it was listed.
+            if stat.st_nlink != 1 or now - stat.st_mtime <= grace:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed += 1
+            freed += stat.st_size
+    return (removed, freed)
+
+
+def revisions(archive_path):
+    """Yield a Revision for each <project>/<rev> directory of the archive."""
+    for project in sorted(os.listdir(archive_path)):
+        project_path = os.path.join(archive_path, project)
+        if not os.path.isdir(project_path):
+            continue
+        for rev in sorted(os.listdir(project_path)):
+            rev_path = os.path.join(project_path, rev)
+            if not REVISION_RE.match(rev) or not os.path.isdir(rev_path):
+                continue
+            fetched = os.stat(rev_path).st_mtime
+            used = fetched
+            links = {}
+            for dirpath, dirs, files in os.walk(rev_path):
+                fetched = max(fetched, os.stat(dirpath).st_mtime)
+                for filename in files:
+                    if not filename.endswith(".png"):
+                        continue
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    used = max(used, stat.st_atime)
+                    inode = (stat.st_dev, stat.st_ino)
+                    if inode in links:
+                        links[inode][2] += 1
+                    else:
+                        links[inode] = [stat.st_size, stat.st_nlink, 1]
+            yield Revision(rev_path, fetched, max(used, fetched), links)
+
+
+def plan_prune(revisions, store_bytes, max_age=None, budget=None, policy="age",
+               grace=DEFAULT_GRACE_SECONDS):
+    """Return the revisions to remove and the size of the store once garbage is collected after.
+
+    Revisions are removed from the least recently fetched (age policy) or used
+    (lru policy) while they're older than `max_age` seconds or the store is
+    larger than `budget` bytes. `store_bytes` is the size of the referenced blobs.
+    """
+    now = time.time()
+    key = (lambda revision: revision.fetched) if policy == "age" else (lambda revision: revision.used)
+    removed_links = defaultdict(int)
+    to_remove = []
+    for revision in sorted(revisions, key=key):
+        too_old = max_age is not None and now - key(revision) > max_age
+        over_budget = budget is not None and store_bytes > budget
+        if not (too_old or over_budget):
+            break
+        if now - key(revision) <= grace:
+            # May still be fetching
+            continue
+        to_remove.append(revision)
+        for inode, (size, nlink, count) in revision.links.items():
+            removed_links[inode] += count
+            if nlink - 1 - removed_links[inode] == 0:
+                store_bytes -= size
+    return (to_remove, store_bytes)
+
+
+def cli(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Collect garbage and enforce a disk budget for the sha512 store')
+    parser.add_argument("--store", default=DEFAULT_STORE_PATH,
+                        help="Content-addressed store of fetch_screenshots [Default=%(default)s]")
+    parser.add_argument("--archive", default=".",
+                        help="Directory containing the <project>/<rev> directories [Default=current directory]")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("stats", help="Print and record statistics of the store")
+
+    gc_parser = subparsers.add_parser("gc", help="Remove blobs which no revision links to")
+    prune_parser = subparsers.add_parser("prune", help="Remove revisions by age or to stay under a budget, then collect garbage")
+    prune_parser.add_argument("--max-age", type=float, default=None, metavar="DAYS",
+                              help="Remove revisions older than this")
+    prune_parser.add_argument("--budget", type=parse_size, default=None, metavar="SIZE",
+                              help="Remove revisions until the store is at most this size e.g. 50G")
+    prune_parser.add_argument("--policy", choices=["age", "lru"], default="age",
+                              help="Remove the least recently fetched (age) or viewed (lru) revisions first [Default=%(default)s]")
+    for subparser in (gc_parser, prune_parser):
+        subparser.add_argument("--grace", type=int, default=DEFAULT_GRACE_SECONDS, metavar="SECONDS",
+                               help="Keep anything modified more recently than this [Default=%(default)s]")
+        subparser.add_argument("-n", "--dry-run", action="store_true", help="Only print what would be removed")
+
+    args = parser.parse_args(args)
+    if not os.path.isdir(args.store):
+        print("No store at {0}".format(args.store))
+        sys.exit(1)
+
+    if args.command == "prune":
+        if args.max_age is None and args.budget is None:
+            parser.error("--max-age or --budget is required")
+        stats = store_stats(args.store)
+        to_remove, projected_bytes = plan_prune(
+            revisions(args.archive), stats["bytes"] - stats["unreferenced_bytes"],
+            args.max_age * 24 * 60 * 60 if args.max_age is not None else None, args.budget,
+            args.policy, args.grace)
+        for revision in to_remove:
+            print("{0} {1}".format("Would remove" if args.dry_run else "Removing", revision.path))
+            if not args.dry_run:
+                shutil.rmtree(revision.path)
+        print("{0} {1} revisions, the store will be {2}".format("Would remove" if args.dry_run else "Removed",
+                                                                len(to_remove), format_size(projected_bytes)))
+        if args.budget is not None and projected_bytes > args.budget:
+            print("The store is still over budget: the remaining revisions are too recent")
+
+    if args.command in ("gc", "prune"):
+        removed, freed = collect_garbage(args.store, args.grace, args.dry_run)
+        print("{0} {1} unreferenced files ({2})".format("Would remove" if args.dry_run else "Removed",
+                                                        removed, format_size(freed)))
+
+    stats = store_stats(args.store)
+    print_stats(stats)
+    write_stats(args.store, stats)
+
+
+if __name__ == '__main__':
+    cli()
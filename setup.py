@@ -14,7 +14,8 @@ deps = [
     'mozrunner >= 5.0',
     'pytz',
     'requests == 2.31.0',
-    'requests-futures == 0.9.7',
+    'futures; python_version < "3"',
+    'scandir; python_version < "3.5"',
     'slugid == 2.0.0',
 ]
 
@@ -47,11 +48,19 @@ setup(name=PACKAGE_NAME,
             ]},
       zip_safe=False,
       install_requires = deps,
+      extras_require={'compare': ['numpy', 'Pillow']},
       entry_points="""
 # -*- Entry points: -*-
 [console_scripts]
 mozscreenshots = mozscreenshots:cli
 fetch_screenshots = mozscreenshots.fetch_screenshots:cli
+fetch_and_compare = mozscreenshots.fetch_and_compare:cli
 compare_screenshots = mozscreenshots.compare_screenshots:cli
+compare_pushes = mozscreenshots.compare_pushes:cli
+build_composite = mozscreenshots.compare_screenshots:build_composite_cli
+fingerprint_screenshots = mozscreenshots.fingerprints:cli
+store_maintenance = mozscreenshots.store_maintenance:cli
+screenshot_results = mozscreenshots.results_index:cli
+comparison_service = mozscreenshots.comparison_service:cli
 """,
     )
@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import apng
+
+if apng.numpy is not None:
+    import numpy
+
+
+def read_chunks(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data[:8] == apng.PNG_SIGNATURE
+    chunks = []
+    position = 8
+    while position < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        crc = struct.unpack(">I", data[position + 8 + length:position + 12 + length])[0]
+        assert crc == zlib.crc32(chunk_type + body) & 0xffffffff
+        chunks.append((chunk_type, body))
+        position += 12 + length
+    return chunks
+
+
+def decode(data, width, height):
+    """Reverse the Sub filter which is the only one apng.compress uses."""
+    scanlines = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8).reshape(height, width * 4 + 1)
+    assert (scanlines[:, 0] == 1).all()
+    rows = scanlines[:, 1:].copy()
+    for x in range(4, width * 4):
+        rows[:, x] += rows[:, x - 4]
+    return rows.reshape(height, width, 4)
+
+
+@unittest.skipUnless(apng.numpy is not None, "numpy is required")
+class WriteAPNGTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "animated.png")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def frames(self, path):
+        chunks = read_chunks(path)
+        self.assertEqual([chunk_type for chunk_type, body in chunks][:2], [b'IHDR', b'acTL'])
+        self.assertEqual(chunks[-1], (b'IEND', b''))
+        width, height, depth, color_type = struct.unpack(">IIBB", chunks[0][1][:10])
+        self.assertEqual((depth, color_type), (8, 6))
+        frame_count = struct.unpack(">II", chunks[1][1])[0]
+
+        frames = []
+        sequences = []
+        for chunk_type, body in chunks[2:-1]:
+            if chunk_type == b'fcTL':
+                sequence, frame_width, frame_height, x, y, delay, denominator = struct.unpack(">IIIIIHH", body[:24])
+                self.assertEqual((frame_width, frame_height, x, y), (width, height, 0, 0))
+                self.assertEqual((delay, denominator), (400, 1000))
+                sequences.append(sequence)
+            elif chunk_type == b'IDAT':
+                frames.append(decode(body, width, height))
+            elif chunk_type == b'fdAT':
+                sequences.append(struct.unpack(">I", body[:4])[0])
+                frames.append(decode(body[4:], width, height))
+        self.assertEqual(len(frames), frame_count)
+        self.assertEqual(sequences, list(range(len(sequences))))
+        return frames
+
+    def test_round_trip(self):
+        random = numpy.random.RandomState(0)
+        frames = [random.randint(0, 256, (7, 11, 4)).astype(numpy.uint8) for i in range(3)]
+        apng.write_apng(self.path, frames, 400)
+        decoded = self.frames(self.path)
+        self.assertEqual(len(decoded), 3)
+        for frame, expected in zip(decoded, frames):
+            self.assertTrue((frame == expected).all())
+
+    def test_pads_smaller_frames(self):
+        before = numpy.full((5, 8, 4), 200, dtype=numpy.uint8)
+        after = numpy.full((9, 4, 4), 100, dtype=numpy.uint8)
+        apng.write_apng(self.path, [before, after], 400)
+        decoded = self.frames(self.path)
+        self.assertEqual([frame.shape for frame in decoded], [(9, 8, 4), (9, 8, 4)])
+        self.assertTrue((decoded[0][:5] == 200).all())
+        self.assertTrue((decoded[0][5:] == 0).all())
+        self.assertTrue((decoded[1][:, :4] == 100).all())
+        self.assertTrue((decoded[1][:, 4:] == 0).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import image_diff
+
+try:
+    import compare_pushes
+except ImportError:
+    # fetch_screenshots imports mozscreenshots/__init__.py which needs mozrunner
+    compare_pushes = None
+
+if image_diff.available():
+    import numpy
+    from PIL import Image
+
+PROJECT = "mozilla-central"
+
+
+def push(push_id):
+    return {"id": push_id, "revision": ("%x" % push_id) * 40,
+            "push_timestamp": int(time.time()) - 24 * 60 * 60 + push_id * 60}
+
+
+@unittest.skipUnless(compare_pushes, "mozrunner is required")
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_push_reported(self):
+        state = compare_pushes.State(self.path)
+        self.assertIsNone(state.last_push(PROJECT))
+        state.push_reported(PROJECT, push(1), dict(push(2), extra="not kept"))
+
+        state = compare_pushes.State(self.path)
+        self.assertEqual(state.last_push(PROJECT), push(2))
+        self.assertTrue(state.is_reported(PROJECT, push(1)["revision"], push(2)["revision"]))
+        self.assertFalse(state.is_reported(PROJECT, push(2)["revision"], push(1)["revision"]))
+        self.assertIsNone(state.last_push("try"))
+
+    def test_reported_pairs_are_limited(self):
+        state = compare_pushes.State(self.path)
+        for i in range(1, compare_pushes.MAX_REPORTED_PAIRS + 2):
+            state.push_reported(PROJECT, push(i), push(i + 1))
+        self.assertEqual(len(state.project(PROJECT)["reported"]), compare_pushes.MAX_REPORTED_PAIRS)
+        self.assertFalse(state.is_reported(PROJECT, push(1)["revision"], push(2)["revision"]))
+        self.assertTrue(state.is_reported(PROJECT, push(2)["revision"], push(3)["revision"]))
+
+
+@unittest.skipUnless(compare_pushes and image_diff.available(), "mozrunner, numpy and Pillow are required")
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.archive = tempfile.mkdtemp()
+        self.pushes = [push(i) for i in range(1, 5)]
+        self.original_resultsets_for_range = compare_pushes.resultsets_for_range
+        self.original_recent_data_path = compare_pushes.RECENT_DATA_PATH
+        compare_pushes.resultsets_for_range = lambda project, start_time, end_time: [
+            resultset for resultset in reversed(self.pushes) if resultset["push_timestamp"] >= int(start_time)]
+        compare_pushes.RECENT_DATA_PATH = os.path.join(self.archive, "recent_data.json")
+
+    def tearDown(self):
+        compare_pushes.resultsets_for_range = self.original_resultsets_for_range
+        compare_pushes.RECENT_DATA_PATH = self.original_recent_data_path
+        shutil.rmtree(self.archive)
+
+    def fetch(self, resultset):
+        job_dir = os.path.join(self.archive, PROJECT, resultset["revision"], "linux64-%d" % (1000 + resultset["id"]))
+        os.makedirs(job_dir)
+        pixels = numpy.zeros((8, 8, 4), dtype=numpy.uint8)
+        pixels[resultset["id"]] = 255
+        Image.fromarray(pixels, "RGBA").save(os.path.join(job_dir, "1234-browserWindow_01.png"))
+
+    def run_pushes(self, workers):
+        return compare_pushes.run(self.archive, PROJECT, send_email=False, known_inconsistencies=[], workers=workers)
+
+    def last_push(self):
+        return compare_pushes.State(os.path.join(self.archive, compare_pushes.STATE_FILENAME)).last_push(PROJECT)
+
+    def check_stops_at_unfetched_push(self, workers):
+        for resultset in self.pushes[:2] + self.pushes[3:]:
+            self.fetch(resultset)
+        self.assertEqual(self.run_pushes(workers), 1)
+        self.assertEqual(self.last_push(), self.pushes[1])
+
+        self.fetch(self.pushes[2])
+        self.assertEqual(self.run_pushes(workers), 2)
+        self.assertEqual(self.last_push(), self.pushes[3])
+        self.assertEqual(self.run_pushes(workers), 0)
+
+    def test_stops_at_unfetched_push(self):
+        self.check_stops_at_unfetched_push(1)
+
+    def test_stops_at_unfetched_push_in_parallel(self):
+        self.check_stops_at_unfetched_push(2)
+
+    def test_locked_platform_is_compared_again(self):
+        for resultset in self.pushes:
+            self.fetch(resultset)
+        # As if another process was comparing the platform
+        original_compare_dirs = compare_pushes.compare_screenshots.compare_dirs
+        compare_pushes.compare_screenshots.compare_dirs = lambda *args: {}
+        try:
+            self.assertEqual(self.run_pushes(1), 0)
+        finally:
+            compare_pushes.compare_screenshots.compare_dirs = original_compare_dirs
+        self.assertIsNone(self.last_push())
+        self.assertEqual(self.run_pushes(1), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
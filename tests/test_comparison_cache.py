@@ -0,0 +1,146 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+
+import compare_screenshots
+import comparison_cache
+import image_diff
+from comparison_common import ComparisonResult
+
+if image_diff.available():
+    import numpy
+    from PIL import Image
+
+
+class ComparisonCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = comparison_cache.ComparisonCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_key(self):
+        key = self.cache.key("a", "b", 3, [(0, 0, 0, 0)])
+        self.assertEqual(key, self.cache.key("a", "b", 3, [(0, 0, 0, 0)]))
+        self.assertNotEqual(key, self.cache.key("b", "a", 3, [(0, 0, 0, 0)]))
+        self.assertNotEqual(key, self.cache.key("a", "b", 4, [(0, 0, 0, 0)]))
+        self.assertNotEqual(key, self.cache.key("a", "b", 3, [(0, 0, 2, 0)]))
+
+    def test_put_and_get(self):
+        key = self.cache.key("a", "b", 3)
+        self.assertIsNone(self.cache.get(key))
+        bounds = {"top": 1, "right": 2, "bottom": 3, "left": 4}
+        self.cache.put(key, (ComparisonResult.DIFFERENT, "12", bounds, [bounds]))
+        self.assertEqual(self.cache.get(key), (ComparisonResult.DIFFERENT, "12", bounds, [bounds]))
+        self.assertIsNone(self.cache.get(self.cache.key("a", "c", 3)))
+
+    def test_link_composite(self):
+        key = self.cache.key("a", "b", 3)
+        composite = os.path.join(self.tmpdir, "composite.png")
+        dest = os.path.join(self.tmpdir, "linked.png")
+        self.cache.put(key, (ComparisonResult.SIMILAR, "0", None, None))
+        self.assertFalse(self.cache.link_composite(key, dest))
+
+        with open(composite, "wb") as f:
+            f.write(b"composite")
+        self.cache.put(key, (ComparisonResult.SIMILAR, "0", None, None), composite)
+        self.assertTrue(self.cache.link_composite(key, dest))
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), b"composite")
+
+    def test_get_cache(self):
+        cache_dir = os.path.join(self.tmpdir, "shared")
+        self.assertIs(comparison_cache.get_cache(cache_dir), comparison_cache.get_cache(cache_dir))
+
+
+class FileHashTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_rewritten_file_is_hashed_again(self):
+        path = self.write("image.png", b"before", 1000000000)
+        before_hash = comparison_cache.file_sha512(path)
+        self.write("image.png", b"rewritten", 1000000000)
+        self.assertNotEqual(comparison_cache.file_sha512(path), before_hash)
+        self.assertEqual(comparison_cache.file_sha512(self.write("copy.png", b"before")), before_hash)
+
+    def test_same_file(self):
+        path = self.write("image.png", b"image")
+        os.link(path, os.path.join(self.tmpdir, "link.png"))
+        self.assertTrue(comparison_cache.same_file(path, os.path.join(self.tmpdir, "link.png")))
+        self.assertFalse(comparison_cache.same_file(path, self.write("copy.png", b"image")))
+
+
+@unittest.skipUnless(image_diff.available(), "numpy and Pillow are required")
+class ComparePairTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.tmpdir, "out")
+        self.similar_dir = os.path.join(self.outdir, "similar")
+        os.makedirs(self.similar_dir)
+        self.args = Namespace(cache_dir=os.path.join(self.tmpdir, "cache"), output_similar_composite=False)
+        self.compare_images = compare_screenshots.compare_images
+        self.compared = []
+
+    def tearDown(self):
+        compare_screenshots.compare_images = self.compare_images
+        shutil.rmtree(self.tmpdir)
+
+    def image(self, name, value):
+        path = os.path.join(self.tmpdir, name)
+        Image.fromarray(numpy.full((8, 8, 4), value, dtype=numpy.uint8), "RGBA").save(path)
+        return path
+
+    def compare(self, before, after):
+        def compare_images(*args):
+            self.compared.append(os.path.basename(after))
+            return self.compare_images(*args)
+        compare_screenshots.compare_images = compare_images
+        return compare_screenshots.compare_pair(before, after, self.outdir, self.similar_dir, self.args)
+
+    def test_copies_are_not_decoded(self):
+        for cache_dir in (self.args.cache_dir, None):
+            self.args.cache_dir = cache_dir
+            comparison = self.compare(self.image("before_a.png", 100), self.image("after_a.png", 100))
+            self.assertEqual(comparison, (ComparisonResult.SIMILAR, "0", None, None))
+        self.assertEqual(self.compared, [])
+
+    def test_results_are_cached(self):
+        before, after = self.image("before_a.png", 100), self.image("after_a.png", 200)
+        first = self.compare(before, after)
+        self.assertEqual(first[:2], (ComparisonResult.DIFFERENT, "64"))
+        self.assertEqual(self.compare(before, after), first)
+        self.assertEqual(self.compared, ["after_a.png"])
+        self.assertTrue(os.path.isfile(os.path.join(self.outdir, "a.png")))
+
+    def test_errors_are_not_cached(self):
+        before, after = self.image("before_a.png", 100), self.image("after_a.png", 200)
+        with open(after, "rb") as f:
+            data = f.read()
+        with open(after, "wb") as f:
+            f.write(data[:len(data) // 2])
+        self.assertEqual(self.compare(before, after)[0], ComparisonResult.ERROR)
+        self.assertEqual(self.compare(before, after)[0], ComparisonResult.ERROR)
+        self.assertEqual(self.compared, ["after_a.png", "after_a.png"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import comparison_common
+
+
+class IndexDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, *names):
+        path = os.path.join(self.tmpdir, *names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+        return path
+
+    def test_index(self):
+        first = self.touch("linux64-123456", "1234-browserWindow_normal.png")
+        self.touch("linux64-123456", "5678-browserWindow_normal.png")
+        nested = self.touch("linux64-123456", "screenshots", "1234_tabs_pinned.png")
+        self.touch("linux64-123456", "log.txt")
+
+        index = comparison_common.index_dir(self.tmpdir)
+        self.assertEqual((index.path, index.images, sorted(index.subdirs)), (self.tmpdir, {}, ["linux64-123456"]))
+        job = index.subdirs["linux64-123456"]
+        # The first of the images with the same suffix is used.
+        self.assertEqual(job.images, {"browserWindow_normal.png": first})
+        self.assertEqual(job.subdirs["screenshots"].images, {"tabs_pinned.png": nested})
+        self.assertEqual(job.subdirs["screenshots"].subdirs, {})
+
+
+class PairSubdirsTest(unittest.TestCase):
+    def test_job_dir_prefix(self):
+        self.assertEqual(comparison_common.job_dir_prefix("linux64-123456"), "linux64")
+        self.assertEqual(comparison_common.job_dir_prefix("windows7-32-123456"), "windows7-32")
+        self.assertEqual(comparison_common.job_dir_prefix("windows7-32"), "windows7-32")
+
+    def test_pairs(self):
+        before = ["osx-10-10-700", "linux64-500", "linux64-400"]
+        after = ["linux64-900", "linux64-800", "windows7-32-100"]
+        self.assertEqual(comparison_common.pair_subdirs(before, after), [
+            ("linux64", "linux64-400", "linux64-900"),
+            ("osx-10-10", "osx-10-10-700", None),
+        ])
+        self.assertEqual(comparison_common.pair_subdirs([], after), [])
+
+    def test_platforms_with_the_same_prefix(self):
+        before = ["linux64-400", "linux64-asan-401"]
+        after = ["linux64-900", "linux64-asan-901"]
+        self.assertEqual(comparison_common.pair_subdirs(before, after), [
+            ("linux64", "linux64-400", "linux64-900"),
+            ("linux64-asan", "linux64-asan-401", "linux64-asan-901"),
+        ])
+        self.assertIsNone(comparison_common.matching_name(["linux64-asan-901"], "linux64-400"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+
+import compare_screenshots
+import comparison_service
+import image_diff
+from comparison_service import ComparisonQueue
+
+if image_diff.available():
+    import numpy
+    from PIL import Image
+
+OLD = ("mozilla-central", "08138045c38c")
+NEW = ("try", "5f6ca9194dd9")
+OTHER = ("try", "0123456789ab")
+
+
+class ComparisonQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, comparison_service.QUEUE_FILENAME)
+        self.queue = ComparisonQueue(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, old, new):
+        return self.queue.request(old[0], old[1], new[0], new[1])
+
+    def test_requests_share_a_job(self):
+        first = self.request(OLD, NEW)
+        second = self.request(OLD, NEW)
+        self.assertEqual(first["id"], "mozilla-central/08138045c38c/try/5f6ca9194dd9")
+        self.assertEqual(second["id"], first["id"])
+        self.assertEqual(second["requests"], 2)
+        self.assertEqual(self.queue.status()["queued"], [first["id"]])
+
+    def test_running_job_is_shared(self):
+        job = self.request(OLD, NEW)
+        self.assertEqual(self.queue.next_job()["id"], job["id"])
+        self.assertEqual(self.request(OLD, NEW)["state"], "running")
+        self.assertEqual(self.queue.status()["queued"], [])
+
+    def test_order_and_position(self):
+        first = self.request(OLD, NEW)
+        second = self.request(OLD, OTHER)
+        self.assertEqual(self.queue.get(first["id"])["position"], 1)
+        self.assertEqual(self.queue.get(second["id"])["position"], 2)
+        self.assertEqual(self.queue.next_job()["id"], first["id"])
+        self.assertEqual(self.queue.get(second["id"])["position"], 1)
+
+    def test_recently_finished_job_is_reused(self):
+        job = self.request(OLD, NEW)
+        self.queue.next_job()
+        self.queue.finish(job["id"], 0)
+        reused = self.request(OLD, NEW)
+        self.assertEqual((reused["state"], reused["requests"]), ("done", 2))
+
+        # Compared again once the job is older than REUSE_SECONDS.
+        self.queue.jobs[job["id"]]["finished"] = time.time() - comparison_service.REUSE_SECONDS - 1
+        requeued = self.request(OLD, NEW)
+        self.assertEqual((requeued["state"], requeued["requests"]), ("queued", 1))
+
+    def test_failed_job(self):
+        job = self.request(OLD, NEW)
+        self.queue.next_job()
+        self.queue.finish(job["id"], 1)
+        self.assertEqual(self.queue.get(job["id"])["state"], "failed")
+        self.assertEqual(self.queue.status()["failed"], 1)
+
+    def test_running_jobs_are_queued_again_after_restart(self):
+        running = self.request(OLD, NEW)
+        queued = self.request(OLD, OTHER)
+        self.queue.next_job()
+        restarted = ComparisonQueue(self.path)
+        self.assertEqual(restarted.status()["queued"], [running["id"], queued["id"]])
+        self.assertEqual(restarted.next_job()["id"], running["id"])
+
+    def test_wait(self):
+        job = self.request(OLD, NEW)
+        start = time.time()
+        self.assertEqual(self.queue.get(job["id"], wait=0.1)["state"], "queued")
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertIsNone(self.queue.get("mozilla-central/08138045c38c/try/000000000000"))
+
+
+@unittest.skipUnless(image_diff.available(), "numpy and Pillow are required")
+class CompositePathTest(unittest.TestCase):
+    def setUp(self):
+        self.archive = tempfile.mkdtemp()
+        self.job_id = "/".join(OLD + NEW)
+        self.outdir = os.path.join(self.archive, "comparisons", self.job_id, "linux64")
+        for rev_dir, value in ((OLD, 100), (NEW, 200)):
+            job_dir = os.path.join(self.archive, rev_dir[0], rev_dir[1], "linux64-123456")
+            os.makedirs(job_dir)
+            for name in ("browserWindow_01_normal.png", "tabs_01_pinned.png"):
+                pixels = numpy.full((6, 6, 4), value if name.startswith("browser") else 50, dtype=numpy.uint8)
+                Image.fromarray(pixels, "RGBA").save(os.path.join(job_dir, "1234-" + name))
+
+    def tearDown(self):
+        shutil.rmtree(self.archive)
+
+    def compare(self, defer_composites):
+        args = Namespace(dppx=1.0, overwrite=True, output_similar_composite=False, defer_composites=defer_composites,
+                         cache_dir=None, tile_size=0, jobs=1)
+        compare_screenshots.compare_dirs(os.path.join(self.archive, OLD[0], OLD[1], "linux64-123456"),
+                                         os.path.join(self.archive, NEW[0], NEW[1], "linux64-123456"),
+                                         self.outdir, args)
+
+    def composite_path(self, name):
+        return comparison_service.composite_path(self.archive, self.job_id, "linux64", name)
+
+    def test_deferred_composite_is_built(self):
+        self.compare(True)
+        path = os.path.join(self.outdir, "browserWindow_01_normal.png")
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.composite_path("browserWindow_01_normal.png"), path)
+        self.assertTrue(os.path.isfile(path))
+        # Similar pairs have no composite.
+        self.assertIsNone(self.composite_path("tabs_01_pinned.png"))
+
+    def test_composite_built_during_comparison(self):
+        self.compare(False)
+        self.assertEqual(self.composite_path("browserWindow_01_normal.png"),
+                         os.path.join(self.outdir, "browserWindow_01_normal.png"))
+        self.assertIsNone(self.composite_path("missing.png"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import uuid
+from argparse import Namespace
+
+import requests
+
+try:
+    import fetch_screenshots
+except ImportError:
+    # mozscreenshots/__init__.py needs mozrunner
+    fetch_screenshots = None
+
+
+class FakeResponse(object):
+    def __init__(self, url, status_code=200, body=None, content=b""):
+        self.url = url
+        self.status_code = status_code
+        self.body = body
+        self.content = content
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("%d for %s" % (self.status_code, self.url))
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeScheduler(object):
+    """Answers the Treeherder and Taskcluster requests for `jobs` (push id -> jobs) with two images per job."""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.requests = []
+        self.failing = set()
+        self.lock = threading.Lock()
+
+    def set_max_concurrency(self, concurrency):
+        pass
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.requests.append(url)
+        if "/jobs/" in url:
+            push_ids = url.split("push_id__in=")[1].split("&")[0].split(",")
+            return FakeResponse(url, body={"results": [job for push_id in push_ids
+                                                       for job in self.jobs.get(int(push_id), [])]})
+        if url.endswith("/artifacts"):
+            return FakeResponse(url, body={"artifacts": [
+                {"name": "public/screenshots/1234-%s.png" % name, "contentType": "image/png"}
+                for name in ("browserWindow_01", "tabs_01")
+            ] + [{"name": "public/logs/live.log", "contentType": "text/plain"}]})
+        if any(url.endswith(name) for name in self.failing):
+            return FakeResponse(url, status_code=500)
+        return FakeResponse(url, content=os.path.basename(url).encode("utf-8") * 1000)
+
+    def artifact_listings(self):
+        return len([url for url in self.requests if url.endswith("/artifacts")])
+
+
+def job(push_id, job_id, platform):
+    return {
+        "id": job_id,
+        "push_id": push_id,
+        "platform": platform,
+        "job_guid": "%s/0" % uuid.UUID(int=job_id),
+        "job_group_symbol": "M",
+        "result": "success",
+        "task_id": "task",
+        "retry_id": 0,
+    }
+
+
+@unittest.skipUnless(fetch_screenshots, "mozrunner is required")
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.scheduler = FakeScheduler({
+            1: [job(1, 100, "linux64"), job(1, 101, "windows7-32")],
+            2: [job(2, 200, "linux64"), job(2, 201, "windows7-32")],
+        })
+        self.original_scheduler = fetch_screenshots.scheduler
+        self.original_metadata_cache = fetch_screenshots.metadata_cache
+        fetch_screenshots.scheduler = self.scheduler
+        fetch_screenshots.metadata_cache = None
+        self.resultsets = [{"id": 1, "revision": "a" * 40, "push_timestamp": 0},
+                           {"id": 2, "revision": "b" * 40, "push_timestamp": 0}]
+        self.args = Namespace(project="try", job_type_name=None, job_type_symbol="ss", job_group_symbol="M")
+        self.listed = []
+        self.finished = []
+
+    def tearDown(self):
+        fetch_screenshots.scheduler = self.original_scheduler
+        fetch_screenshots.metadata_cache = self.original_metadata_cache
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self):
+        fetcher = fetch_screenshots.Fetcher(4, self.finished.append,
+                                            lambda rev_dir, job_dirs: self.listed.append((rev_dir, job_dirs)))
+        fetcher.fetch_resultsets(self.args, self.resultsets)
+        return (sorted(fetcher.wait()), fetcher.errors)
+
+    def test_fetches_all_jobs(self):
+        job_dirs, errors = self.fetch()
+        self.assertEqual(errors, 0)
+        expected = [os.path.join("try", "a" * 40, "linux64-100"), os.path.join("try", "a" * 40, "windows7-32-101"),
+                    os.path.join("try", "b" * 40, "linux64-200"), os.path.join("try", "b" * 40, "windows7-32-201")]
+        self.assertEqual(job_dirs, expected)
+        self.assertEqual(sorted(self.finished), expected)
+        self.assertEqual(sorted(self.listed), [(os.path.join("try", "a" * 40), expected[:2]),
+                                               (os.path.join("try", "b" * 40), expected[2:])])
+        # One query lists the jobs of both resultsets.
+        self.assertEqual(len([url for url in self.scheduler.requests if "/jobs/" in url]), 1)
+
+        for job_dir in expected:
+            self.assertEqual(sorted(os.listdir(job_dir)), ["1234-browserWindow_01.png", "1234-tabs_01.png"])
+        # Images with the same content share their file in the store.
+        first = os.stat(os.path.join(expected[0], "1234-tabs_01.png"))
+        self.assertEqual(first.st_nlink, 5)
+        self.assertEqual(os.listdir(os.path.join(fetch_screenshots.HASHED_IMAGE_PATH,
+                                                 fetch_screenshots.HASHED_IMAGE_TMP_DIR)), [])
+
+    def test_failed_download(self):
+        self.scheduler.failing.add("1234-tabs_01.png")
+        job_dirs, errors = self.fetch()
+        # The jobs are still returned with the images which were downloaded...
+        self.assertEqual(len(job_dirs), 4)
+        self.assertEqual(os.listdir(job_dirs[0]), ["1234-browserWindow_01.png"])
+        # ...but aren't complete.
+        self.assertEqual(self.finished, [])
+
+    def test_rerun_skips_fetched_jobs(self):
+        self.fetch()
+        self.assertEqual(self.scheduler.artifact_listings(), 4)
+        self.finished = []
+        job_dirs, errors = self.fetch()
+        self.assertEqual((len(job_dirs), errors), (4, 0))
+        self.assertEqual(len(self.finished), 4)
+        self.assertEqual(self.scheduler.artifact_listings(), 4)
+
+        # Jobs whose images were removed are fetched again.
+        shutil.rmtree(job_dirs[0])
+        self.fetch()
+        self.assertEqual(self.scheduler.artifact_listings(), 5)
+        self.assertEqual(len(os.listdir(job_dirs[0])), 2)
+
+    def test_incomplete_jobs_are_fetched_again(self):
+        self.scheduler.failing.add("1234-tabs_01.png")
+        self.fetch()
+        self.scheduler.failing = set()
+        self.fetch()
+        self.assertEqual(self.scheduler.artifact_listings(), 8)
+        self.assertEqual(len(self.finished), 4)
+
+
+@unittest.skipUnless(fetch_screenshots, "mozrunner is required")
+class FetchManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_job(self):
+        manifest = fetch_screenshots.FetchManifest(self.tmpdir)
+        self.assertIsNone(manifest.job("task/0"))
+        manifest.add_job("task/0", job(1, 100, "linux64"), os.path.join(self.tmpdir, "linux64-100"), ["a.png"])
+        expected = {"id": 100, "platform": "linux64", "dir": "linux64-100", "artifacts": ["a.png"]}
+        self.assertEqual(manifest.job("task/0"), expected)
+        self.assertEqual(fetch_screenshots.FetchManifest(self.tmpdir).job("task/0"), expected)
+
+    def test_keeps_jobs_added_by_other_runs(self):
+        first = fetch_screenshots.FetchManifest(self.tmpdir)
+        second = fetch_screenshots.FetchManifest(self.tmpdir)
+        first.add_job("task/0", job(1, 100, "linux64"), "linux64-100", [])
+        second.add_job("task/1", job(1, 101, "linux64"), "linux64-101", [])
+        self.assertEqual(sorted(fetch_screenshots.FetchManifest(self.tmpdir).jobs), ["task/0", "task/1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+
+import image_diff
+
+if image_diff.available():
+    import numpy
+    from PIL import Image
+
+FUZZ = 0.03
+
+
+def solid(rgba, height=4, width=4):
+    pixels = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    pixels[:] = rgba
+    return pixels
+
+
+@unittest.skipUnless(image_diff.available(), "numpy and Pillow are required")
+class DifferenceMaskTest(unittest.TestCase):
+    """The expected results are those of `compare -fuzz 3% -metric AE`.
+
+    ImageMagick's IsMagickColorSimilar treats opaque pixels as similar when the
+    squared RGB distance is at most 3 * (0.03 * 255)^2 = 175.5675, so a
+    difference of 7 in every channel (147) is similar and 8 (192) isn't.
+    """
+
+    def assertDifferent(self, before, after, expected):
+        mask = image_diff.difference_mask(solid(before), solid(after), FUZZ)
+        self.assertEqual(bool(mask.all()), expected)
+        self.assertEqual(bool(mask.any()), expected)
+
+    def test_identical(self):
+        self.assertDifferent((10, 20, 30, 255), (10, 20, 30, 255), False)
+
+    def test_opaque_within_fuzz(self):
+        self.assertDifferent((100, 100, 100, 255), (107, 107, 107, 255), False)
+        self.assertDifferent((100, 100, 100, 255), (113, 100, 100, 255), False)
+
+    def test_opaque_beyond_fuzz(self):
+        self.assertDifferent((100, 100, 100, 255), (108, 108, 108, 255), True)
+        self.assertDifferent((100, 100, 100, 255), (114, 100, 100, 255), True)
+
+    def test_transparent_colors_are_ignored(self):
+        self.assertDifferent((0, 0, 0, 0), (255, 255, 255, 0), False)
+
+    def test_alpha_difference(self):
+        # The alpha channels alone are compared against (0.03 * 255)^2 = 58.5225.
+        self.assertDifferent((0, 0, 0, 100), (0, 0, 0, 107), False)
+        self.assertDifferent((0, 0, 0, 100), (0, 0, 0, 108), True)
+
+    def test_translucent_distance_is_scaled(self):
+        # A distance of 64 in one channel is scaled by (128 / 255)^2 to ~1032, still beyond the fuzz.
+        self.assertDifferent((0, 0, 0, 128), (64, 0, 0, 128), True)
+        # ...and 20 to ~101, within it, although it wouldn't be for opaque pixels.
+        self.assertDifferent((0, 0, 0, 128), (20, 0, 0, 128), False)
+        self.assertDifferent((0, 0, 0, 255), (20, 0, 0, 255), True)
+
+    def test_dimension_mismatch(self):
+        with self.assertRaises(image_diff.DimensionMismatch):
+            image_diff.difference_mask(solid((0, 0, 0, 255), 4, 4), solid((0, 0, 0, 255), 4, 5), FUZZ)
+
+    def test_diff_count_and_bounds(self):
+        before = solid((100, 100, 100, 255), 10, 12)
+        after = before.copy()
+        after[2, 3] = (200, 100, 100, 255)
+        after[6, 9] = (100, 100, 100, 0)
+        after[8, 1] = (105, 105, 105, 255)
+        difference = image_diff.diff(before, after, FUZZ)
+        self.assertEqual(difference.count, 2)
+        self.assertEqual(difference.bounds, {"top": 2, "right": 9, "bottom": 6, "left": 3})
+        self.assertIsNone(image_diff.diff(before, before.copy(), FUZZ).bounds)
+
+
+@unittest.skipUnless(image_diff.available(), "numpy and Pillow are required")
+class DiffTiledTest(unittest.TestCase):
+    def random_pair(self, seed):
+        random = numpy.random.RandomState(seed)
+        before = random.randint(0, 256, (45, 70, 4)).astype(numpy.uint8)
+        before[..., 3] = 255
+        after = before.copy()
+        # Changes small enough to be within the fuzz and others beyond it, in a few areas
+        for top, left in ((3, 5), (20, 40), (40, 66)):
+            area = after[top:top + 5, left:left + 4, :3].astype(numpy.int32)
+            area += random.randint(-12, 13, area.shape)
+            after[top:top + 5, left:left + 4, :3] = numpy.clip(area, 0, 255)
+        return before, after
+
+    def test_same_as_diff(self):
+        for seed in range(5):
+            before, after = self.random_pair(seed)
+            expected = image_diff.diff(before, after, FUZZ)
+            for tile_size in (1, 7, 16, 100):
+                difference = image_diff.diff_tiled(before, after, FUZZ, tile_size)
+                self.assertEqual(difference.count, expected.count)
+                self.assertEqual(difference.bounds, expected.bounds)
+                self.assertTrue((difference.mask == expected.mask).all())
+
+    def test_cropped_views(self):
+        before, after = self.random_pair(1)
+        chop = (1, 3, 2, 5)
+        before, after = image_diff.crop(before, chop), image_diff.crop(after, chop)
+        expected = image_diff.diff(before, after, FUZZ)
+        difference = image_diff.diff_tiled(before, after, FUZZ, 8)
+        self.assertEqual(difference.count, expected.count)
+        self.assertTrue((difference.mask == expected.mask).all())
+
+    def test_regions(self):
+        before = solid((0, 0, 0, 255), 32, 32)
+        after = before.copy()
+        # The first two are in vertically adjacent tiles so they're one region.
+        after[1, 1] = after[9, 2] = (255, 255, 255, 255)
+        after[30, 20] = (255, 255, 255, 255)
+        difference = image_diff.diff_tiled(before, after, FUZZ, 8)
+        self.assertEqual(difference.regions, [
+            {"top": 1, "right": 2, "bottom": 9, "left": 1},
+            {"top": 30, "right": 20, "bottom": 30, "left": 20},
+        ])
+        self.assertEqual(difference.bounds, {"top": 1, "right": 20, "bottom": 30, "left": 1})
+
+    def test_no_changes(self):
+        before = solid((0, 0, 0, 255), 16, 16)
+        difference = image_diff.diff_tiled(before, before.copy(), FUZZ, 8)
+        self.assertEqual((difference.count, difference.bounds, difference.regions), (0, None, []))
+
+
+@unittest.skipUnless(image_diff.available(), "numpy and Pillow are required")
+class LoadPNGTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rgba(self):
+        path = os.path.join(self.tmpdir, "rgb.png")
+        Image.new("RGB", (3, 2), (1, 2, 3)).save(path)
+        pixels = image_diff.load_png(path)
+        self.assertEqual(pixels.shape, (2, 3, 4))
+        self.assertEqual(tuple(pixels[1, 2]), (1, 2, 3, 255))
+
+    def test_truncated(self):
+        path = os.path.join(self.tmpdir, "truncated.png")
+        random = numpy.random.RandomState(0)
+        Image.fromarray(random.randint(0, 256, (64, 64, 4)).astype(numpy.uint8), "RGBA").save(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data[:len(data) // 2])
+        with self.assertRaises(IOError):
+            image_diff.load_png(path)
+
+
+@unittest.skipUnless(image_diff.available() and find_executable("compare"),
+                     "numpy, Pillow and ImageMagick are required")
+class ImageMagickTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def imagemagick_count(self, before, after):
+        paths = []
+        for name, pixels in (("before.png", before), ("after.png", after)):
+            paths.append(os.path.join(self.tmpdir, name))
+            Image.fromarray(pixels, "RGBA").save(paths[-1])
+        process = subprocess.Popen(["compare", "-quiet", "-fuzz", "3%", "-metric", "AE"] + paths + ["null:"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return int(float(process.communicate()[1].split()[0]))
+
+    def test_counts_match(self):
+        random = numpy.random.RandomState(0)
+        before = random.randint(0, 256, (30, 30, 4)).astype(numpy.uint8)
+        after = numpy.clip(before.astype(numpy.int32) + random.randint(-10, 11, before.shape), 0, 255)
+        after = after.astype(numpy.uint8)
+        for alpha in (None, 255):
+            if alpha is not None:
+                before[..., 3] = after[..., 3] = alpha
+            self.assertEqual(image_diff.diff(before, after, FUZZ).count, self.imagemagick_count(before, after))
+
+
+if __name__ == "__main__":
+    unittest.main()
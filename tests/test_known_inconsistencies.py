@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+import known_inconsistencies
+from known_inconsistencies import KnownInconsistencies
+
+
+def rule(reason, platform, names, **difference):
+    known = {"reason": reason, "platformRegex": platform, "nameRegexes": names}
+    known.update(difference)
+    return known
+
+
+def reason(match):
+    return match.reason if match else None
+
+
+class KnownInconsistenciesTest(unittest.TestCase):
+    def test_earlier_rules_take_precedence(self):
+        rules = KnownInconsistencies([
+            rule("specific", "^linux", ["^browserWindow_01"], pixels=[[1, 10]]),
+            rule("any platform", ".*", ["^browserWindow"], pixels=[5, 50]),
+            rule("later", "^linux", ["browserWindow"], pixels=[5]),
+        ])
+        self.assertEqual(reason(rules.match("linux64", "browserWindow_01_normal", "5")), "specific")
+        self.assertEqual(reason(rules.match("linux64", "browserWindow_02_normal", "5")), "any platform")
+        self.assertEqual(reason(rules.match("windows7-32", "browserWindow_01_normal", "5")), "any platform")
+        self.assertEqual(reason(rules.match("linux64", "browserWindow_01_normal", "50")), "any platform")
+        self.assertIsNone(rules.match("linux64", "browserWindow_01_normal", "51"))
+        self.assertEqual([known.reason for known in rules.rules_for("linux64", "browserWindow_01_normal")],
+                         ["specific", "any platform", "later"])
+
+    def test_pixels(self):
+        rules = KnownInconsistencies([rule("pixels", ".*", ["x"], pixels=[3, [80, 90]], pixelRegex="^1\\d\\d$")])
+        for difference in ("3", "80", "85", "90", "100", "199"):
+            self.assertIsNotNone(rules.match("linux64", "x", difference), difference)
+        for difference in ("2", "79", "91", "200", "ERROR", None):
+            self.assertIsNone(rules.match("linux64", "x", difference), difference)
+
+    def test_rule_without_difference(self):
+        with self.assertRaises(ValueError):
+            KnownInconsistencies([rule("everything", ".*", ["x"])])
+
+    def test_named_groups_and_backreferences(self):
+        # Two rules with the same group name can't be combined into one regex.
+        rules = KnownInconsistencies([
+            rule("named", ".*", ["^(?P<config>tabs)_"], pixels=[1]),
+            rule("same name", ".*", ["^(?P<config>toolbars)_"], pixels=[1]),
+            rule("backreference", ".*", ["^(\\w+)_\\1$"], pixels=[1]),
+            rule("plain", ".*", ["^(lwtheme)_"], pixels=[1]),
+        ])
+        self.assertEqual(reason(rules.match("linux64", "tabs_01", "1")), "named")
+        self.assertEqual(reason(rules.match("linux64", "toolbars_01", "1")), "same name")
+        self.assertEqual(reason(rules.match("linux64", "menu_menu", "1")), "backreference")
+        self.assertEqual(reason(rules.match("linux64", "lwtheme_01", "1")), "plain")
+        self.assertIsNone(rules.match("linux64", "menu_panel", "1"))
+
+    def test_inline_flags(self):
+        # The flag would apply to the other rules if they were combined.
+        rules = KnownInconsistencies([
+            rule("case insensitive", ".*", ["(?i)^tabs_"], pixels=[1]),
+            rule("case sensitive", ".*", ["^toolbars_"], pixels=[1]),
+        ])
+        self.assertEqual(reason(rules.match("linux64", "TABS_01", "1")), "case insensitive")
+        self.assertEqual(reason(rules.match("linux64", "toolbars_01", "1")), "case sensitive")
+        self.assertIsNone(rules.match("linux64", "TOOLBARS_01", "1"))
+        self.assertEqual(len(known_inconsistencies.combine_patterns(["(?s)a.b", "c", "d"])), 2)
+
+    def test_combine_patterns_group_limit(self):
+        patterns = ["(a{0})(b)(c)".format(i) for i in range(100)]
+        regexes = known_inconsistencies.combine_patterns(patterns)
+        self.assertGreater(len(regexes), 1)
+        self.assertTrue(all(regex.groups <= known_inconsistencies.MAX_GROUPS for regex in regexes))
+        self.assertTrue(any(regex.search("a99bc") for regex in regexes))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from metadata_cache import IMMUTABLE, MetadataCache
+
+URL = "https://treeherder.mozilla.org/api/project/try/push/?count=2&full=true&revision=5f6ca9194dd9"
+
+
+class MetadataCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = MetadataCache(os.path.join(self.tmpdir, "metadata_cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def age(self, method, url, seconds):
+        """Make the entry for the request `seconds` older."""
+        path = self.cache._path(method, url)
+        with open(path, "r") as entry_file:
+            entry = json.load(entry_file)
+        entry["fetched"] -= seconds
+        with open(path, "w") as entry_file:
+            json.dump(entry, entry_file)
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get("get", URL))
+        self.cache.put("get", URL, {"results": [1]}, 60, etag='"abc"')
+        entry = self.cache.get("GET", URL)
+        self.assertEqual((entry["body"], entry["max_age"], entry["etag"], entry["last_modified"]),
+                         ({"results": [1]}, 60, '"abc"', None))
+        # The method is part of the key.
+        self.assertIsNone(self.cache.get("post", URL))
+
+    def test_freshness(self):
+        self.cache.put("get", URL, {}, 60)
+        self.cache.put("post", URL, {}, IMMUTABLE)
+        self.assertTrue(MetadataCache.is_fresh(self.cache.get("get", URL)))
+        self.age("get", URL, 61)
+        self.age("post", URL, 10 ** 9)
+        self.assertFalse(MetadataCache.is_fresh(self.cache.get("get", URL)))
+        self.assertTrue(MetadataCache.is_fresh(self.cache.get("post", URL)))
+
+        # Revalidated entries are fresh again.
+        self.cache.touch("get", URL, self.cache.get("get", URL))
+        self.assertTrue(MetadataCache.is_fresh(self.cache.get("get", URL)))
+        self.assertTrue(MetadataCache.is_fresh(self.cache.get("get", URL), time.time() + 59))
+        self.assertFalse(MetadataCache.is_fresh(self.cache.get("get", URL), time.time() + 61))
+
+    def test_stats_and_clear(self):
+        self.cache.put("get", URL, {}, IMMUTABLE)
+        self.cache.put("get", URL + "&fresh", {}, 60)
+        self.cache.put("get", URL + "&stale", {}, 60)
+        self.age("get", URL + "&stale", 61)
+        stats = self.cache.stats()
+        self.assertEqual([stats[key] for key in ("entries", "immutable", "fresh", "stale")], [3, 1, 1, 1])
+        self.assertGreater(stats["bytes"], 0)
+
+        self.assertEqual(self.cache.clear(stale_only=True), 1)
+        self.assertIsNone(self.cache.get("get", URL + "&stale"))
+        self.assertEqual(self.cache.clear(), 2)
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import email
+import email.utils
+import os
+import shutil
+import smtplib
+import socket
+import tempfile
+import unittest
+from email.mime.text import MIMEText
+
+import outbox
+
+
+class FakeSMTP(object):
+    """Records the messages sent, raising the queued `failures` first and for the `unreachable` subjects."""
+    sent = []
+    failures = []
+    unreachable = set()
+    connections = 0
+
+    def __init__(self, host, port=None, local_hostname=None):
+        FakeSMTP.connections += 1
+
+    def sendmail(self, from_addr, to_addrs, message):
+        if FakeSMTP.failures:
+            raise FakeSMTP.failures.pop(0)
+        msg = email.message_from_string(message)
+        if msg["Subject"] in FakeSMTP.unreachable:
+            raise socket.error("connection refused")
+        FakeSMTP.sent.append(msg)
+
+    def close(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+def message(subject):
+    msg = MIMEText("Results of " + subject)
+    msg["Subject"] = subject
+    msg["From"] = "from@example.com"
+    msg["To"] = "to@example.com"
+    msg["Message-ID"] = email.utils.make_msgid()
+    return msg
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outbox = outbox.Outbox(os.path.join(self.tmpdir, "outbox"))
+        self.original_smtp = outbox.smtplib.SMTP
+        self.original_retry_delay = outbox.RETRY_DELAY
+        outbox.smtplib.SMTP = FakeSMTP
+        outbox.RETRY_DELAY = 0
+        FakeSMTP.sent = []
+        FakeSMTP.failures = []
+        FakeSMTP.unreachable = set()
+        FakeSMTP.connections = 0
+
+    def tearDown(self):
+        outbox.smtplib.SMTP = self.original_smtp
+        outbox.RETRY_DELAY = self.original_retry_delay
+        shutil.rmtree(self.tmpdir)
+
+    def enqueue(self, thread, *subjects):
+        for subject in subjects:
+            self.outbox.enqueue(thread, message(subject), ["to@example.com"])
+
+    def test_delivered_in_order_over_one_connection(self):
+        self.enqueue("mozilla-central", "a", "b")
+        self.enqueue("try", "c")
+        self.enqueue("mozilla-central", "d")
+        self.assertEqual(self.outbox.deliver(), 4)
+        self.assertEqual([msg["Subject"] for msg in FakeSMTP.sent], ["a", "b", "c", "d"])
+        self.assertEqual(FakeSMTP.connections, 1)
+        self.assertEqual(self.outbox.pending(), [])
+
+    def test_dates_increase(self):
+        self.enqueue("mozilla-central", "a", "b", "c")
+        self.outbox.deliver()
+        dates = [email.utils.mktime_tz(email.utils.parsedate_tz(msg["Date"])) for msg in FakeSMTP.sent]
+        self.assertEqual(dates, sorted(set(dates)))
+
+    def test_threading(self):
+        self.enqueue("mozilla-central", "a", "b")
+        self.enqueue("try", "c")
+        self.enqueue("mozilla-central", "d")
+        self.outbox.deliver()
+        a, b, c, d = FakeSMTP.sent
+        self.assertIsNone(a["In-Reply-To"])
+        self.assertEqual(b["In-Reply-To"], a["Message-ID"])
+        self.assertIsNone(c["In-Reply-To"])
+        self.assertEqual(d["In-Reply-To"], b["Message-ID"])
+        self.assertEqual(d["References"].split(), [a["Message-ID"], b["Message-ID"]])
+
+    def test_references_are_limited(self):
+        self.enqueue("mozilla-central", *[str(i) for i in range(outbox.MAX_REFERENCES + 5)])
+        self.outbox.deliver()
+        references = FakeSMTP.sent[-1]["References"].split()
+        self.assertEqual(len(references), outbox.MAX_REFERENCES)
+        self.assertEqual(references[0], FakeSMTP.sent[0]["Message-ID"])
+        self.assertEqual(references[-1], FakeSMTP.sent[-2]["Message-ID"])
+
+    def test_retry(self):
+        self.enqueue("mozilla-central", "a", "b")
+        FakeSMTP.failures = [socket.error("connection reset"), smtplib.SMTPServerDisconnected("gone")]
+        self.assertEqual(self.outbox.deliver(), 2)
+        self.assertEqual([msg["Subject"] for msg in FakeSMTP.sent], ["a", "b"])
+        # The connection is opened again after each error.
+        self.assertEqual(FakeSMTP.connections, 3)
+
+    def test_undelivered_messages_stay_queued_in_order(self):
+        self.enqueue("mozilla-central", "a", "b", "c")
+        self.outbox.max_retries = 1
+        FakeSMTP.unreachable = set(["b"])
+        self.assertEqual(self.outbox.deliver(), 1)
+        self.assertEqual([msg["Subject"] for msg in FakeSMTP.sent], ["a"])
+        self.assertEqual(len(self.outbox.pending()), 2)
+
+        FakeSMTP.unreachable = set()
+        self.assertEqual(self.outbox.deliver(), 2)
+        self.assertEqual([msg["Subject"] for msg in FakeSMTP.sent], ["a", "b", "c"])
+
+    def test_rejected_messages_are_set_aside(self):
+        self.enqueue("mozilla-central", "a", "b")
+        FakeSMTP.failures = [smtplib.SMTPRecipientsRefused({"to@example.com": (550, "No such user")})]
+        self.assertEqual(self.outbox.deliver(), 1)
+        self.assertEqual([msg["Subject"] for msg in FakeSMTP.sent], ["b"])
+        self.assertEqual(len(os.listdir(os.path.join(self.outbox.path, outbox.FAILED_DIRNAME))), 1)
+        self.assertEqual(self.outbox.pending(), [])
+
+    def test_permanent_errors_are_set_aside(self):
+        self.enqueue("mozilla-central", "a", "b", "c")
+        FakeSMTP.failures = [smtplib.SMTPDataError(550, "Message rejected as spam"),
+                             smtplib.SMTPDataError(451, "Try again later")]
+        self.assertEqual(self.outbox.deliver(), 2)
+        self.assertEqual([msg["Subject"] for msg in FakeSMTP.sent], ["b", "c"])
+        self.assertEqual(len(os.listdir(os.path.join(self.outbox.path, outbox.FAILED_DIRNAME))), 1)
+
+    def test_is_rejection(self):
+        self.assertTrue(outbox.is_rejection(smtplib.SMTPSenderRefused(553, "Bad sender", "from@example.com")))
+        self.assertTrue(outbox.is_rejection(smtplib.SMTPDataError(554, "Transaction failed")))
+        self.assertFalse(outbox.is_rejection(smtplib.SMTPDataError(421, "Closing")))
+        self.assertFalse(outbox.is_rejection(smtplib.SMTPConnectError(554, "No service")))
+        self.assertFalse(outbox.is_rejection(smtplib.SMTPServerDisconnected("gone")))
+        self.assertFalse(outbox.is_rejection(socket.error("connection refused")))
+
+
+if __name__ == "__main__":
+    unittest.main()
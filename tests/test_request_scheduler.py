@@ -0,0 +1,125 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+import unittest
+
+import requests
+
+import request_scheduler
+from request_scheduler import RequestScheduler
+
+URL = "https://treeherder.mozilla.org/api/project/try/push/"
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+    """Returns (or raises) the queued `outcomes` in order, then 200 responses."""
+
+    def __init__(self, outcomes=(), seconds=0):
+        self.outcomes = list(outcomes)
+        self.seconds = seconds
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            outcome = self.outcomes.pop(0) if self.outcomes else FakeResponse(200)
+        time.sleep(self.seconds)
+        with self.lock:
+            self.in_flight -= 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class RequestSchedulerTest(unittest.TestCase):
+    def scheduler(self, session, max_concurrency=4, max_retries=2):
+        # No backoff so the retries are immediate.
+        return RequestScheduler(session, max_concurrency, max_retries, backoff=0)
+
+    def test_retries_server_errors(self):
+        failed = FakeResponse(502)
+        session = FakeSession([failed, FakeResponse(503)])
+        scheduler = self.scheduler(session)
+        self.assertEqual(scheduler.request("get", URL).status_code, 200)
+        self.assertEqual(session.requests, 3)
+        self.assertTrue(failed.closed)
+        stats = scheduler.stats()["treeherder.mozilla.org"]
+        self.assertEqual((stats["requests"], stats["retries"], stats["throttled"], stats["failures"]), (3, 2, 1, 0))
+
+    def test_returns_the_last_response(self):
+        session = FakeSession([FakeResponse(500), FakeResponse(500), FakeResponse(500), FakeResponse(200)])
+        scheduler = self.scheduler(session)
+        self.assertEqual(scheduler.request("get", URL).status_code, 500)
+        self.assertEqual(session.requests, 3)
+        self.assertEqual(scheduler.stats()["treeherder.mozilla.org"]["failures"], 1)
+
+    def test_client_errors_are_not_retried(self):
+        session = FakeSession([FakeResponse(404)])
+        self.assertEqual(self.scheduler(session).request("get", URL).status_code, 404)
+        self.assertEqual(session.requests, 1)
+
+    def test_connection_errors(self):
+        session = FakeSession([requests.exceptions.ConnectionError("reset"), requests.exceptions.Timeout("slow")])
+        self.assertEqual(self.scheduler(session).request("get", URL).status_code, 200)
+
+        session = FakeSession([requests.exceptions.ConnectionError("reset")] * 3)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.scheduler(session).request("get", URL)
+        self.assertEqual(session.requests, 3)
+
+    def test_retry_after(self):
+        scheduler = self.scheduler(FakeSession())
+        self.assertEqual(scheduler.delay(1, FakeResponse(429, {"Retry-After": "7"})), 7)
+        self.assertEqual(scheduler.delay(1, FakeResponse(429, {"Retry-After": "3600"})), request_scheduler.MAX_BACKOFF)
+        scheduler.backoff = 1.0
+        for attempt in range(1, 10):
+            self.assertTrue(0 <= scheduler.delay(attempt) <= min(request_scheduler.MAX_BACKOFF, 2 ** attempt))
+
+    def test_throttling_halves_the_limit_once_per_interval(self):
+        scheduler = self.scheduler(FakeSession([FakeResponse(429), FakeResponse(503)]), max_concurrency=8)
+        scheduler.request("get", URL)
+        # Halved once by the two overloaded responses, then grown by the successful one.
+        self.assertEqual(scheduler.stats()["treeherder.mozilla.org"]["limit"], 4)
+
+        limiter = scheduler.limiter("treeherder.mozilla.org")
+        for i in range(100):
+            limiter.acquire()
+            limiter.release(0)
+        self.assertEqual(limiter.limit, 8)
+
+    def test_concurrency_limit(self):
+        session = FakeSession(seconds=0.02)
+        scheduler = self.scheduler(session, max_concurrency=4)
+        scheduler.set_max_concurrency(2)
+        threads = [threading.Thread(target=scheduler.request, args=("get", URL)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(session.requests, 8)
+        self.assertEqual(session.max_in_flight, 2)
+        # Hosts are limited separately.
+        scheduler.request("get", "https://firefox-ci-tc.services.mozilla.com/api/queue/v1/task/")
+        self.assertEqual(sorted(scheduler.stats()), ["firefox-ci-tc.services.mozilla.com", "treeherder.mozilla.org"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import comparison_cache
+from comparison_common import ComparisonResult
+from known_inconsistencies import KnownInconsistencies
+from results_index import ResultsIndex
+
+OLD_REV = "08138045c38c"
+NEW_REVS = ["5f6ca9194dd9", "0123456789ab", "abcdef012345"]
+
+
+def output(result, difference):
+    return {"result": result, "difference": difference}
+
+
+class ResultsIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.archive = tempfile.mkdtemp()
+        self.index = ResultsIndex(os.path.join(self.archive, "results.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.archive)
+
+    def outdir(self, new_rev, platform="linux64"):
+        return os.path.join(self.archive, "comparisons", "mozilla-central", OLD_REV, "try", new_rev, platform)
+
+    def add_comparisons(self):
+        for i, (new_rev, difference) in enumerate(zip(NEW_REVS, ["12", "0", "40"])):
+            result = ComparisonResult.DIFFERENT if difference != "0" else ComparisonResult.SIMILAR
+            self.index.add(self.outdir(new_rev), {
+                "browserWindow_01.png": output(result, difference),
+                "tabs_01.png": output(ComparisonResult.SIMILAR, "0"),
+            }, {}, {}, 1000 + i)
+        self.index.add(self.outdir(NEW_REVS[0], "windows7-32"), {
+            "browserWindow_01.png": output(ComparisonResult.ERROR, "-1"),
+        }, {}, {}, 2000)
+
+    def test_history(self):
+        self.add_comparisons()
+        history = self.index.history("browserWindow_01.png", platform="linux64")
+        self.assertEqual([(row[0], row[4], row[6], row[7]) for row in history], [
+            (1002, NEW_REVS[2], ComparisonResult.DIFFERENT, 40),
+            (1001, NEW_REVS[1], ComparisonResult.SIMILAR, 0),
+            (1000, NEW_REVS[0], ComparisonResult.DIFFERENT, 12),
+        ])
+        self.assertEqual(history[0][1:6], ("mozilla-central", OLD_REV, "try", NEW_REVS[2], "linux64"))
+        self.assertEqual([row[5] for row in self.index.history("browserWindow_01.png", limit=2)],
+                         ["windows7-32", "linux64"])
+        self.assertEqual(self.index.history("browserWindow_01.png", project="mozilla-central"), [])
+
+    def test_readding_replaces_results(self):
+        self.add_comparisons()
+        self.index.add(self.outdir(NEW_REVS[0]), {"tabs_01.png": output(ComparisonResult.DIFFERENT, "3")}, {}, {}, 3000)
+        self.assertEqual(self.index.compared(self.outdir(NEW_REVS[0])), 3000)
+        self.assertEqual(len(self.index.history("browserWindow_01.png", platform="linux64")), 2)
+        self.assertEqual(self.index.history("tabs_01.png")[0][6:], (ComparisonResult.DIFFERENT, 3))
+        self.assertIsNone(self.index.compared(self.outdir("ffffffffffff")))
+
+    def test_flaky(self):
+        self.add_comparisons()
+        self.assertEqual(self.index.flaky(), [("linux64", "browserWindow_01.png", 3, 2, 2, 12, 40)])
+        self.assertEqual(self.index.flaky(min_comparisons=4), [])
+        self.assertEqual(self.index.flaky(platform="windows7-32"), [])
+
+    def test_rule_matches(self):
+        self.add_comparisons()
+        rules = KnownInconsistencies([
+            {"reason": "small", "platformRegex": "^linux", "nameRegexes": ["^browserWindow"], "pixels": [[1, 20]]},
+            {"reason": "any", "platformRegex": ".*", "nameRegexes": ["^browserWindow"], "pixels": [[1, 100]]},
+            {"reason": "unused", "platformRegex": ".*", "nameRegexes": ["^tabs"], "pixels": [1]},
+        ])
+        self.assertEqual(self.index.rule_matches(rules), [[1, 1000], [2, 1002], [0, None]])
+
+    def test_backfill(self):
+        images = {}
+        for rev, platform in ((OLD_REV, "linux64-1001"), (NEW_REVS[0], "linux64-2001")):
+            job_dir = os.path.join(self.archive, "mozilla-central" if rev == OLD_REV else "try", rev, platform)
+            os.makedirs(job_dir)
+            images[rev] = os.path.join(job_dir, "1234-browserWindow_01.png")
+            with open(images[rev], "wb") as f:
+                f.write(rev.encode("utf-8"))
+        for new_rev in NEW_REVS[:2]:
+            os.makedirs(self.outdir(new_rev))
+            with open(os.path.join(self.outdir(new_rev), "comparison.json"), "w") as f:
+                json.dump({"browserWindow_01.png": output(ComparisonResult.DIFFERENT, "5")}, f)
+
+        self.assertEqual(self.index.backfill(self.archive), 2)
+        self.assertEqual(self.index.backfill(self.archive), 0)
+        self.assertEqual(self.index.backfill(self.archive, force=True), 2)
+        rows = self.index.connection.execute(
+            "SELECT c.new_rev, r.before_sha512, r.after_sha512 FROM results r "
+            "JOIN comparisons c ON c.id = r.comparison_id ORDER BY c.new_rev").fetchall()
+        old_hash = comparison_cache.file_sha512(images[OLD_REV])
+        # The after revision of the second comparison wasn't fetched.
+        self.assertEqual(rows, [(NEW_REVS[1], old_hash, None),
+                                (NEW_REVS[0], old_hash, comparison_cache.file_sha512(images[NEW_REVS[0]]))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from hashlib import sha512
+
+import store_maintenance
+
+DAY = 24 * 60 * 60
+GRACE = 60 * 60
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.archive = tempfile.mkdtemp()
+        self.store = os.path.join(self.archive, store_maintenance.DEFAULT_STORE_PATH)
+        self.now = time.time()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive)
+
+    def blob(self, data, age=DAY):
+        digest = sha512(data).hexdigest()
+        path = os.path.join(self.store, digest[0], digest[1], digest)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(data)
+        os.utime(path, (self.now - age, self.now - age))
+        return path
+
+    def revision(self, rev, blobs, age=DAY):
+        """Link the `blobs` into a job directory of a revision fetched `age` seconds ago."""
+        job_dir = os.path.join(self.archive, "try", rev, "linux64-123456")
+        os.makedirs(job_dir)
+        for i, blob in enumerate(blobs):
+            os.link(blob, os.path.join(job_dir, "%d-image.png" % i))
+        for path in (job_dir, os.path.dirname(job_dir)):
+            os.utime(path, (self.now - age, self.now - age))
+        return os.path.dirname(job_dir)
+
+
+class CollectGarbageTest(StoreTest):
+    def test_only_unreferenced_old_files_are_removed(self):
+        linked = self.blob(b"linked")
+        self.revision("a" * 40, [linked])
+        unreferenced = self.blob(b"unreferenced" * 10)
+        recent = self.blob(b"recent", age=60)
+        tmp_dir = os.path.join(self.store, store_maintenance.STORE_TMP_DIR)
+        os.makedirs(tmp_dir)
+        abandoned = os.path.join(tmp_dir, "download-old")
+        downloading = os.path.join(tmp_dir, "download-new")
+        for path, age in ((abandoned, DAY), (downloading, 0)):
+            with open(path, "wb") as f:
+                f.write(b"partial")
+            os.utime(path, (self.now - age, self.now - age))
+
+        self.assertEqual(store_maintenance.collect_garbage(self.store, GRACE, dry_run=True), (2, 127))
+        self.assertTrue(os.path.exists(unreferenced))
+        self.assertEqual(store_maintenance.collect_garbage(self.store, GRACE), (2, 127))
+        self.assertEqual([os.path.exists(path) for path in (linked, unreferenced, recent, abandoned, downloading)],
+                         [True, False, True, False, True])
+
+    def test_stats(self):
+        shared = self.blob(b"shared" * 10)
+        self.revision("a" * 40, [shared])
+        self.revision("b" * 40, [shared, self.blob(b"own")])
+        self.blob(b"unreferenced")
+        stats = store_maintenance.store_stats(self.store)
+        self.assertEqual([stats[key] for key in ("blobs", "unreferenced_blobs", "links", "bytes", "linked_bytes")],
+                         [3, 1, 3, 75, 123])
+        self.assertEqual(stats["bytes_saved"], 60)
+
+
+class PlanPruneTest(StoreTest):
+    def setUp(self):
+        StoreTest.setUp(self)
+        self.shared = self.blob(b"s" * 100)
+        self.oldest = self.revision("a" * 40, [self.shared, self.blob(b"a" * 10)], age=30 * DAY)
+        self.older = self.revision("b" * 40, [self.shared, self.blob(b"b" * 20)], age=20 * DAY)
+        self.recent = self.revision("c" * 40, [self.blob(b"c" * 40)], age=60)
+        self.store_bytes = 170
+
+    def plan(self, **kwargs):
+        to_remove, store_bytes = store_maintenance.plan_prune(store_maintenance.revisions(self.archive),
+                                                              self.store_bytes, grace=GRACE, **kwargs)
+        return ([revision.path for revision in to_remove], store_bytes)
+
+    def test_max_age(self):
+        self.assertEqual(self.plan(max_age=25 * DAY), ([self.oldest], 160))
+        # The shared blob is only freed once no revision links to it.
+        self.assertEqual(self.plan(max_age=10 * DAY), ([self.oldest, self.older], 40))
+
+    def test_budget(self):
+        self.assertEqual(self.plan(budget=165), ([self.oldest], 160))
+        self.assertEqual(self.plan(budget=150), ([self.oldest, self.older], 40))
+        # Revisions within the grace period are kept even if the store is still over budget.
+        self.assertEqual(self.plan(budget=0), ([self.oldest, self.older], 40))
+        self.assertEqual(self.plan(budget=1000), ([], 170))
+
+    def test_lru(self):
+        # Viewing an image only linked by the oldest revision makes it the most recently used.
+        viewed = os.path.join(self.oldest, "linux64-123456", "1-image.png")
+        os.utime(viewed, (self.now - 2 * GRACE, os.stat(viewed).st_mtime))
+        self.assertEqual(self.plan(budget=165, policy="lru"), ([self.older], 150))
+        self.assertEqual(self.plan(budget=100, policy="lru"), ([self.older, self.oldest], 40))
+        # The shared image was last viewed a day ago.
+        self.assertEqual(self.plan(max_age=2 * DAY, policy="lru"), ([], 170))
+
+    def test_sizes(self):
+        self.assertEqual(store_maintenance.parse_size("50G"), 50 * 1024 ** 3)
+        self.assertEqual(store_maintenance.parse_size("1.5kb"), 1536)
+        self.assertEqual(store_maintenance.parse_size("100"), 100)
+        self.assertEqual(store_maintenance.format_size(1536), "1.5KB")
+
+
+if __name__ == "__main__":
+    unittest.main()
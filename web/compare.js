@@ -25,12 +25,19 @@ var Compare = {
   },
   TASKCLUSTER_API: "https://firefox-ci-tc.services.mozilla.com/api",
   TREEHERDER_API: "https://treeherder.mozilla.org/api",
+  // comparison_service.py behind the web server
+  COMPARISON_SERVICE_URL: "https://screenshots.mattn.ca/compare/service",
 
   comparisonsByPlatform: new Map(),
+  // Display name -> composite name of the composites deferred by each platform's comparison,
+  // see fetchDeferredComposites.
+  deferredCompositesByPlatform: new Map(),
   form: null,
   resultsetsByID: new Map(),
   screenshotsByJob: new Map(),
-  knownInconsistencies: {},
+  // Known inconsistency rules grouped by platform pattern, see fetchKnownInconsistencies.
+  knownInconsistencies: [],
+  knownInconsistenciesByPlatform: new Map(),
 
   init() {
     console.log("init");
@@ -154,15 +161,73 @@ var Compare = {
     }
   },
 
+  /**
+   * Group the rules by platform pattern and combine the name patterns of each group into one
+   * regex so most images are rejected with a single test, like known_inconsistencies.py.
+   * Rules match the difference with a `pixelRegex` and/or `pixels`, a list of counts and
+   * inclusive [min, max] ranges.
+   */
   async fetchKnownInconsistencies() {
     let xhr = await this.getJSON("known_inconsistencies.json");
-    let response = xhr.response;
-    for (let known of response) {
-      known.platformRegex = new RegExp(known.platformRegex);
-      known.pixelRegex = new RegExp(known.pixelRegex);
+    let groups = new Map();
+    for (let [index, known] of xhr.response.entries()) {
+      if (!groups.has(known.platformRegex)) {
+        groups.set(known.platformRegex, {
+          platformRegex: new RegExp(known.platformRegex),
+          namePatterns: [],
+          rules: [],
+        });
+      }
+      let group = groups.get(known.platformRegex);
+      group.namePatterns.push(...known.nameRegexes);
+      group.rules.push(known);
+      // Rules earlier in the file take precedence, whatever their group.
+      known.index = index;
+      known.pixelRegex = "pixelRegex" in known ? new RegExp(known.pixelRegex) : null;
+      known.pixels = known.pixels || [];
       known.nameRegexes = known.nameRegexes.map(pattern => new RegExp(pattern));
     }
-    this.knownInconsistencies = response;
+    for (let group of groups.values()) {
+      // Patterns with backreferences can't be combined since their group numbers would change,
+      // nor patterns with named groups since two rules could use the same name.
+      let combinable = group.namePatterns.filter(pattern => !/\\[1-9]|\\k<|\(\?<[^=!]/.test(pattern));
+      group.nameRegexes = group.namePatterns.filter(pattern => !combinable.includes(pattern))
+        .map(pattern => new RegExp(pattern));
+      if (combinable.length) {
+        group.nameRegexes.push(new RegExp(combinable.map(pattern => `(?:${pattern})`).join("|")));
+      }
+    }
+    this.knownInconsistencies = [...groups.values()];
+    this.knownInconsistenciesByPlatform.clear();
+  },
+
+  matchKnownInconsistency(platform, basename, difference) {
+    if (!this.knownInconsistenciesByPlatform.has(platform)) {
+      this.knownInconsistenciesByPlatform.set(platform, this.knownInconsistencies.filter(
+        group => group.platformRegex.test(platform)));
+    }
+    let count = Number(difference);
+    let match = null;
+    for (let group of this.knownInconsistenciesByPlatform.get(platform)) {
+      if (!group.nameRegexes.some(regex => regex.test(basename))) {
+        continue;
+      }
+      for (let known of group.rules) {
+        if (match && match.index < known.index) {
+          break;
+        }
+        let pixelsMatch = known.pixels.some(pixels => Array.isArray(pixels) ?
+                                            pixels[0] <= count && count <= pixels[1] : pixels == count);
+        if (!pixelsMatch && !(known.pixelRegex && known.pixelRegex.test(difference))) {
+          continue;
+        }
+        if (known.nameRegexes.some(pattern => pattern.test(basename))) {
+          match = known;
+          break;
+        }
+      }
+    }
+    return match;
   },
 
   async populateSuggestedRevisions() {
@@ -262,6 +327,7 @@ var Compare = {
 
     let isComparison = this.newProject && this.newRev;
     this.comparisonsByPlatform = new Map();
+    this.deferredCompositesByPlatform = new Map();
     this.resultsetsByID = new Map();
     this.screenshotsByJob = new Map();
 
@@ -314,13 +380,30 @@ var Compare = {
     }
   },
 
-  triggerComparisons() {
+  /**
+   * Request the comparison and wait for it to finish. Requests for the same pair of pushes
+   * share one job of the comparison service.
+   */
+  async triggerComparisons() {
     console.debug("triggerComparisons");
     let params = new URLSearchParams();
     for (let param of ["oldProject", "oldRev", "newProject", "newRev"]) {
       params.append(param, this.form[param].value.trim());
     }
-    return this.getJSON("https://screenshots.mattn.ca/compare/cgi-bin/request_comparison.cgi?" + params.toString());
+    let progress = document.querySelector("progress");
+    let xhr = await this.requestJSON("POST", this.COMPARISON_SERVICE_URL + "/comparisons", params);
+    let job = xhr.response;
+    while (job && (job.state == "queued" || job.state == "running")) {
+      progress.title = job.state == "queued" ? `Comparison queued (position ${job.position})` :
+        `Comparing… ${job.platforms_compared.join(", ")}`;
+      xhr = await this.getJSON(`${this.COMPARISON_SERVICE_URL}/comparisons/${job.id}?wait=30`);
+      job = xhr.response;
+    }
+    progress.title = "";
+    if (!job || job.state == "failed") {
+      console.error("Comparison failed", job);
+    }
+    return job;
   },
 
   fetchComparisons() {
@@ -342,6 +425,7 @@ var Compare = {
       this.comparisonsByPlatform.set(platform, xhr.response);
       return xhr;
     }
+    await this.fetchDeferredComposites(platform);
     let response = xhr.response;
     for (let comboName of Object.keys(response)) {
       let displayName = this.calculateCombinationDisplayName(comboName);
@@ -356,6 +440,20 @@ var Compare = {
     return xhr;
   },
 
+  /**
+   * Comparisons run with --defer-composites list the composites which the comparison service
+   * builds when they're first requested in composites.json.
+   */
+  async fetchDeferredComposites(platform) {
+    let xhr = await this.getJSON(`https://screenshots.mattn.ca/comparisons/${this.oldProject}/${this.oldRev}/` +
+                                 `${this.newProject}/${this.newRev}/${platform}/composites.json`);
+    let composites = new Map();
+    for (let name of Object.keys(xhr.response || {})) {
+      composites.set(this.calculateCombinationDisplayName(name), name);
+    }
+    this.deferredCompositesByPlatform.set(platform, composites);
+  },
+
   fetchResultset(project, rev) {
     var url = this.TREEHERDER_API + "/project/" + project
               + "/push/?count=2&full=true&revision=" + rev;
@@ -458,16 +556,20 @@ var Compare = {
   },
 
   getJSON(url) {
+    return this.requestJSON("GET", url);
+  },
+
+  requestJSON(method, url, body = null) {
     return new Promise((resolve, reject) => {
       var xhr = new XMLHttpRequest();
       xhr.addEventListener("load", (evt) => resolve(evt.target));
       xhr.addEventListener("error", reject);
       xhr.addEventListener("abort", reject);
-      xhr.open("GET", url, true);
+      xhr.open(method, url, true);
       // This will prevent the rel="preload" from working due to the preload not using this accept header
       //xhr.setRequestHeader("Accept", "application/json");
       xhr.responseType = "json";
-      xhr.send();
+      xhr.send(body);
     });
   },
 
@@ -482,19 +584,10 @@ var Compare = {
         diffCol.textContent = comparison.difference == "0" ? "None" : comparison.difference + "px";
         break;
       case this.RESULT.DIFFERENT:
-        for (let known of this.knownInconsistencies) {
-          if (!known.platformRegex.test(platform)) {
-            continue;
-          }
-          if (!known.pixelRegex.test(comparison.difference)) {
-            continue;
-          }
-          if (!known.nameRegexes.some(pattern => pattern.test(basename))) {
-            continue;
-          }
+        let known = this.matchKnownInconsistency(platform, basename, comparison.difference);
+        if (known) {
           row.classList.add("known_inconsistency");
           diffLink.parentElement.title = `Known inconsistency: ${known.reason}`;
-          break;
         }
 
         row.classList.add("different");
@@ -504,8 +597,14 @@ var Compare = {
         for (let [bound, val] of Object.entries(comparison.difference_bounds || {})) {
           diffLink.setAttribute("data-difference-bounds-" + bound, val);
         }
-        diffLink.dataset.img = `https://screenshots.mattn.ca/comparisons/${this.oldProject}/${this.oldRev}/`
-          + `${this.newProject}/${this.newRev}/${platform}/${image}`;
+        let deferred = this.deferredCompositesByPlatform.get(platform);
+        if (deferred && deferred.has(image)) {
+          diffLink.dataset.img = `${this.COMPARISON_SERVICE_URL}/composites/${this.oldProject}/${this.oldRev}/`
+            + `${this.newProject}/${this.newRev}/${platform}/${deferred.get(image)}`;
+        } else {
+          diffLink.dataset.img = `https://screenshots.mattn.ca/comparisons/${this.oldProject}/${this.oldRev}/`
+            + `${this.newProject}/${this.newRev}/${platform}/${image}`;
+        }
         break;
       case this.RESULT.MISSING_BEFORE:
       case this.RESULT.MISSING_AFTER: